@@ -3,26 +3,147 @@ XRDに関するデータを一時的なtmp.hdfに書き込むクラス
 
 Cakeデータ・Patternデータをはじめ、角度配列、frame配列など使いそうなデータを片っ端から保存する
 """
+import json
 import os
-from concurrent.futures import ThreadPoolExecutor
+import time
 
 import h5py
 import numpy as np
-from matplotlib import pyplot as plt
 from tqdm import tqdm
-import streamlit as st
 
+from app_utils.cake_index import CakeIntegralIndex
 from app_utils.peak_handler import Peak
-from modules import XRD
+from app_utils.pyramid import CakePyramid, downsample
+from app_utils.spots import SpotCollector, SpotDetector
+from modules.BatchIntegrator import BatchIntegrator
+from modules.CakePipeline import CakePipeline
+from modules.PeakFitter import PeakFitter
+from modules.XRD import XRD
+from modules.XRDPool import XRDPool
+from modules.StageTimer import StageTimer, profiled
 from modules.HDF5 import HDF5Writer, HDF5Reader
 
 
+class FrameBlockWriter:
+    """
+    (frame, ...) のデータセットにframeごとのデータを書き込むクラス
+    chunkのframe方向の大きさ分だけメモリに溜めてからまとめて書き込むので、圧縮されたchunkを何度も書き直さない
+    done_dataset を渡すと、実際にデータセットに書き込んだframeの完了フラグを立て、定期的にファイルをflushする
+    timer を渡すと、1回の書き込みごとの時間とbyte数を stage の名前で記録する
+    """
+    CHECKPOINT_SECONDS = 10.0 # この間隔でflushする。落ちても、flush済みのframeは次回スキップできる
+
+    def __init__(self, dataset: h5py.Dataset, done_dataset: h5py.Dataset = None,
+                 timer: StageTimer = None, stage: str = 'write'):
+        self.dataset = dataset
+        self.done_dataset = done_dataset
+        self.timer = timer
+        self.stage = stage
+        self.block_frames = dataset.chunks[0] if dataset.chunks is not None else 1
+        self.write_seconds = 0.0 # HDF5への書き込みにかかった時間
+        self.written_bytes = 0
+        self._block = None
+        self._block_start = None
+        self._filled = None
+        self._last_checkpoint = time.perf_counter()
+
+    def write(self, frame: int, data: np.ndarray):
+        if self.block_frames == 1:
+            self._write_to_dataset(np.s_[frame], np.asarray(data, dtype=self.dataset.dtype))
+            return
+        block_start = frame // self.block_frames * self.block_frames
+        if block_start != self._block_start:
+            self.flush()
+            block_stop = min(block_start + self.block_frames, self.dataset.shape[0])
+            self._block = np.zeros((block_stop - block_start, *self.dataset.shape[1:]), dtype=self.dataset.dtype)
+            self._filled = np.zeros(block_stop - block_start, dtype=bool)
+            self._block_start = block_start
+        self._block[frame - block_start] = data
+        self._filled[frame - block_start] = True
+
+    def flush(self):
+        if self._block is None:
+            return
+        if self._filled.all(): # ブロックが全部埋まっていればまとめて書き込む
+            self._write_to_dataset(np.s_[self._block_start:self._block_start + len(self._block)], self._block)
+        else: # 一部のframeしかない場合は、既存のデータを消さないようにframeごとに書き込む
+            for i in np.flatnonzero(self._filled):
+                self._write_to_dataset(np.s_[self._block_start + i], self._block[i])
+        self._block = None
+        self._block_start = None
+        self._filled = None
+
+    def _write_to_dataset(self, selection, data: np.ndarray):
+        start = time.perf_counter()
+        self.dataset[selection] = data
+        seconds = time.perf_counter() - start
+        self.write_seconds += seconds
+        self.written_bytes += data.nbytes
+        if self.timer is not None:
+            self.timer.add(self.stage, seconds, data.nbytes)
+        if self.done_dataset is not None:
+            self.done_dataset[selection] = True
+            if time.perf_counter() - self._last_checkpoint > self.CHECKPOINT_SECONDS:
+                self.dataset.file.flush()
+                self._last_checkpoint = time.perf_counter()
+
+
 class XRDWriter(HDF5Writer):
     BASE_PATH = 'entry/'
-
-    def __init__(self, filepath: str, xrd: XRD):
+    # cakeデータの保存レイアウト
+    #   contiguous: chunkなし・圧縮なし (今まで通り)
+    #   frame: 1frameずつ表示する用。chunkは (1, azi, tth) 方向のタイル
+    #   roi: PeakWriterの再積算のように、狭い範囲を全frameにわたって読む用。chunkはframe方向に深くする
+    CAKE_LAYOUTS = ('contiguous', 'frame', 'roi')
+    COMPRESSIONS = (None, 'lzf', 'gzip')
+    # frameごとの完了フラグ (bool) を entry/progress/<cake, pattern> に保存する
+    PROGRESS_PATH = 'entry/progress'
+    # 書き込み処理ごとの時間の集計 (JSON) を entry/report/<メソッド名> に保存する
+    REPORT_PATH = 'entry/report'
+    # 積算中に使ってよいメモリの既定値。処理中のframe数をこれで制限する
+    DEFAULT_MEMORY_BUDGET = 4 * 1024**3
+
+    def __init__(self, filepath: str, xrd: XRD, num_workers: int = 1,
+                 cake_layout: str = 'contiguous', compression: str = None, shuffle: bool = False,
+                 build_pyramid: bool = False, resume: bool = True, profile_path: str = None,
+                 batch_integrate: bool = False, num_threads: int = 1, memory_budget: int = None,
+                 spot_detector: SpotDetector = None):
+        """
+        num_workers: 積算を行うプロセス数。1なら今まで通り呼び出し元のプロセスで1frameずつ処理する
+        cake_layout: cakeデータのchunkの形。CAKE_LAYOUTS のどれか
+        compression: cakeデータの圧縮フィルタ。COMPRESSIONS のどれか (h5pyの組み込みフィルタ)
+        shuffle: 圧縮前にshuffleフィルタをかけるか。floatの圧縮率が上がる
+        build_pyramid: caking中に縮小したcake・pattern (2x, 4x, 8x, ...) も保存するか。表示を速くするため (CakePyramid)
+        resume: 前回と同じ条件で途中まで書き込まれていれば、完了していないframeだけを積算する
+        profile_path: 指定すると、書き込み処理を cProfile で計測してこのpathに保存する (遅い原因を調べる用)
+        batch_integrate: 複数frameをまとめて疎行列の積で積算する (BatchIntegrator)。frame数が多いときに速い
+        num_threads: num_workers=1 のとき、読み込み・積算・書き込みを別のスレッドで行い、積算をこの数のスレッドで行う (CakePipeline)
+        memory_budget: 積算中に使ってよいメモリ (byte)。Noneなら DEFAULT_MEMORY_BUDGET
+            処理中のframe数 (並列処理のworkerに渡す数、パイプラインの枠、まとめて積算するframe数) をこれに収める
+        spot_detector: 指定すると、cakeを書き込みながらスポットを検出して entry/spots に保存する (SpotDetector)
+        """
+        if cake_layout not in self.CAKE_LAYOUTS:
+            raise ValueError(f"cake_layout が無効です: {cake_layout}\n\t有効なもの: {self.CAKE_LAYOUTS}")
+        if compression not in self.COMPRESSIONS:
+            raise ValueError(f"compression が無効です: {compression}\n\t有効なもの: {self.COMPRESSIONS}")
         super().__init__(filepath) # .hdfファイルを紐づけ or 新規作成
         self.xrd = xrd
+        self.num_workers = num_workers
+        self.cake_layout = cake_layout
+        self.compression = compression
+        self.shuffle = shuffle
+        self.build_pyramid = build_pyramid
+        self.resume = resume
+        self.profile_path = profile_path
+        self.batch_integrate = batch_integrate
+        self._batch = BatchIntegrator(xrd) if batch_integrate else None
+        self.num_threads = num_threads
+        self.memory_budget = memory_budget if memory_budget is not None else self.DEFAULT_MEMORY_BUDGET
+        self.spot_detector = spot_detector
+        self.cake_storage_report = None # cakeを書き込んだ後に、サイズと書き込み速度が入る
+        self.timer = StageTimer() # 直前の書き込み処理の、段階ごとの時間 (読み込み・積算・書き込み)
+        self.run_report = None # 直前の書き込み処理の集計。entry/report にも保存する
+        self._pool = None
 
     def write_params(self):
         params_path = os.path.join(self.BASE_PATH, 'params') # パラメータ書き込み先の起点。これの先にぶら下げる
@@ -31,11 +152,11 @@ class XRDWriter(HDF5Writer):
         to_frame_num = os.path.join(params_path, 'frame_num')
         self.write(data_path=to_frame_num, data=self.xrd.frame_num, overwrite=True)
         # fps (現在.nxsのみ)
-        if self.xrd.xrd_path.endswith('.nxs'):
-            to_fps = os.path.join(params_path, 'fps')
+        to_fps = os.path.join(params_path, 'fps')
+        if self.xrd.fps is not None:
             self.write(data_path=to_fps, data=self.xrd.fps, overwrite=True)
-        if self.xrd.xrd_path.endswith('.hdf'): # .hdfには実装されていないはずなので、間違って流用しないように消す
-            self.delete(data_path=to_fps)
+        else: # .hdfには無いので、前回の.nxsのものを間違って流用しないように消す
+            self._delete_if_exists(to_fps)
 
         # 分割数
         to_npt_tth = os.path.join(params_path, 'npt_tth')
@@ -61,142 +182,764 @@ class XRDWriter(HDF5Writer):
     # 全frameに対する処理なのでメソッドを分けている。
     #   HDF5Writer の write メソッドは書き込むデータ全てをメモリ上に載せることを前提にしているため
     # NOTE: 1,000frameくらいの1次元データなら、最近のPCならいちいち書き込まなくてもメモリに保持できる。そっちのほうが速い
-    def write_pattern_data(self):
-        to_pattern_data = os.path.join(self.BASE_PATH, 'pattern')
-        with h5py.File(self.file_path, 'a') as f_append:
-            # 既存データが存在すれば削除する
-            if to_pattern_data in f_append:
-                del f_append[to_pattern_data]
-            # patternデータの保存領域を作っておく
-            pattern_dataset = f_append.create_dataset(
-                to_pattern_data,
-                shape=(self.xrd.frame_num, self.xrd.npt_tth),
-                dtype=np.float32
-            )
-            # 書き込み
-            # TODO streamlitでの進捗バー表示、threading処理
-            for frame in tqdm(range(self.xrd.frame_num)):
-                pattern = self.xrd.get_1d_pattern_data(frame)
-                pattern_dataset[frame, :] = pattern
+    #   frame_step: Nframeおきに積算する (クイックルック)。残りのframeは、後で frame_step=1 で呼べば埋まる (resume=True のとき)
+    def write_pattern_data(self, frame_step: int = 1):
+        partial = frame_step > 1 # 書き込まないframeが残る
+        with profiled(self.profile_path), h5py.File(self.file_path, 'a') as f_append:
+            pattern_dataset, pattern_done = self._prepare_dataset(f_append, 'pattern', self._create_pattern_dataset, self._pattern_params(), partial)
+            pattern_writer = FrameBlockWriter(pattern_dataset, pattern_done, self.timer, 'write_pattern')
+            frames = self._strided(self._frames_to_process(pattern_done), frame_step)
+            start = self._start_run()
+            # 書き込み。並列の場合も結果はframe順に返ってくるので、ここで1つずつ書き込む
+            # TODO streamlitでの進捗バー表示
+            for frame, pattern in tqdm(self._iterate_pattern(frames), total=len(frames), desc="Writing Pattern Data"):
+                pattern_writer.write(frame, pattern)
+            pattern_writer.flush()
+            if self.build_pyramid:
+                self._write_pattern_pyramid(f_append, pattern_dataset)
+            self._mark_partial(pattern_dataset, pattern_done)
+            self._finish_run(f_append, 'write_pattern_data', len(frames), start)
 
 
     # 全frameに対する処理なのでメソッドを分けている
-    def write_cake_data(self):
+    def write_cake_data(self, frame_step: int = 1):
+        partial = frame_step > 1 # 書き込まないframeが残る
+        with profiled(self.profile_path), h5py.File(self.file_path, 'a') as f_append:
+            cake_dataset, cake_done = self._prepare_dataset(f_append, 'cake', self._create_cake_dataset, self._cake_params(), partial)
+            cake_writer = FrameBlockWriter(cake_dataset, cake_done, self.timer, 'write_cake')
+            pyramid_writers = self._create_cake_pyramid_writers(f_append)
+            frames = self._strided(self._frames_to_process(cake_done), frame_step)
+            spot_collector = self._create_spot_collector(f_append)
+            start = self._start_run()
+            for frame, cake in tqdm(self._iterate_cake(frames), total=len(frames), desc="Writing Cake Data"):
+                cake_writer.write(frame, cake)
+                self._write_cake_pyramid(pyramid_writers, frame, cake)
+                self._collect_spots(spot_collector, frame, cake)
+            cake_writer.flush()
+            self._flush_cake_pyramid(pyramid_writers)
+            self._finish_spots(spot_collector, cake_dataset, cake_done)
+            self._report_cake_storage(cake_writer, time.perf_counter() - start)
+            self._mark_partial(cake_dataset, cake_done)
+            self._finish_run(f_append, 'write_cake_data', len(frames), start)
+
+    # pattern と cake を1回のパスで書き込む。rawデータの読み込み・解凍は1frameにつき1回だけ
+    #   patternはcakeと同じbinから作るので、write_pattern_data と write_cake_data を続けて呼ぶより速い
+    def write_pattern_and_cake_data(self, frame_step: int = 1):
+        partial = frame_step > 1 # 書き込まないframeが残る
+        with profiled(self.profile_path), h5py.File(self.file_path, 'a') as f_append:
+            pattern_dataset, pattern_done = self._prepare_dataset(f_append, 'pattern', self._create_pattern_dataset, self._pattern_params(), partial)
+            cake_dataset, cake_done = self._prepare_dataset(f_append, 'cake', self._create_cake_dataset, self._cake_params(), partial)
+            pattern_writer = FrameBlockWriter(pattern_dataset, pattern_done, self.timer, 'write_pattern')
+            cake_writer = FrameBlockWriter(cake_dataset, cake_done, self.timer, 'write_cake')
+            pyramid_writers = self._create_cake_pyramid_writers(f_append)
+            frames = self._strided(self._frames_to_process(pattern_done, cake_done), frame_step)
+            spot_collector = self._create_spot_collector(f_append)
+            start = self._start_run()
+            for frame, pattern, cake in tqdm(self._iterate_pattern_and_cake(frames), total=len(frames), desc="Writing Pattern & Cake Data"):
+                pattern_writer.write(frame, pattern)
+                cake_writer.write(frame, cake)
+                self._write_cake_pyramid(pyramid_writers, frame, cake)
+                self._collect_spots(spot_collector, frame, cake)
+            pattern_writer.flush()
+            cake_writer.flush()
+            self._flush_cake_pyramid(pyramid_writers)
+            self._finish_spots(spot_collector, cake_dataset, cake_done)
+            if self.build_pyramid:
+                self._write_pattern_pyramid(f_append, pattern_dataset)
+            self._report_cake_storage(cake_writer, time.perf_counter() - start)
+            self._mark_partial(pattern_dataset, pattern_done)
+            self._mark_partial(cake_dataset, cake_done)
+            self._finish_run(f_append, 'write_pattern_and_cake_data', len(frames), start)
+
+    # クイックルック: Nframeおきに、2θ・方位角の範囲 (deg) を絞って pattern と cake を積算する
+    #   範囲は全体のbinの境界に合わせる (BatchIntegrator.set_window) ので、書き込んだ値は全体を積算したときと同じ
+    #   範囲を絞った場合は、そのframeも完了にはしない。後で write_pattern_and_cake_data を呼ぶと、
+    #   範囲を絞らずに積算したframe (完了済み) は飛ばし、それ以外を全体の範囲で積算して埋める
+    #   方位角の範囲を絞った場合、patternは全方位角の和にならないので書き込まない
+    #   build_pyramid=True なら、範囲を書き込んだframeのcakeの縮小版も作り直す (ページはcakeを縮小版で表示するため)
+    def write_quick_look(self, frame_step: int = 10, tth_range: tuple = None, azi_range: tuple = None):
+        if tth_range is None and azi_range is None: # Nframeおきに全体を積算する。積算したframeは完了になる
+            self.write_pattern_and_cake_data(frame_step=frame_step)
+            quick_look = {'frame_step': frame_step, 'tth_bins': [0, self.xrd.npt_tth], 'azi_bins': [0, self.xrd.npt_azi],
+                          'frame_count': self.run_report['frame_count']}
+            with h5py.File(self.file_path, 'a') as f_append:
+                for name in ('pattern', 'cake'):
+                    self._mark_partial(f_append[os.path.join(self.BASE_PATH, name)],
+                                       f_append[os.path.join(self.PROGRESS_PATH, name)], quick_look)
+            return
+        tth_bins = self._bins_in_range(self.xrd.get_tth(), tth_range)
+        azi_bins = self._bins_in_range(self.xrd.get_azi(), azi_range)
+        partial = True
+        with profiled(self.profile_path), h5py.File(self.file_path, 'a') as f_append:
+            pattern_dataset, pattern_done = self._prepare_dataset(f_append, 'pattern', self._create_pattern_dataset, self._pattern_params(), partial)
+            cake_dataset, cake_done = self._prepare_dataset(f_append, 'cake', self._create_cake_dataset, self._cake_params(), partial)
+            pyramid_writers = self._create_cake_pyramid_writers(f_append)
+            frames = self._strided(self._frames_to_process(pattern_done, cake_done), frame_step)
+            batch = self._batch if self._batch is not None else BatchIntegrator(self.xrd)
+            batch.set_window(tth_bins, azi_bins)
+            write_pattern = azi_bins == (0, self.xrd.npt_azi)
+            tth_slice, azi_slice = slice(*tth_bins), slice(*azi_bins)
+            start = self._start_run()
+            self.xrd.open_frame_source()
+            try:
+                block_frames = batch.block_frames(min(BatchIntegrator.BLOCK_BYTES, self._usable_memory()))
+                for block, frames_data in tqdm(batch.iterate_blocks(frames, block_frames), total=-(-len(frames) // block_frames), desc="Writing Quick Look"):
+                    with self.xrd.timer.stage('integrate_batch', nbytes=frames_data.nbytes):
+                        patterns, cakes = batch.integrate_patterns_and_cakes(frames_data)
+                    with self.timer.stage('write_cake', nbytes=cakes.nbytes):
+                        cake_dataset[block, azi_slice, tth_slice] = cakes
+                    if pyramid_writers:
+                        # 縮小版は範囲の外のbinとも平均するので、書き込んだframe全体を1frameずつ読み直して作る
+                        for frame in block:
+                            self._write_cake_pyramid(pyramid_writers, frame, cake_dataset[frame])
+                    if write_pattern:
+                        with self.timer.stage('write_pattern', nbytes=patterns.nbytes):
+                            pattern_dataset[block, tth_slice] = patterns.astype(np.float32)
+            finally:
+                self.xrd.close_frame_source()
+                batch.set_window() # 通常の積算 (batch_integrate) に戻す
+            self._flush_cake_pyramid(pyramid_writers)
+            quick_look = {'frame_step': frame_step, 'tth_bins': list(tth_bins), 'azi_bins': list(azi_bins), 'frame_count': len(frames)}
+            self._mark_partial(cake_dataset, cake_done, quick_look)
+            self._mark_partial(pattern_dataset, pattern_done, quick_look if write_pattern else None)
+            self._finish_run(f_append, 'write_quick_look', len(frames), start)
+
+    # tmp.hdfの pattern・cake がどこまで積算されているかを {名前: 状態} で返す (ページでの表示用)
+    #   partial: まだ積算されていないframeがある (その部分は0)。quick_look: 直前のクイックルックの条件
+    @classmethod
+    def read_progress(cls, file_path: str) -> dict:
+        progress = {}
+        if not os.path.exists(file_path):
+            return progress
+        with h5py.File(file_path, 'r') as f:
+            for name in ('pattern', 'cake'):
+                to_data, to_done = os.path.join(cls.BASE_PATH, name), os.path.join(cls.PROGRESS_PATH, name)
+                if to_data not in f or to_done not in f:
+                    continue
+                quick_look = f[to_data].attrs.get('quick_look')
+                progress[name] = {
+                    'done_frames': int(np.count_nonzero(f[to_done][:])),
+                    'frame_num': int(f[to_done].shape[0]),
+                    'partial': bool(f[to_data].attrs.get('partial', False)),
+                    'quick_look': json.loads(quick_look) if quick_look is not None else None,
+                }
+        return progress
+
+    # tmp.hdfに保存された書き込み処理の集計を {名前: 集計} で返す (ページでの表示用)
+    @classmethod
+    def read_run_reports(cls, file_path: str) -> dict:
+        reports = {}
+        if not os.path.exists(file_path):
+            return reports
+        with h5py.File(file_path, 'r') as f:
+            if cls.REPORT_PATH not in f:
+                return reports
+            f[cls.REPORT_PATH].visititems(
+                lambda name, obj: reports.__setitem__(name, json.loads(obj[()])) if isinstance(obj, h5py.Dataset) else None
+            )
+        return reports
+
+    # 書き込み処理の前に呼ぶ。それまでの集計(2θ配列の計算など)を捨てて、開始時刻を返す
+    #   FrameBlockWriterにはself.timerを渡しているので、self.timer自体は作り直さずに中身だけ空にする
+    def _start_run(self) -> float:
+        self.timer.pop_stages()
+        self.xrd.timer.pop_stages()
+        self._pool = None
+        return time.perf_counter()
+
+    # 書き込み処理の後に呼ぶ。読み込み・積算の時間(並列ならworkerの分)を足し合わせて、集計を保存・表示する
+    def _finish_run(self, f_append: h5py.File, name: str, frame_count: int, start: float) -> dict:
+        self.timer.merge(self.xrd.timer.pop_stages())
+        if self._pool is not None:
+            self.timer.merge(self._pool.timer.pop_stages())
+        wall_seconds = time.perf_counter() - start
+        report = {
+            'name': name,
+            'frame_count': frame_count,
+            'num_workers': self.num_workers,
+            'wall_seconds': wall_seconds,
+            'frames_per_s': frame_count / wall_seconds if wall_seconds else 0.0,
+            'finished_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'stages': self.timer.report(),
+        }
+        to_report = os.path.join(self.REPORT_PATH, name)
+        if to_report in f_append:
+            del f_append[to_report]
+        f_append.create_dataset(to_report, data=json.dumps(report))
+        self.run_report = report
+        print(f"{name}: {frame_count} frame, {wall_seconds:.1f} s (num_workers={self.num_workers})\n{self.timer.summary()}")
+        return report
+
+    # 途中から再開できる場合は既存のデータセットと完了フラグをそのまま返し、できない場合は両方作り直す
+    #   再開できるのは、resume=True で、前回と同じパラメータ・同じshapeのデータセットがある場合だけ
+    #   partial: 一部のframe・範囲だけを書き込む (クイックルック)。作り直す場合、書き込まない部分が0になるようにする
+    #     (HDF5はfill valueを指定しないと、確保した領域を初期化しない。前に消したデータの中身が見えることがある)
+    #     全frameを書き込む場合は初期化の書き込みが無駄なので指定しない
+    def _prepare_dataset(self, f_append: h5py.File, name: str, create_dataset, params: dict, partial: bool = False):
+        to_data = os.path.join(self.BASE_PATH, name)
+        to_done = os.path.join(self.PROGRESS_PATH, name)
+        params_json = json.dumps(params, sort_keys=True)
+        resumed = (self.resume and to_data in f_append and to_done in f_append
+                   and f_append[to_done].attrs.get('params') == params_json
+                   and f_append[to_data].shape[0] == f_append[to_done].shape[0] == self.xrd.frame_num)
+        if resumed:
+            done_num = int(np.count_nonzero(f_append[to_done][:]))
+            print(f"{to_data}: 前回の続きから再開します ({done_num}/{self.xrd.frame_num} frame 完了済み)")
+            dataset, done_dataset = f_append[to_data], f_append[to_done]
+        else:
+            dataset = create_dataset(f_append, fillvalue=0 if partial else None)
+            if to_done in f_append:
+                del f_append[to_done]
+            done_dataset = f_append.create_dataset(to_done, shape=(self.xrd.frame_num,), dtype=bool) # 全てFalseで作られる
+            done_dataset.attrs['params'] = params_json
+        # 書き込み中は partial にしておく。途中で落ちた場合も、読む側 (read_progress) が未完了だとわかる
+        #   最後まで書き込めたら _mark_partial で付け直す
+        dataset.attrs['partial'] = True
+        dataset.attrs['params'] = params_json
+        # 前のデータから作ったものは、今回書き込むデータと合わなくなるので消しておく
+        #   積分画像: write_cake_index で作り直す
+        #   patternの縮小版: 全frameを書き込んだ後に作り直す (build_pyramid=True の場合だけ)
+        #   cakeの縮小版: 作り直した場合だけ。再開する場合は書き込みながら続きを埋める (_create_cake_pyramid_writers)
+        stale_paths = {
+            'cake': [CakeIntegralIndex.DATA_PATH] + ([] if resumed else [os.path.join(CakePyramid.BASE_PATH, 'cake')]),
+            'pattern': [os.path.join(CakePyramid.BASE_PATH, 'pattern')],
+        }[name]
+        for stale_path in stale_paths:
+            if stale_path in f_append:
+                del f_append[stale_path]
+        f_append.flush()
+        return dataset, done_dataset
+
+    @staticmethod
+    def _frames_to_process(*done_datasets: h5py.Dataset) -> list:
+        """ どれかのデータセットで完了していないframeのリスト """
+        done = np.logical_and.reduce([done_dataset[:] for done_dataset in done_datasets])
+        return np.flatnonzero(~done).tolist()
+
+    @staticmethod
+    def _strided(frames: list, frame_step: int) -> list:
+        """ frame番号が frame_step の倍数のものだけ。何回に分けても同じframeを選ぶように、framesの順番ではなく番号で選ぶ """
+        if frame_step < 1:
+            raise ValueError(f"frame_step は1以上にしてください: {frame_step}")
+        return [frame for frame in frames if frame % frame_step == 0]
+
+    @staticmethod
+    def _bins_in_range(centers: np.ndarray, value_range: tuple) -> tuple:
+        """ 中心が value_range (min, max) に入るbinの (start, stop)。Noneなら全体 """
+        if value_range is None:
+            return 0, len(centers)
+        inside = np.flatnonzero((centers >= min(value_range)) & (centers <= max(value_range)))
+        if len(inside) == 0:
+            raise ValueError(f"範囲 {value_range} にbinがありません ({centers[0]:.3f} ~ {centers[-1]:.3f})")
+        return int(inside[0]), int(inside[-1]) + 1
+
+    # 積算されていないframeが残っているか (partial) をデータセットのattributeに書く。クイックルックならその条件も書く
+    #   全frameが完了したら、クイックルックの記録は消す
+    @staticmethod
+    def _mark_partial(dataset: h5py.Dataset, done_dataset: h5py.Dataset, quick_look: dict = None):
+        partial = not bool(np.all(done_dataset[:]))
+        dataset.attrs['partial'] = partial
+        if partial and quick_look is not None:
+            dataset.attrs['quick_look'] = json.dumps(quick_look)
+        elif not partial and 'quick_look' in dataset.attrs:
+            del dataset.attrs['quick_look']
+
+    # patternデータを決めるパラメータ
+    def _pattern_params(self) -> dict:
+        return self.xrd.describe_params()
+
+    # cakeデータを決めるパラメータ。保存レイアウトが変わった場合も作り直す
+    def _cake_params(self) -> dict:
+        return {
+            **self.xrd.describe_params(),
+            'cake_layout': self.cake_layout,
+            'compression': self.compression,
+            'shuffle': self.shuffle,
+            'build_pyramid': self.build_pyramid,
+        }
+
+    # ライブ処理: 検出器が書き込み中の .nxs を監視し、追加されたframeから順に pattern・cake を積算する
+    #   xrd は swmr=True で作っておく。pattern・cake・arr/frame はframe方向に伸ばしながら書き込む
+    #   batch_frames ずつ書き込むたびにtmp.hdfを閉じるので、その間にページ側から途中結果を読める
+    #   idle_seconds の間frameが増えなければ(測定が終わったとみなして)終了する。stop_event がsetされた場合も終了する
+    def follow_data(self, poll_seconds: float = 1.0, idle_seconds: float = 30.0, batch_frames: int = 16, stop_event=None):
+        self.xrd.open_frame_source()
+        try:
+            last_update = time.monotonic()
+            # 最初のframeは使わないことがあるので (XRD._read_frame_data)、2frame書き込まれるまで待つ
+            while self.xrd.refresh_frame_num() < 2:
+                if time.monotonic() - last_update > idle_seconds or (stop_event is not None and stop_event.is_set()):
+                    print("frameが書き込まれないので終了します。")
+                    return
+                time.sleep(poll_seconds)
+            self.write_params()
+            self.write_arrays()
+            with h5py.File(self.file_path, 'a') as f_append:
+                self._create_growing_datasets(f_append)
+
+            done_num = 0
+            last_update = time.monotonic()
+            while stop_event is None or not stop_event.is_set():
+                frame_num = self.xrd.refresh_frame_num()
+                if frame_num > done_num:
+                    to_frame = min(frame_num, done_num + batch_frames)
+                    self._append_frames(range(done_num, to_frame))
+                    print(f"ライブ処理: {to_frame}/{frame_num} frame")
+                    done_num = to_frame
+                    last_update = time.monotonic()
+                elif time.monotonic() - last_update > idle_seconds:
+                    print(f"{idle_seconds} 秒間frameが増えなかったので終了します。({done_num} frame)")
+                    break
+                else:
+                    time.sleep(poll_seconds)
+        finally:
+            self.xrd.close_frame_source()
+
+    # frame数0から伸ばしていくデータセットを作る。前回の途中経過や、frame数が変わると使えないデータは消しておく
+    def _create_growing_datasets(self, f_append: h5py.File):
+        for data_path in [os.path.join(self.BASE_PATH, 'pattern'), os.path.join(self.BASE_PATH, 'cake'),
+                          self.PROGRESS_PATH, CakePyramid.BASE_PATH, CakeIntegralIndex.DATA_PATH]:
+            if data_path in f_append:
+                del f_append[data_path]
+        npt_azi, npt_tth = self.xrd.npt_azi, self.xrd.npt_tth
+        f_append.create_dataset(
+            os.path.join(self.BASE_PATH, 'pattern'),
+            shape=(0, npt_tth), maxshape=(None, npt_tth), chunks=(1, npt_tth),
+            dtype=np.float32
+        )
+        # 1frameずつ追加するので、chunkはframe方向に1にする
+        f_append.create_dataset(
+            os.path.join(self.BASE_PATH, 'cake'),
+            shape=(0, npt_azi, npt_tth), maxshape=(None, npt_azi, npt_tth),
+            chunks=(1, min(npt_azi, 1024), min(npt_tth, 1024)),
+            dtype=np.float32,
+            compression=self.compression,
+            shuffle=self.shuffle if self.compression is not None else False,
+        )
+
+    # framesを積算して、データセットを伸ばして書き込む。frame数の情報も更新する
+    def _append_frames(self, frames: range):
+        results = [self.xrd.get_pattern_and_caked_data(frame) for frame in frames]
+        with h5py.File(self.file_path, 'a') as f_append:
+            pattern_dataset = f_append[os.path.join(self.BASE_PATH, 'pattern')]
+            cake_dataset = f_append[os.path.join(self.BASE_PATH, 'cake')]
+            pattern_dataset.resize(frames.stop, axis=0)
+            cake_dataset.resize(frames.stop, axis=0)
+            for frame, (pattern, cake) in zip(frames, results):
+                pattern_dataset[frame] = pattern
+                cake_dataset[frame] = cake
+            to_frame_arr = os.path.join(self.BASE_PATH, 'arr', 'frame')
+            to_frame_num = os.path.join(self.BASE_PATH, 'params', 'frame_num')
+            for data_path, data in [(to_frame_arr, np.arange(frames.stop)), (to_frame_num, float(frames.stop))]:
+                if data_path in f_append:
+                    del f_append[data_path]
+                f_append.create_dataset(data_path, data=data)
+
+    # cakeの積分画像(summed-area table)を entry/cake_index に書き込む。cakeを書き込んだ後に呼ぶ
+    #   ピーク範囲をどこに変えても、数か所読むだけで再積算できるようになる (CakeIntegralIndex)
+    # NOTE: float64で (frame, npt_azi+1, npt_tth+1) なので、cakeの2倍強の容量になる
+    def write_cake_index(self, block_bytes: int = 512 * 1024**2):
         to_cake_data = os.path.join(self.BASE_PATH, 'cake')
-
         with h5py.File(self.file_path, 'a') as f_append:
-            if to_cake_data in f_append:
-                del f_append[to_cake_data]
-
-            cake_dataset = f_append.create_dataset(
-                to_cake_data,
-                shape=(self.xrd.frame_num, self.xrd.npt_azi, self.xrd.npt_tth),
-                dtype=np.float32,
+            cake_dataset = f_append[to_cake_data]
+            frame_num, npt_azi, npt_tth = cake_dataset.shape
+            if CakeIntegralIndex.DATA_PATH in f_append:
+                del f_append[CakeIntegralIndex.DATA_PATH]
+            # block_bytesに収まるframe数ずつ計算する。chunkもframe方向にその深さにしてまとめて書き込む
+            frame_bytes = (npt_azi + 1) * (npt_tth + 1) * np.dtype(np.float64).itemsize
+            block_frames = int(max(1, min(64, frame_num, block_bytes // frame_bytes)))
+            index_dataset = f_append.create_dataset(
+                CakeIntegralIndex.DATA_PATH,
+                shape=(frame_num, npt_azi + 1, npt_tth + 1),
+                dtype=np.float64,
+                chunks=(block_frames, min(npt_azi + 1, 32), min(npt_tth + 1, 32)),
+            )
+            for from_frame in tqdm(range(0, frame_num, block_frames), desc="Writing Cake Index"):
+                to_frame = min(from_frame + block_frames, frame_num)
+                cake = cake_dataset[from_frame:to_frame].astype(np.float64)
+                index = np.zeros((to_frame - from_frame, npt_azi + 1, npt_tth + 1), dtype=np.float64)
+                index[:, 1:, 1:] = cake.cumsum(axis=1).cumsum(axis=2)
+                index_dataset[from_frame:to_frame] = index
+            # 最後まで書き込めたら、どのcakeから作ったかを記録する (CakeIntegralIndex.exists はこれが今のcakeと同じときだけTrue)
+            index_dataset.attrs['cake'] = CakeIntegralIndex.describe_cake(cake_dataset)
+
+    # cakeの縮小版の保存領域を作る。build_pyramid=False なら空のdictを返すので、以降の処理は何もしない
+    #   途中から再開する場合は、同じshapeのものが残っていればそのまま使う
+    def _create_cake_pyramid_writers(self, f_append: h5py.File) -> dict:
+        to_cake_pyramid = os.path.join(CakePyramid.BASE_PATH, 'cake')
+        factors = CakePyramid.factors_for((self.xrd.npt_azi, self.xrd.npt_tth)) if self.build_pyramid else []
+        shapes = {
+            factor: (self.xrd.frame_num, -(-self.xrd.npt_azi // factor), -(-self.xrd.npt_tth // factor))
+            for factor in factors
+        }
+        can_reuse = self.resume and factors and all(
+            CakePyramid.data_path('cake', factor) in f_append
+            and f_append[CakePyramid.data_path('cake', factor)].shape == shape
+            for factor, shape in shapes.items()
+        )
+        if not can_reuse and to_cake_pyramid in f_append: # 前回の解像度のものが残らないように、まとめて消す
+            del f_append[to_cake_pyramid]
+        writers = {}
+        for factor, shape in shapes.items():
+            dataset = f_append.require_dataset(CakePyramid.data_path('cake', factor), shape=shape, dtype=np.float32)
+            writers[factor] = FrameBlockWriter(dataset)
+        return writers
+
+    @staticmethod
+    def _write_cake_pyramid(pyramid_writers: dict, frame: int, cake: np.ndarray):
+        for factor, writer in pyramid_writers.items():
+            writer.write(frame, downsample(cake, factor, axes=(0, 1)))
+
+    @staticmethod
+    def _flush_cake_pyramid(pyramid_writers: dict):
+        for writer in pyramid_writers.values():
+            writer.flush()
+
+    # spot_detector があれば、caking中にスポットを検出する。entry/spots は作り直す
+    def _create_spot_collector(self, f_append: h5py.File):
+        if self.spot_detector is None:
+            return None
+        return SpotCollector(self.spot_detector, f_append, self.xrd.get_tth(), self.xrd.get_azi())
+
+    def _collect_spots(self, spot_collector: SpotCollector, frame: int, cake: np.ndarray):
+        if spot_collector is None:
+            return
+        with self.timer.stage('detect_spots'):
+            spot_collector.add(frame, cake)
+
+    # 残りを検出して、frame順に並べる。今回積算しなかった完了済みのframe (再開した場合) は保存済みのcakeから検出する
+    def _finish_spots(self, spot_collector: SpotCollector, cake_dataset: h5py.Dataset, cake_done: h5py.Dataset):
+        if spot_collector is None:
+            return
+        with self.timer.stage('detect_spots'):
+            spot_collector.finish(cake_dataset, cake_done)
+
+    # patternの縮小版を書き込む。frame方向にも縮小するので、全frameを書き込んだ後に呼ぶ
+    #   patternは1次元データなので全frame分をメモリに載せて計算する
+    def _write_pattern_pyramid(self, f_append: h5py.File, pattern_dataset: h5py.Dataset):
+        pattern = pattern_dataset[:]
+        to_pattern_pyramids = os.path.join(CakePyramid.BASE_PATH, 'pattern')
+        if to_pattern_pyramids in f_append:
+            del f_append[to_pattern_pyramids]
+        for factor in CakePyramid.factors_for(pattern.shape):
+            f_append.create_dataset(
+                CakePyramid.data_path('pattern', factor),
+                data=downsample(pattern, factor, axes=(0, 1)).astype(np.float32)
             )
 
-            num_workers = min(8, os.cpu_count()-2)
-            frame_list = list(range(self.xrd.frame_num))
-
-            def _write_cake_slice(cake_dataset, frame, xrd: XRD):
-                """ 1フレームのデータを取得してHDF5に書き込む """
-                cake = xrd.get_caked_data(frame)
-                cake_dataset[frame, :, :] = cake
-
-            for frame in tqdm(frame_list):
-                _write_cake_slice(cake_dataset, frame, self.xrd)
-
-            # with ThreadPoolExecutor(max_workers=num_workers) as executor:
-            #     list(tqdm(
-            #         executor.map(lambda f: _write_cake_slice(cake_dataset, f, self.xrd), frame_list),
-            #         total=len(frame_list),
-            #         desc="Writing Cake Data"
-            #     ))
+    # 既存データがあれば削除して、patternデータの保存領域を作る
+    def _create_pattern_dataset(self, f_append: h5py.File, fillvalue=None) -> h5py.Dataset:
+        to_pattern_data = os.path.join(self.BASE_PATH, 'pattern')
+        if to_pattern_data in f_append:
+            del f_append[to_pattern_data]
+        return f_append.create_dataset(
+            to_pattern_data,
+            shape=(self.xrd.frame_num, self.xrd.npt_tth),
+            dtype=np.float32,
+            fillvalue=fillvalue,
+        )
+
+    # 既存データがあれば削除して、cakeデータの保存領域を作る
+    def _create_cake_dataset(self, f_append: h5py.File, fillvalue=None) -> h5py.Dataset:
+        to_cake_data = os.path.join(self.BASE_PATH, 'cake')
+        if to_cake_data in f_append:
+            del f_append[to_cake_data]
+        return f_append.create_dataset(
+            to_cake_data,
+            shape=(self.xrd.frame_num, self.xrd.npt_azi, self.xrd.npt_tth),
+            dtype=np.float32,
+            chunks=self._cake_chunks(),
+            compression=self.compression,
+            shuffle=self.shuffle if self.compression is not None else False,
+            fillvalue=fillvalue,
+        )
+
+    # cake_layout からchunkの形を決める
+    def _cake_chunks(self):
+        frame_num, npt_azi, npt_tth = self.xrd.frame_num, self.xrd.npt_azi, self.xrd.npt_tth
+        if self.cake_layout == 'frame' or (self.cake_layout == 'contiguous' and self.compression is not None):
+            # 圧縮にはchunkが必要なので、contiguousで圧縮する場合もframe用にする
+            return (1, min(npt_azi, 1024), min(npt_tth, 1024))
+        elif self.cake_layout == 'roi':
+            # 1chunk 64frame x 32 x 32 (float32で256 KB)。ピーク範囲は数十bin程度なので、数chunk読めば全frame分がそろう
+            return (min(frame_num, 64), min(npt_azi, 32), min(npt_tth, 32))
+        return None
+
+    # 書き込んだcakeのサイズ・速度を記録して表示する。レイアウトを実験ごとに選ぶための情報
+    def _report_cake_storage(self, cake_writer: FrameBlockWriter, total_seconds: float):
+        dataset = cake_writer.dataset
+        raw_bytes = dataset.size * dataset.dtype.itemsize
+        storage_bytes = dataset.id.get_storage_size()
+        report = {
+            'layout': self.cake_layout,
+            'compression': str(self.compression),
+            'shuffle': bool(dataset.shuffle),
+            'chunks': str(dataset.chunks),
+            'raw_bytes': int(raw_bytes),
+            'storage_bytes': int(storage_bytes),
+            'compression_ratio': raw_bytes / storage_bytes if storage_bytes else 0.0,
+            'write_seconds': cake_writer.write_seconds,
+            'write_MBps': cake_writer.written_bytes / 1e6 / cake_writer.write_seconds if cake_writer.write_seconds else 0.0,
+            'total_seconds': total_seconds,
+        }
+        for key, value in report.items(): # cakeデータのattributeとして残しておく
+            dataset.attrs[key] = value
+        self.cake_storage_report = report
+        print(
+            f"cake: layout={report['layout']}, compression={report['compression']}, chunks={report['chunks']}\n"
+            f"\t-> {storage_bytes / 1e9:.2f} GB (raw {raw_bytes / 1e9:.2f} GB, x{report['compression_ratio']:.2f}), "
+            f"write {report['write_MBps']:.1f} MB/s, total {total_seconds:.1f} s"
+        )
+        return report
+
+    # 積算結果を (frame, data) の順に返す。num_workers > 1 ならプロセスプールで並列に積算する
+    def _iterate_pattern(self, frames):
+        return self._iterate('pattern', frames)
+
+    def _iterate_cake(self, frames):
+        return self._iterate('cake', frames)
+
+    def _iterate_pattern_and_cake(self, frames):
+        return self._iterate('pattern_and_cake', frames)
+
+    # kind: 'pattern', 'cake', 'pattern_and_cake'
+    def _iterate(self, kind: str, frames):
+        if self.batch_integrate:
+            return self._iterate_batch(kind, frames)
+        if self.num_workers > 1:
+            # 結果を受け取る前にworkerに渡す数をメモリで制限する。書き込みが遅くても結果が溜まり続けない
+            max_in_flight = max(1, self._usable_memory() // self.xrd.estimate_frame_bytes())
+            self._pool = XRDPool(self.xrd, num_workers=self.num_workers, max_in_flight=max_in_flight)
+            return getattr(self._pool, f'imap_{kind}')(frames)
+        if self.num_threads > 1:
+            pipeline = CakePipeline(self.xrd, num_threads=self.num_threads,
+                                    memory_budget=self.memory_budget, reserved_bytes=self._writer_buffer_bytes())
+            return pipeline.run(f'integrate_{kind}', frames)
+        get_data = {
+            'pattern': self.xrd.get_1d_pattern_data,
+            'cake': self.xrd.get_caked_data,
+            'pattern_and_cake': self.xrd.get_pattern_and_caked_data,
+        }[kind]
+        return self._iterate_serial(lambda frame: (frame, *self._as_tuple(get_data(frame))), frames)
+
+    @staticmethod
+    def _as_tuple(result) -> tuple:
+        return result if isinstance(result, tuple) else (result,)
+
+    # 書き込み側 (FrameBlockWriter) がchunk1つ分溜めておくメモリ。cake・縮小版・patternの合計
+    def _writer_buffer_bytes(self) -> int:
+        chunks = self._cake_chunks()
+        block_frames = chunks[0] if chunks is not None else 1
+        cake_frame_bytes = self.xrd.npt_azi * self.xrd.npt_tth * np.dtype(np.float32).itemsize
+        pyramid_ratio = 1 / 3 if self.build_pyramid else 0 # 2x, 4x, ... の合計は元の1/3
+        return int(block_frames * cake_frame_bytes * (1 + pyramid_ratio) + self.xrd.frame_num * self.xrd.npt_tth * 4)
+
+    # memory_budget のうち、積算中のframeに使える分
+    def _usable_memory(self) -> int:
+        return max(0, self.memory_budget - self._writer_buffer_bytes())
+
+    # BatchIntegrator でブロックごとに積算して、1frameずつ返す。num_workers > 1 ならブロックをworkerに分ける
+    #   workerに渡すブロックはworker数までにして、1ブロックのメモリは 使えるメモリ / worker数 (最大 BatchIntegrator.BLOCK_BYTES)
+    def _iterate_batch(self, kind: str, frames):
+        block_bytes = min(BatchIntegrator.BLOCK_BYTES, self._usable_memory() // max(1, self.num_workers))
+        block_frames = self._batch.block_frames(block_bytes)
+        if self.num_workers > 1:
+            self._pool = XRDPool(self.xrd, num_workers=self.num_workers, max_in_flight=self.num_workers)
+            yield from self._pool.imap_blocks(kind, frames, block_frames)
+            return
+        integrate = {
+            'pattern': self._batch.integrate_patterns,
+            'cake': self._batch.integrate_cakes,
+            'pattern_and_cake': self._batch.integrate_patterns_and_cakes,
+        }[kind]
+        self.xrd.open_frame_source()
+        try:
+            for block, frames_data in self._batch.iterate_blocks(frames, block_frames):
+                with self.xrd.timer.stage('integrate_batch', nbytes=frames_data.nbytes):
+                    result = integrate(frames_data)
+                arrays = result if isinstance(result, tuple) else (result,)
+                for i, frame in enumerate(block):
+                    yield (frame, *(array[i] for array in arrays))
+        finally:
+            self.xrd.close_frame_source()
+
+    # 1プロセスで順番に積算する。処理中は生データのファイルを開いたままにしておく
+    def _iterate_serial(self, integrate, frames):
+        self.xrd.open_frame_source()
+        try:
+            for frame in frames:
+                yield integrate(frame)
+        finally:
+            self.xrd.close_frame_source()
 
 class PeakWriter(HDF5Writer):
     BASE_PATH = 'entry/'
+    # 1回に読み込むROIブロックの大きさの目安
+    ROI_BLOCK_BYTES = 256 * 1024**2
+    # 近いピークを1つのROIにまとめるのは、囲むROIが各ピークの範囲の合計のこの倍数以下の場合 (_group_rois)
+    ROI_GROUP_OVERHEAD = 1.5
+
+    def __init__(self, filepath: str):
+        super().__init__(filepath)
+        self.timer = StageTimer() # 直前の再積算の、段階ごとの時間 (ROIの読み込み・計算・書き込み)
+        self.run_report = None
 
     # 設定されたピーク範囲から再積算を行う
-    def write_re_integrate_peak_data(self, peak: Peak, peak_num: int, frame_num: int):
-        # hdf内のデータパスの設定
-        to_peak_path = os.path.join(self.BASE_PATH, 'peak', f'{peak_num}')
-        to_peak_tth_pattern_data = os.path.join(to_peak_path, 'tth')
-        to_peak_azi_pattern_data = os.path.join(to_peak_path, 'azi')
+    #   cakeのうちピーク範囲(ROI)だけを、複数frameまとめて読み込む。計算量はcake全体ではなくROIの大きさで決まる
+    #   entry/cake_index があれば (use_index=True)、cakeは読まずに積分画像から計算する
+    def write_re_integrate_peak_data(self, peak: Peak, peak_num: int, frame_num: int, use_index: bool = True):
+        return self.write_re_integrate_peaks({peak_num: peak}, frame_num, use_index=use_index, report_name=f'{peak_num}')
+
+    # 複数のピークを1回のパスで再積算する ({peak_num: Peak}。Peak.load_all で peaks.json の全ピークを読める)
+    #   近いピークをまとめたグループ (_group_rois) ごとに、それを囲むROIをframeのブロックごとに1回だけ読み、各ピークの範囲を切り出す
+    #   ピークごとに呼ぶと、重なったピークの分だけcakeを読み直すことになる。全ピークを1つのROIで囲むと、離れたピークの間も読むことになる
+    def write_re_integrate_peaks(self, peaks: dict, frame_num: int, use_index: bool = True, report_name: str = 'all'):
+        self.timer.pop_stages()
+        start = time.perf_counter()
+        for peak_num, peak in peaks.items():
+            if peak.to_azi_idx <= peak.from_azi_idx or peak.to_tth_idx <= peak.from_tth_idx:
+                raise ValueError(f"Peak {peak_num} の範囲が空です: azi {peak.from_azi_idx}-{peak.to_azi_idx}, tth {peak.from_tth_idx}-{peak.to_tth_idx}")
+        to_cake_data = os.path.join(self.BASE_PATH, 'cake')
 
-        # Peakから範囲の個数を計算しておく
-        npt_azi_diff = peak.to_azi_idx - peak.from_azi_idx
-        npt_tth_diff = peak.to_tth_idx - peak.from_tth_idx
+        # 積分画像があれば、範囲の四隅を読むだけで済む
+        if use_index and CakeIntegralIndex.exists(self.file_path):
+            cake_index = CakeIntegralIndex(self.file_path)
+            for peak_num, peak in peaks.items():
+                with self.timer.stage('compute_index'):
+                    tth_pattern, azi_pattern = cake_index.roi_profiles(
+                        peak.from_azi_idx, peak.to_azi_idx,
+                        peak.from_tth_idx, peak.to_tth_idx,
+                        to_frame=frame_num
+                    )
+                with self.timer.stage('write_peak', nbytes=tth_pattern.nbytes + azi_pattern.nbytes):
+                    self.write(data_path=self._peak_data_path(peak_num, 'tth'), data=tth_pattern, overwrite=True)
+                    self.write(data_path=self._peak_data_path(peak_num, 'azi'), data=azi_pattern, overwrite=True)
+            self._write_run_report(report_name, list(peaks), frame_num, use_index=True, start=start)
+            return
 
         # 書き込み
         with h5py.File(self.file_path, 'a') as f_append:
-            # 既存データを削除する
-            if to_peak_azi_pattern_data in f_append:
-                del f_append[to_peak_azi_pattern_data]
-            if to_peak_tth_pattern_data in f_append:
-                del f_append[to_peak_tth_pattern_data]
-
-            # データ書き込み先の作成
-            tth_pattern_dataset = f_append.create_dataset(
-                to_peak_tth_pattern_data,
-                shape=(frame_num, npt_tth_diff),
-                dtype=np.float32,
-            )
-            azi_pattern_dataset = f_append.create_dataset(
-                to_peak_azi_pattern_data,
-                shape=(frame_num, npt_azi_diff),
-                dtype=np.float32,
-            )
-
-            # 並列スレッド処理の準備
-            num_workers = min(8, os.cpu_count()-2)
-            frame_list = list(range(frame_num))
-
-            # cakeデータ取得の fetcherを作成する
-            cake_fetcher = HDF5Reader(self.file_path).create_fetcher(query='cake')
-
-            def process_frame(frame):
-                # フレームごとにデータ取得
-                cake = cake_fetcher.fetch_by_frame(frame)
-                selected_cake = cake[
-                                peak.from_azi_idx:peak.to_azi_idx,
-                                peak.from_tth_idx:peak.to_tth_idx
-                                ]
-                tth_pattern = selected_cake.mean(axis=0)
-                azi_pattern = selected_cake.mean(axis=1)
-
-                # HDF5 に直接書き込む（ファイルは開いたまま）
-                tth_pattern_dataset[frame] = tth_pattern
-                azi_pattern_dataset[frame] = azi_pattern
-
-            # ThreadPoolExecutor でマルチスレッド処理
-            with ThreadPoolExecutor(max_workers=num_workers) as executor:
-                list(tqdm(
-                    executor.map(process_frame, frame_list),
-                    total=len(frame_list),
-                    desc="Writing Peak Data"
-                ))
-
-            # 並列処理しないバージョン
-            # for frame in tqdm(frame_list, desc="Writing Peak Data"):
-            #     # cake dataを取得して選択された範囲を渡す
-            #     cake = cake_fetcher.fetch_by_frame(frame)
-            #     selected_cake = cake[
-            #                     peak.from_azi_idx:peak.to_azi_idx,
-            #                     peak.from_tth_idx:peak.to_tth_idx
-            #                     ]
-            #
-            #     # azi方向に積算して 1d tthパターンを作成して保存 (回折角度の変化を見る用)
-            #     tth_pattern = selected_cake.mean(axis=0)
-            #     # tth方向に積算して、1d aziパターンを作成して保存 (粒の変化を見る用)
-            #     azi_pattern = selected_cake.mean(axis=1)
-            #     # 書き込み
-            #     tth_pattern_dataset[frame] = tth_pattern
-            #     azi_pattern_dataset[frame] = azi_pattern
-
-
-
-
-
-
-
-
-
+            # データ書き込み先の作成。既存データは削除する
+            datasets = {}
+            for peak_num, peak in peaks.items():
+                datasets[peak_num] = []
+                for axis, npt_diff in [('tth', peak.to_tth_idx - peak.from_tth_idx), ('azi', peak.to_azi_idx - peak.from_azi_idx)]:
+                    to_peak_pattern_data = self._peak_data_path(peak_num, axis)
+                    if to_peak_pattern_data in f_append:
+                        del f_append[to_peak_pattern_data]
+                    datasets[peak_num].append(f_append.create_dataset(to_peak_pattern_data, shape=(frame_num, npt_diff), dtype=np.float32))
+
+            roi_groups = self._group_rois(peaks)
+            cake_dataset = f_append[to_cake_data]
+            # ブロックのframe数は、全グループのROIを合わせた大きさで決める
+            block_frames = self._roi_block_frames(cake_dataset, sum(self._roi_size(roi) for roi, _ in roi_groups))
+            for from_frame in tqdm(range(0, frame_num, block_frames), desc="Writing Peak Data"):
+                to_frame = min(from_frame + block_frames, frame_num)
+                for (from_azi_idx, to_azi_idx, from_tth_idx, to_tth_idx), peak_nums in roi_groups:
+                    # (frames, azi, tth) のROIだけを1回で読み込む
+                    with self.timer.stage('read_roi') as record:
+                        roi_cake = cake_dataset[from_frame:to_frame, from_azi_idx:to_azi_idx, from_tth_idx:to_tth_idx]
+                        record.nbytes = roi_cake.nbytes
+                    for peak_num in peak_nums:
+                        peak = peaks[peak_num]
+                        with self.timer.stage('compute'):
+                            selected_cake = roi_cake[
+                                            :,
+                                            peak.from_azi_idx - from_azi_idx:peak.to_azi_idx - from_azi_idx,
+                                            peak.from_tth_idx - from_tth_idx:peak.to_tth_idx - from_tth_idx
+                                            ]
+                            # azi方向に積算して 1d tthパターンを作成 (回折角度の変化を見る用)
+                            tth_pattern = selected_cake.mean(axis=1)
+                            # tth方向に積算して、1d aziパターンを作成 (粒の変化を見る用)
+                            azi_pattern = selected_cake.mean(axis=2)
+                        tth_pattern_dataset, azi_pattern_dataset = datasets[peak_num]
+                        with self.timer.stage('write_peak', nbytes=tth_pattern.nbytes + azi_pattern.nbytes):
+                            tth_pattern_dataset[from_frame:to_frame] = tth_pattern
+                            azi_pattern_dataset[from_frame:to_frame] = azi_pattern
+        self._write_run_report(report_name, list(peaks), frame_num, use_index=False, start=start)
+
+    # entry/peak/<peak_num>/<tth, azi>
+    # 再積算した2θパターン (entry/peak/<peak_num>/tth) の全frameにピークの関数をフィッティングし、
+    # パラメータと誤差の時系列を entry/peak/<peak_num>/fit/<パラメータ名> に保存する
+    #   tth_axis: 再積算した範囲の2θ (tth_arr[peak.from_tth_idx:peak.to_tth_idx])
+    def write_peak_fit(self, peak_num, tth_axis, model: str = 'pseudo_voigt') -> dict:
+        self.timer.pop_stages()
+        start = time.perf_counter()
+        with self.timer.stage('read_peak') as record:
+            with h5py.File(self.file_path, 'r') as f:
+                tth_pattern = f[self._peak_data_path(peak_num, 'tth')][:]
+            record.nbytes = tth_pattern.nbytes
+        if tth_pattern.shape[1] != len(tth_axis):
+            raise ValueError(f"Peak {peak_num} の再積算の範囲 ({tth_pattern.shape[1]} bin) と2θの配列 ({len(tth_axis)}) が合いません。再積算し直してください。")
+        with self.timer.stage('fit'):
+            result = PeakFitter(model).fit(tth_axis, tth_pattern)
+        to_fit = self._peak_data_path(peak_num, 'fit')
+        with self.timer.stage('write_fit'), h5py.File(self.file_path, 'a') as f_append:
+            if to_fit in f_append:
+                del f_append[to_fit]
+            group = f_append.create_group(to_fit)
+            for name, values in result.items():
+                group.create_dataset(name, data=values)
+            group.attrs['model'] = model
+            group.attrs['tth_range'] = [float(tth_axis[0]), float(tth_axis[-1])]
+        print(f"Peak {peak_num} のフィッティング: {time.perf_counter() - start:.2f} s")
+        return result
+
+    # 保存したフィッティング結果を {パラメータ名: (frame,)} で返す。なければ空のdict
+    @classmethod
+    def read_peak_fit(cls, file_path: str, peak_num) -> dict:
+        to_fit = os.path.join(cls.BASE_PATH, 'peak', f'{peak_num}', 'fit')
+        with h5py.File(file_path, 'r') as f:
+            if to_fit not in f:
+                return {}
+            return {name: dataset[:] for name, dataset in f[to_fit].items()}
+
+    def _peak_data_path(self, peak_num, axis: str) -> str:
+        return os.path.join(self.BASE_PATH, 'peak', f'{peak_num}', axis)
+
+    # 再積算の時間の集計を entry/report/peak/<name> に保存する (1ピークなら name はpeak_num)
+    def _write_run_report(self, name: str, peak_nums: list, frame_num: int, use_index: bool, start: float) -> dict:
+        wall_seconds = time.perf_counter() - start
+        report = {
+            'name': 'write_re_integrate_peak_data',
+            'peak_nums': [f'{peak_num}' for peak_num in peak_nums],
+            'frame_count': frame_num,
+            'use_index': use_index,
+            'wall_seconds': wall_seconds,
+            'finished_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'stages': self.timer.report(),
+        }
+        self.write(data_path=os.path.join(XRDWriter.REPORT_PATH, 'peak', name), data=json.dumps(report), overwrite=True)
+        self.run_report = report
+        return report
+
+    # ピークの範囲を、1回で読むROIのグループに分ける。[((from_azi, to_azi, from_tth, to_tth), [peak_num, ...]), ...]
+    #   2θ順に見ていき、今のグループに加えても囲むROIが各ピークの範囲の合計の ROI_GROUP_OVERHEAD 倍以下ならまとめる
+    #   重なったピーク・隣り合ったピークは1回で読み、離れたピークは別々に読む
+    @classmethod
+    def _group_rois(cls, peaks: dict) -> list:
+        groups = []
+        for peak_num in sorted(peaks, key=lambda peak_num: (peaks[peak_num].from_tth_idx, peaks[peak_num].from_azi_idx)):
+            peak = peaks[peak_num]
+            roi = (peak.from_azi_idx, peak.to_azi_idx, peak.from_tth_idx, peak.to_tth_idx)
+            if groups:
+                group_roi, peak_nums, peaks_size = groups[-1]
+                merged_roi = (min(group_roi[0], roi[0]), max(group_roi[1], roi[1]), min(group_roi[2], roi[2]), max(group_roi[3], roi[3]))
+                if cls._roi_size(merged_roi) <= cls.ROI_GROUP_OVERHEAD * (peaks_size + cls._roi_size(roi)):
+                    groups[-1] = (merged_roi, peak_nums + [peak_num], peaks_size + cls._roi_size(roi))
+                    continue
+            groups.append((roi, [peak_num], cls._roi_size(roi)))
+        return [(roi, peak_nums) for roi, peak_nums, _ in groups]
+
+    @staticmethod
+    def _roi_size(roi: tuple) -> int:
+        from_azi_idx, to_azi_idx, from_tth_idx, to_tth_idx = roi
+        return (to_azi_idx - from_azi_idx) * (to_tth_idx - from_tth_idx)
+
+    # ROIブロックのframe数を決める。chunkがある場合は、chunkのframe方向の大きさの倍数にして同じchunkを何度も読まない
+    def _roi_block_frames(self, cake_dataset: h5py.Dataset, roi_size: int) -> int:
+        block_frames = max(1, self.ROI_BLOCK_BYTES // max(1, roi_size * cake_dataset.dtype.itemsize))
+        if cake_dataset.chunks is not None:
+            chunk_frames = cake_dataset.chunks[0]
+            block_frames = max(chunk_frames, block_frames // chunk_frames * chunk_frames)
+        return min(block_frames, cake_dataset.shape[0])
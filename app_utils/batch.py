@@ -0,0 +1,227 @@
+"""
+フォルダ・globで指定した複数の .nxs (.hdf) を、ブラウザを使わずにまとめて処理する (一晩かけての再処理など)
+
+ファイルごとに出力 (<output_dir>/<ファイル名>.hdf、中身はtmp.hdfと同じ) を作り、
+ファイル単位でプロセスプールに割り振る。1つのファイルが失敗しても、残りのファイルは続けて処理する。
+Streamlitは読み込まない (ページ用のモジュール cache_handler, setting_handler を使わない)。
+
+stages:
+    cake, pattern: 積算 (両方なら1回の読み込みで両方書く)
+    spots: cakeを書きながら (cakeを積算しない場合は保存済みのcakeから) スポットを検出する
+    tracks: 検出したスポットをframe間でつなぐ
+    peaks: peaks.json の全ピークを再積算する
+    fit: 再積算したピークをフィッティングする
+
+最後に、ファイルごとの結果 (かかった時間・frame数・失敗した場合はエラー) と全体の処理速度を
+<output_dir>/batch_summary_<日時>.json に保存する。
+
+    python -m app_utils.batch "/data/FeO/*.nxs" calib.poni --output_dir out --npt_tth 1000 --npt_azi 1000 --workers 4
+    python -m app_utils.batch /data/FeO calib.poni --output_dir out --stages cake pattern peaks fit --peaks_json peaks.json
+"""
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+from app_utils.Writer import PeakWriter, XRDWriter
+from app_utils.peak_handler import Peak
+from app_utils.spot_tracker import SpotTracker
+from app_utils.spots import SpotDetector
+from modules.XRD import XRD
+
+STAGES = ('cake', 'pattern', 'spots', 'tracks', 'peaks', 'fit')
+INPUT_EXTENSIONS = ('.nxs', '.hdf')
+
+
+def find_inputs(inputs: list) -> list:
+    """ フォルダ (直下の .nxs, .hdf)・globのパターン・ファイルを、重複なしで名前順のリストにする """
+    paths = []
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            paths += [os.path.join(pattern, name) for name in os.listdir(pattern)]
+        else:
+            paths += glob.glob(pattern)
+    return sorted({os.path.abspath(path) for path in paths if path.endswith(INPUT_EXTENSIONS) and os.path.isfile(path)})
+
+
+def output_path_for(xrd_path: str, output_dir: str) -> str:
+    return os.path.join(output_dir, os.path.splitext(os.path.basename(xrd_path))[0] + '.hdf')
+
+
+""" 1ファイル (プロセスプールのworkerで実行される) """
+def process_file(job: dict) -> dict:
+    """ job: run() が作る1ファイル分の設定。成功・失敗にかかわらず、結果の記録を返す """
+    start = time.perf_counter()
+    record = {
+        'xrd_path': job['xrd_path'],
+        'output_path': job['output_path'],
+        'input_bytes': os.path.getsize(job['xrd_path']),
+        'stages': {},
+    }
+    try:
+        xrd = XRD(
+            xrd_path=job['xrd_path'], poni_path=job['poni_path'], mask_path=job['mask_path'],
+            npt_tth=job['npt_tth'], npt_azi=job['npt_azi'],
+        )
+        record['frame_num'] = xrd.frame_num
+        stages = job['stages']
+        spot_detector = SpotDetector(threshold=job['spot_threshold']) if 'spots' in stages else None
+
+        def run_stage(name, function):
+            stage_start = time.perf_counter()
+            function()
+            record['stages'][name] = time.perf_counter() - stage_start
+
+        integrate_stages = [stage for stage in ('pattern', 'cake') if stage in stages]
+        if integrate_stages:
+            writer = XRDWriter(
+                job['output_path'], xrd,
+                num_threads=job['threads'], memory_budget=job['memory_budget'],
+                cake_layout=job['cake_layout'], compression=job['compression'], resume=not job['overwrite'],
+                spot_detector=spot_detector if 'cake' in stages else None,
+            )
+            writer.write_params()
+            writer.write_arrays()
+            if len(integrate_stages) == 2:
+                run_stage('pattern_and_cake', writer.write_pattern_and_cake_data)
+            elif 'cake' in stages:
+                run_stage('cake', writer.write_cake_data)
+            else:
+                run_stage('pattern', writer.write_pattern_data)
+        if 'spots' in stages and 'cake' not in stages:
+            run_stage('spots', lambda: spot_detector.write_spots(job['output_path']))
+        if 'tracks' in stages:
+            run_stage('tracks', lambda: SpotTracker().write_tracks(job['output_path']))
+
+        if 'peaks' in stages or 'fit' in stages:
+            tth_arr, azi_arr = xrd.get_tth(), xrd.get_azi()
+            peaks = Peak.load_all(tth_arr, azi_arr, path_to_json=job['peaks_json'])
+            if not peaks:
+                raise ValueError(f"ピークが設定されていません: {job['peaks_json']}")
+            peak_writer = PeakWriter(filepath=job['output_path'])
+            if 'peaks' in stages:
+                run_stage('peaks', lambda: peak_writer.write_re_integrate_peaks(peaks=peaks, frame_num=xrd.frame_num))
+            if 'fit' in stages:
+                def fit_all():
+                    for peak_num, peak in peaks.items():
+                        peak_writer.write_peak_fit(peak_num, tth_arr[peak.from_tth_idx:peak.to_tth_idx], model=job['fit_model'])
+                run_stage('fit', fit_all)
+        record['status'] = 'ok'
+    except Exception as e:
+        record['status'] = 'failed'
+        record['error'] = f"{type(e).__name__}: {str(e)}"
+        record['traceback'] = traceback.format_exc()
+    record['seconds'] = time.perf_counter() - start
+    return record
+
+
+""" 全ファイル """
+def run(xrd_paths: list, poni_path: str, output_dir: str, stages: list, mask_path: str = None,
+        npt_tth: int = 1_000, npt_azi: int = 1_000, workers: int = 1, threads: int = 1, memory_budget: int = None,
+        cake_layout: str = 'contiguous', compression: str = None, overwrite: bool = False,
+        peaks_json: str = Peak.path_to_json, fit_model: str = 'pseudo_voigt', spot_threshold: float = 5.0) -> dict:
+    """
+    ファイルを workers 個のプロセスで処理し、全体のまとめ (batch_summary_*.json にも保存する) を返す
+    memory_budget: 全体で使ってよいメモリ (byte)。各ファイルの処理には workers で割った分を渡す
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    memory_budget = memory_budget if memory_budget is not None else XRDWriter.DEFAULT_MEMORY_BUDGET
+    jobs = [{
+        'xrd_path': xrd_path, 'output_path': output_path_for(xrd_path, output_dir),
+        'poni_path': poni_path, 'mask_path': mask_path, 'npt_tth': npt_tth, 'npt_azi': npt_azi,
+        'stages': list(stages), 'threads': threads, 'memory_budget': memory_budget // max(1, workers),
+        'cake_layout': cake_layout, 'compression': compression, 'overwrite': overwrite,
+        'peaks_json': peaks_json, 'fit_model': fit_model, 'spot_threshold': spot_threshold,
+    } for xrd_path in xrd_paths]
+    if len({job['output_path'] for job in jobs}) != len(jobs):
+        raise ValueError('出力ファイル名が重複します。同じ名前のファイルは別々に処理してください。')
+
+    print(f"{len(jobs)} 個のファイルを {workers} プロセスで処理します: {', '.join(stages)}")
+    start = time.perf_counter()
+    records = []
+    if workers <= 1:
+        for job in jobs:
+            records.append(_report(process_file(job), len(records) + 1, len(jobs)))
+    else:
+        # h5pyのファイルハンドルをforkで引き継がないように spawn で起動する (XRDPoolと同じ)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = [executor.submit(process_file, job) for job in jobs]
+            for future in as_completed(futures):
+                records.append(_report(future.result(), len(records) + 1, len(jobs)))
+    wall_seconds = time.perf_counter() - start
+
+    records.sort(key=lambda record: record['xrd_path'])
+    succeeded = [record for record in records if record['status'] == 'ok']
+    frames = sum(record.get('frame_num', 0) for record in succeeded)
+    input_bytes = sum(record['input_bytes'] for record in succeeded)
+    summary = {
+        'finished_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'stages': list(stages),
+        'settings': {key: jobs[0][key] for key in ('poni_path', 'mask_path', 'npt_tth', 'npt_azi', 'threads', 'cake_layout', 'compression')} if jobs else {},
+        'workers': workers,
+        'file_count': len(records),
+        'succeeded': len(succeeded),
+        'failed': len(records) - len(succeeded),
+        'wall_seconds': wall_seconds,
+        'frames': frames,
+        'frames_per_s': frames / wall_seconds if wall_seconds else 0.0,
+        'MB_per_s': input_bytes / 1e6 / wall_seconds if wall_seconds else 0.0,
+        'files': records,
+    }
+    summary_path = os.path.join(output_dir, f"batch_summary_{datetime.now():%Y%m%d_%H%M%S}.json")
+    with open(summary_path, 'w') as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+
+    print(
+        f"完了: {summary['succeeded']}/{summary['file_count']} ファイル成功, {wall_seconds:.1f} s, "
+        f"{summary['frames_per_s']:.1f} frames/s, {summary['MB_per_s']:.1f} MB/s"
+    )
+    for record in records:
+        if record['status'] != 'ok':
+            print(f"  失敗: {record['xrd_path']}\n    {record['error']}")
+    print(f"まとめを保存しました: {summary_path}")
+    return summary
+
+
+def _report(record: dict, done: int, total: int) -> dict:
+    result = f"{record['seconds']:.1f} s" if record['status'] == 'ok' else f"失敗 ({record['error']})"
+    print(f"[{done}/{total}] {os.path.basename(record['xrd_path'])}: {result}")
+    return record
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='複数の .nxs (.hdf) をまとめて積算・解析する')
+    parser.add_argument('inputs', nargs='+', help='フォルダ、globのパターン (引用符で囲む)、またはファイル')
+    parser.add_argument('poni_path')
+    parser.add_argument('--output_dir', required=True, help='ファイルごとの出力 (<ファイル名>.hdf) とまとめの保存先')
+    parser.add_argument('--mask_path', default=None)
+    parser.add_argument('--npt_tth', type=int, default=1_000)
+    parser.add_argument('--npt_azi', type=int, default=1_000)
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=['cake', 'pattern'])
+    parser.add_argument('--workers', type=int, default=1, help='同時に処理するファイル数 (プロセス数)')
+    parser.add_argument('--threads', type=int, default=1, help='1ファイルあたりの積算スレッド数')
+    parser.add_argument('--memory_gb', type=float, default=XRDWriter.DEFAULT_MEMORY_BUDGET / 1024**3, help='全体で使ってよいメモリ (GB)')
+    parser.add_argument('--cake_layout', choices=XRDWriter.CAKE_LAYOUTS, default='contiguous')
+    parser.add_argument('--compression', choices=[c for c in XRDWriter.COMPRESSIONS if c is not None], default=None)
+    parser.add_argument('--overwrite', action='store_true', help='途中まで書き込まれた出力があっても、最初からやり直す')
+    parser.add_argument('--peaks_json', default=Peak.path_to_json)
+    parser.add_argument('--fit_model', choices=['pseudo_voigt', 'gaussian'], default='pseudo_voigt')
+    parser.add_argument('--spot_threshold', type=float, default=5.0)
+    args = parser.parse_args()
+
+    xrd_paths = find_inputs(args.inputs)
+    if not xrd_paths:
+        parser.error(f"入力ファイルが見つかりません: {args.inputs}")
+    summary = run(
+        xrd_paths, args.poni_path, args.output_dir, args.stages,
+        mask_path=args.mask_path, npt_tth=args.npt_tth, npt_azi=args.npt_azi,
+        workers=args.workers, threads=args.threads, memory_budget=int(args.memory_gb * 1024**3),
+        cake_layout=args.cake_layout, compression=args.compression, overwrite=args.overwrite,
+        peaks_json=args.peaks_json, fit_model=args.fit_model, spot_threshold=args.spot_threshold,
+    )
+    raise SystemExit(1 if summary['failed'] else 0)
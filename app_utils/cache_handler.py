@@ -0,0 +1,87 @@
+"""
+Streamlitの再実行(ウィジェット操作のたびにページが上から実行し直される)をまたいで、重いオブジェクト・データを使い回す
+
+キャッシュのキーにはファイルのpathと更新時刻・サイズを含めるので、
+tmp.hdfが書き直されたり、.poniが変わったりすると自動的に読み込み直される。
+"""
+import os
+
+import streamlit as st
+
+from app_utils.pyramid import CakePyramid
+from modules.HDF5 import HDF5Reader
+from modules.XRD import XRD
+
+
+def file_stamp(path: str):
+    """ ファイルの更新時刻とサイズ。無ければNone。キャッシュのキーに使う """
+    if path is None or not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+""" XRD (pyFAI.load, OpenCLの確認, .nxsのメタデータ読み込み) """
+def get_xrd(xrd_path, poni_path, npt_tth, npt_azi, mask_path=None) -> XRD:
+    return _load_xrd(
+        xrd_path, poni_path, npt_tth, npt_azi, mask_path,
+        file_stamp(xrd_path), file_stamp(poni_path), file_stamp(mask_path)
+    )
+
+@st.cache_resource(max_entries=4, show_spinner='XRDデータを読み込んでいます...')
+def _load_xrd(xrd_path, poni_path, npt_tth, npt_azi, mask_path, xrd_stamp, poni_stamp, mask_stamp) -> XRD:
+    try:
+        return XRD(
+            xrd_path=xrd_path, poni_path=poni_path, mask_path=mask_path,
+            npt_tth=npt_tth, npt_azi=npt_azi
+        )
+    except OSError:
+        # 検出器が書き込み中(SWMR)のファイルは通常の読み込みでは開けないので、SWMR読み込みで開き直す
+        return XRD(
+            xrd_path=xrd_path, poni_path=poni_path, mask_path=mask_path,
+            npt_tth=npt_tth, npt_azi=npt_azi, swmr=True
+        )
+
+
+""" tmp.hdf の HDF5Reader (ファイル内の全pathの探索) """
+def get_tmp_reader(tmp_hdf_path) -> HDF5Reader:
+    return _load_tmp_reader(tmp_hdf_path, file_stamp(tmp_hdf_path))
+
+@st.cache_resource(max_entries=4)
+def _load_tmp_reader(tmp_hdf_path, tmp_hdf_stamp) -> HDF5Reader:
+    return HDF5Reader(tmp_hdf_path)
+
+
+""" tmp.hdf の frame, 2θ, 方位角の配列 """
+def get_arrays(tmp_hdf_path):
+    """
+    Returns:
+        : (frame配列, 2θ配列, 方位角配列)
+    """
+    return _load_arrays(tmp_hdf_path, file_stamp(tmp_hdf_path))
+
+@st.cache_data(max_entries=4)
+def _load_arrays(tmp_hdf_path, tmp_hdf_stamp):
+    cake_hdf = _load_tmp_reader(tmp_hdf_path, tmp_hdf_stamp)
+    return (
+        cake_hdf.find_by(query='arr/frame'),
+        cake_hdf.find_by(query='arr/tth'),
+        cake_hdf.find_by(query='arr/azi'),
+    )
+
+
+""" tmp.hdf の patternデータ """
+def get_pattern(tmp_hdf_path, display_shape=None):
+    """
+    display_shape を渡すと、それに合った縮小版を返す (CakePyramid.fetch_pattern)。Noneなら元の解像度
+
+    Returns:
+        : (patternデータ, 倍率)
+    """
+    return _load_pattern(tmp_hdf_path, display_shape, file_stamp(tmp_hdf_path))
+
+@st.cache_data(max_entries=8)
+def _load_pattern(tmp_hdf_path, display_shape, tmp_hdf_stamp):
+    if display_shape is None:
+        return _load_tmp_reader(tmp_hdf_path, tmp_hdf_stamp).find_by(query='pattern'), 1
+    return CakePyramid(tmp_hdf_path).fetch_pattern(display_shape=display_shape)
@@ -0,0 +1,67 @@
+"""
+cakeデータの積分画像(summed-area table)から、任意のピーク範囲の積算パターンを計算するクラス
+
+entry/cake_index[frame, a, t] には cake[frame, :a, :t] の和が入っている (XRDWriter.write_cake_index で作る)。
+範囲内の和は四隅の値の足し引きで求まるので、cake全体を読み直さずに再積算できる。
+インデックスには作ったときのcake (shape・積算パラメータ) を記録しておき、cakeを積算し直した後の古いものは使わない。
+"""
+import json
+
+import h5py
+import numpy as np
+
+
+class CakeIntegralIndex:
+    DATA_PATH = 'entry/cake_index'
+    CAKE_PATH = 'entry/cake'
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+
+    @classmethod
+    def exists(cls, file_path: str) -> bool:
+        """ tmp.hdfに、今のcakeから作ったインデックスがあるか """
+        with h5py.File(file_path, 'r') as f:
+            return cls._is_current(f)
+
+    @staticmethod
+    def describe_cake(cake_dataset: h5py.Dataset) -> str:
+        """ インデックスを作ったcakeを表す文字列。shapeと、XRDWriterが書き込んだ積算パラメータ (attrsの params) """
+        return json.dumps({'shape': list(cake_dataset.shape), 'params': cake_dataset.attrs.get('params', '')})
+
+    @classmethod
+    def _is_current(cls, f: h5py.File) -> bool:
+        """ インデックスがあり、作ったときと今のcakeが同じか。記録のない (古い形式の) インデックスも使わない """
+        if cls.DATA_PATH not in f or cls.CAKE_PATH not in f:
+            return False
+        return f[cls.DATA_PATH].attrs.get('cake') == cls.describe_cake(f[cls.CAKE_PATH])
+
+    def roi_profiles(self,
+                     from_azi_idx: int, to_azi_idx: int,
+                     from_tth_idx: int, to_tth_idx: int,
+                     from_frame: int = 0, to_frame: int = None):
+        """
+        cake[frame, from_azi_idx:to_azi_idx, from_tth_idx:to_tth_idx] の平均パターンを返す
+        (PeakWriter.write_re_integrate_peak_data の結果と同じもの)
+
+        Returns:
+            : (tthパターン (frames, npt_tth_diff), aziパターン (frames, npt_azi_diff))
+        """
+        npt_azi_diff = to_azi_idx - from_azi_idx
+        npt_tth_diff = to_tth_idx - from_tth_idx
+        if npt_azi_diff <= 0 or npt_tth_diff <= 0:
+            raise ValueError(f"範囲が空です: azi {from_azi_idx}-{to_azi_idx}, tth {from_tth_idx}-{to_tth_idx}")
+
+        with h5py.File(self.file_path, 'r') as f:
+            if not self._is_current(f):
+                raise ValueError(f"{self.DATA_PATH} が無いか、今のcakeと合いません。write_cake_index で作り直してください。")
+            index = f[self.DATA_PATH]
+            frames = slice(from_frame, to_frame)
+            # azi の上下端の2行だけ読めば、各2θ binの azi方向の和が求まる
+            rows = index[frames, [from_azi_idx, to_azi_idx], from_tth_idx:to_tth_idx + 1]
+            # tth の左右端の2列だけ読めば、各方位角binの tth方向の和が求まる
+            cols = index[frames, from_azi_idx:to_azi_idx + 1, [from_tth_idx, to_tth_idx]]
+
+        tth_pattern = np.diff(rows[:, 1, :] - rows[:, 0, :], axis=1) / npt_azi_diff
+        azi_pattern = np.diff(cols[:, :, 1] - cols[:, :, 0], axis=1) / npt_tth_diff
+        return tth_pattern.astype(np.float32), azi_pattern.astype(np.float32)
@@ -0,0 +1,57 @@
+"""
+ライブ処理 (XRDWriter.follow_data) を別プロセスで動かす
+
+Streamlitのページは操作のたびに再実行されるので、積算はページとは別のプロセスで続ける。
+ページ側は tmp.hdf が書き換わるたびに読み直して表示を更新する。
+
+コマンドラインからも使える:
+    python -m app_utils.live data.nxs calib.poni tmp.hdf --npt_tth 1000 --npt_azi 1000
+"""
+import argparse
+import multiprocessing
+
+from app_utils.Writer import XRDWriter
+from modules.XRD import XRD
+
+
+def follow(xrd_config: dict, tmp_hdf_path: str, poll_seconds: float = 1.0, idle_seconds: float = 60.0, stop_event=None):
+    xrd = XRD(**{**xrd_config, 'swmr': True})
+    XRDWriter(filepath=tmp_hdf_path, xrd=xrd).follow_data(
+        poll_seconds=poll_seconds, idle_seconds=idle_seconds, stop_event=stop_event
+    )
+
+
+def start_follow_process(xrd_config: dict, tmp_hdf_path: str, poll_seconds: float = 1.0, idle_seconds: float = 60.0):
+    """
+    ライブ処理のプロセスを起動する
+
+    Returns:
+        : (プロセス, 止めるときにsetするEvent)
+    """
+    context = multiprocessing.get_context('spawn')
+    stop_event = context.Event()
+    process = context.Process(
+        target=follow,
+        args=(xrd_config, tmp_hdf_path, poll_seconds, idle_seconds, stop_event),
+        daemon=True,
+    )
+    process.start()
+    return process, stop_event
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='書き込み中の .nxs を監視して、追加されたframeを積算し続ける')
+    parser.add_argument('xrd_path')
+    parser.add_argument('poni_path')
+    parser.add_argument('tmp_hdf_path')
+    parser.add_argument('--mask_path', default=None)
+    parser.add_argument('--npt_tth', type=int, default=1_000)
+    parser.add_argument('--npt_azi', type=int, default=1_000)
+    parser.add_argument('--poll_seconds', type=float, default=1.0)
+    parser.add_argument('--idle_seconds', type=float, default=60.0)
+    args = parser.parse_args()
+    follow(
+        {'xrd_path': args.xrd_path, 'poni_path': args.poni_path, 'mask_path': args.mask_path,
+         'npt_tth': args.npt_tth, 'npt_azi': args.npt_azi},
+        args.tmp_hdf_path, args.poll_seconds, args.idle_seconds
+    )
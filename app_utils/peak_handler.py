@@ -1,6 +1,6 @@
 import json
 import os
-import streamlit as st
+
 import numpy as np
 
 """ peak_numはメンバとして持たないので注意。その都度わたしてあげる必要がある。 """
@@ -45,8 +45,22 @@ class Peak:
         self.to_azi = peak_settings[f'{peak_num}']['to_azi']
         self.from_frame = peak_settings[f'{peak_num}']['from_frame']
         self.to_frame = peak_settings[f'{peak_num}']['to_frame']
+        # それぞれのindexを取得しておく
+        self._set_boundary_indices()
         return self
 
+    # jsonにある全てのピークを {peak_num: Peak} で返す (PeakWriter.write_re_integrate_peaks に渡す)
+    #   path_to_json: 既定 (app_utils/peaks.json) 以外のjsonを読む場合 (コマンドラインのバッチ処理など)
+    @classmethod
+    def load_all(cls, tth_arr, azi_arr, path_to_json: str = None) -> dict:
+        def create():
+            peak = cls()
+            if path_to_json is not None:
+                peak.path_to_json = path_to_json
+            return peak
+        peak_nums = sorted(create()._get_setting(), key=int)
+        return {peak_num: create().set_from_json(peak_num, tth_arr, azi_arr) for peak_num in peak_nums}
+
     def _set_boundary_indices(self):
         # 2θ
         from_tth_idx, to_tth_idx = self._return_idx(
@@ -73,8 +87,8 @@ class Peak:
     def save_to_json(self, peak_num):
         # 読み出し
         peak_settings = self._get_setting()
-        # 更新
-        peak_settings[peak_num] = {
+        # 更新。jsonのキーは文字列になるので、数値のまま入れると同じピークが2つできてしまう
+        peak_settings[f'{peak_num}'] = {
             'from_tth': self.from_tth,
             'to_tth': self.to_tth,
             'from_azi': self.from_azi,
@@ -93,5 +107,6 @@ class Peak:
                 setting_json = json.load(f)
         except FileNotFoundError:
             print(f'File {self.path_to_json} not found.')
+            setting_json = {}
         return setting_json
 
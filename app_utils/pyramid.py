@@ -0,0 +1,104 @@
+"""
+cake・patternデータを縮小した多段階の解像度(ピラミッド)を扱うクラス
+
+entry/pyramid/cake/<倍率> に (frame, npt_azi/倍率, npt_tth/倍率) を、
+entry/pyramid/pattern/<倍率> に (frame/倍率, npt_tth/倍率) を保存する (XRDWriter が caking 中に作る)。
+表示する画素数に合わせて一番小さいものを選ぶので、画面に出ない分のデータは読まない。
+"""
+import os
+
+import h5py
+import numpy as np
+
+from modules.HDF5 import MemmapCache
+
+
+def downsample(arr: np.ndarray, factor: int, axes: tuple) -> np.ndarray:
+    """ 指定した軸を factor 個ずつ平均して縮小する。割り切れない端の部分は残りの個数で平均する """
+    for axis in axes:
+        n = arr.shape[axis]
+        starts = np.arange(0, n, factor)
+        sums = np.add.reduceat(arr, starts, axis=axis)
+        counts = np.diff(np.append(starts, n))
+        shape = [1] * arr.ndim
+        shape[axis] = -1
+        arr = sums / counts.reshape(shape)
+    return arr
+
+
+class CakePyramid:
+    BASE_PATH = 'entry/pyramid'
+    MIN_SIZE = 128 # これより小さくなる倍率は作らない
+
+    def __init__(self, file_path: str, use_memmap: bool = False):
+        """
+        use_memmap: cakeとその縮小版はchunkなしで書き込むので、frameを動かして表示する間はmemmapで読む (コピーしない)
+            返すのは読み込み専用の view なので、書き換える呼び出し側では False のままにする (HDFDataFetcher と同じ)
+        """
+        self.file_path = file_path
+        self._memmaps = MemmapCache(file_path) if use_memmap else None
+
+    @classmethod
+    def factors_for(cls, shape) -> list:
+        """ shape (縮小する軸の大きさ) に対して作る倍率のリスト。2, 4, 8, ... """
+        factors = []
+        factor = 2
+        while max(shape) // factor >= cls.MIN_SIZE:
+            factors.append(factor)
+            factor *= 2
+        return factors
+
+    @classmethod
+    def data_path(cls, name: str, factor: int) -> str:
+        return os.path.join(cls.BASE_PATH, name, f'{factor}')
+
+    def available_factors(self, name: str) -> list:
+        """ 保存されている倍率。元データの 1 を含む """
+        with h5py.File(self.file_path, 'r') as f:
+            group_path = os.path.join(self.BASE_PATH, name)
+            if group_path not in f:
+                return [1]
+            return [1] + sorted(int(factor) for factor in f[group_path].keys())
+
+    def select_factor(self, name: str, shape, display_shape) -> int:
+        """
+        表示する画素数 display_shape を下回らない範囲で、一番大きい倍率を返す
+        shape: 元データの表示する軸の大きさ
+        """
+        selected = 1
+        for factor in self.available_factors(name):
+            if all(-(-n // factor) >= px for n, px in zip(shape, display_shape)):
+                selected = max(selected, factor)
+        return selected
+
+    def fetch_cake_frame(self, frame: int, display_shape=(480, 640)):
+        """
+        display_shape (azi, tth 方向の画素数) に合った解像度で、1frame分のcakeを返す
+        use_memmap=True で、chunkなし・圧縮なしなら読み込み専用の np.memmap の一部 (view) を返す
+
+        Returns:
+            : (cakeデータ, 倍率)
+        """
+        with h5py.File(self.file_path, 'r') as f:
+            shape = f['entry/cake'].shape[1:]
+        factor = self.select_factor('cake', shape, display_shape)
+        data_path = 'entry/cake' if factor == 1 else self.data_path('cake', factor)
+        memmap = self._memmaps.get(data_path) if self._memmaps is not None else None
+        if memmap is not None:
+            return memmap[frame], factor
+        with h5py.File(self.file_path, 'r') as f:
+            return f[data_path][frame], factor
+
+    def fetch_pattern(self, display_shape=(480, 640)):
+        """
+        display_shape (frame, tth 方向の画素数) に合った解像度で、patternデータ全体を返す
+
+        Returns:
+            : (patternデータ, 倍率)
+        """
+        with h5py.File(self.file_path, 'r') as f:
+            shape = f['entry/pattern'].shape
+        factor = self.select_factor('pattern', shape, display_shape)
+        data_path = 'entry/pattern' if factor == 1 else self.data_path('pattern', factor)
+        with h5py.File(self.file_path, 'r') as f:
+            return f[data_path][:], factor
@@ -0,0 +1,120 @@
+"""
+積算結果(tmp.hdf)をローカルのキャッシュフォルダに保存しておき、同じ条件の積算をやり直さずに使い回すクラス
+
+キーは 生データ(サイズ・一部の中身のハッシュ), .poniの中身, maskの中身, 積算の設定 (XRD.to_config の分割数・積算方法・frame範囲) と、
+tmp.hdfに何を書き込むかの設定 (cakeの保存レイアウト・縮小版・インデックス・スポット検出など) から作る。
+復元したtmp.hdfには、保存したときに作ったものしか入っていないため。
+合計サイズが上限を超えたら、最後に使ったのが古いものから消す (LRU)。
+"""
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from modules.XRD import XRD
+
+
+class IntegrationCache:
+    INDEX_FILE = 'index.json'
+    PARTIAL_HASH_BYTES = 1024**2 # 生データは大きいので、先頭・中央・末尾のこの大きさだけハッシュを取る
+    # XRD.to_config のうちキーに入れないもの。ファイルは場所ではなく中身で区別する。swmr は積算結果を変えない
+    CONFIG_EXCLUDED_FROM_KEY = ('xrd_path', 'poni_path', 'mask_path', 'swmr')
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        """
+        cache_dir: キャッシュを保存するフォルダ。無ければ作る
+        max_bytes: キャッシュの合計サイズの上限
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    """ キー """
+    @classmethod
+    def fingerprint(cls, xrd: XRD, outputs: dict = None) -> str:
+        """
+        積算結果を決める入力から作るキー。ファイルの場所・更新時刻が変わっても (コピー・rsyncなど)、中身が同じなら同じキーになる
+        積算方法 (set_methods) を決めてから呼ぶ
+        outputs: 積算以外で tmp.hdf の中身を決める設定 (XRDWriterの cake_layout, compression, build_pyramid, インデックスの有無など)。JSONにできるもの
+
+        NOTE: 生データはサイズと一部の中身だけで区別する。同じサイズで、ハッシュを取らない部分だけが違うファイルは区別できない
+        """
+        config = {key: value for key, value in xrd.to_config().items() if key not in cls.CONFIG_EXCLUDED_FROM_KEY}
+        key_source = {
+            'xrd_size': os.path.getsize(xrd.xrd_path),
+            'xrd_partial_sha1': cls._partial_sha1(xrd.xrd_path),
+            'poni_sha1': XRD.sha1_of_file(xrd.poni_path),
+            'mask_sha1': XRD.sha1_of_file(xrd.mask_path) if xrd.mask_path is not None else None,
+            'config': config,
+            'outputs': outputs or {},
+        }
+        return hashlib.sha1(json.dumps(key_source, sort_keys=True).encode()).hexdigest()
+
+    @classmethod
+    def _partial_sha1(cls, path: str) -> str:
+        size = os.path.getsize(path)
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for offset in sorted({0, max(0, size // 2 - cls.PARTIAL_HASH_BYTES // 2), max(0, size - cls.PARTIAL_HASH_BYTES)}):
+                f.seek(offset)
+                sha1.update(f.read(cls.PARTIAL_HASH_BYTES))
+        return sha1.hexdigest()
+
+    """ 読み出し・保存 """
+    def restore(self, key: str, to_path: str) -> bool:
+        """ キャッシュにあれば to_path (tmp.hdf) にコピーしてTrueを返す。無ければFalse """
+        index = self._read_index()
+        if key not in index or not os.path.exists(self._entry_path(key)):
+            print(f"キャッシュにありません: {key}")
+            return False
+        shutil.copyfile(self._entry_path(key), to_path)
+        index[key]['last_used'] = time.time()
+        self._write_index(index)
+        print(f"キャッシュから復元しました: {key} -> {to_path}")
+        return True
+
+    def store(self, key: str, from_path: str, description: dict = None):
+        """ from_path (積算し終わったtmp.hdf) をキャッシュに保存し、上限を超えた分を古い順に消す """
+        size = os.path.getsize(from_path)
+        if size > self.max_bytes:
+            print(f"キャッシュの上限 ({self.max_bytes / 1e9:.1f} GB) より大きいので保存しません: {from_path}")
+            return
+        shutil.copyfile(from_path, self._entry_path(key))
+        index = self._read_index()
+        index[key] = {'size': size, 'last_used': time.time(), 'description': description or {}}
+        self._write_index(index)
+        print(f"キャッシュに保存しました: {from_path} -> {key}")
+        self._evict(keep=key)
+
+    def _evict(self, keep: str = None):
+        index = self._read_index()
+        total = sum(entry['size'] for entry in index.values())
+        for key in sorted(index, key=lambda k: index[k]['last_used']): # 古い順
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= index[key]['size']
+            if os.path.exists(self._entry_path(key)):
+                os.remove(self._entry_path(key))
+            del index[key]
+            print(f"キャッシュから削除しました: {key}")
+        self._write_index(index)
+
+    def total_bytes(self) -> int:
+        return sum(entry['size'] for entry in self._read_index().values())
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f'{key}.hdf')
+
+    def _read_index(self) -> dict:
+        try:
+            with open(os.path.join(self.cache_dir, self.INDEX_FILE), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _write_index(self, index: dict):
+        with open(os.path.join(self.cache_dir, self.INDEX_FILE), 'w') as f:
+            json.dump(index, f, ensure_ascii=False)
@@ -0,0 +1,233 @@
+"""
+frameの範囲ごとに別々のプロセス (別のノードでもよい) で caking し、HDF5の仮想データセット (VDS) で1つにまとめるクラス
+
+tmp.hdfの entry/cake に書き込めるのは同時に1プロセスだけなので、XRDWriterを並列にしても書き込みで頭打ちになる。
+ここでは全frameを shard_num 個の範囲に分け、範囲ごとに独立したファイル (shard) に XRDWriter で書き込む。
+shardのpathと範囲は (file_path, shard_num, 何番目か) だけで決まるので、ファイルシステムを共有していれば
+各ノードは互いに連絡せずに自分の分を書き込める。全部終わったら assemble() で
+    entry/cake, entry/pattern, entry/progress/<cake, pattern>
+を、各shardの同じデータセットをframe方向に並べたVDSとして tmp.hdf に作る。
+読み込み側 (HDF5Reader, HDFDataFetcher, CakePyramid など) からは普通のデータセットと同じに見える。
+まだ書き込まれていないshardの部分は0 (完了フラグはFalse) になる。
+
+shardのファイルはVDSから参照されるので、tmp.hdfと一緒に置いておく (tmp.hdfからの相対pathで参照する)。
+
+    # 1台で、4プロセスで8個のshardを書き込んでまとめる
+    python -m app_utils.shards local data.nxs calib.poni tmp.hdf --shard_num 8 --workers 4
+    # 複数のノードで: 各ノードで自分の番号のshardを書き込み、最後に1回まとめる
+    python -m app_utils.shards worker data.nxs calib.poni tmp.hdf --shard_num 8 --shard 3
+    python -m app_utils.shards assemble data.nxs calib.poni tmp.hdf --shard_num 8
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import h5py
+import numpy as np
+
+from app_utils.Writer import XRDWriter
+from app_utils.cake_index import CakeIntegralIndex
+from app_utils.pyramid import CakePyramid
+from modules.XRD import XRD
+
+
+class ShardedCaking:
+    # tmp.hdf に保存する、まとめたshardの一覧
+    SHARD_PATH = 'entry/shards'
+    # VDSにするデータセット。shardの中でも同じpath
+    DATA_PATHS = (
+        os.path.join(XRDWriter.BASE_PATH, 'cake'),
+        os.path.join(XRDWriter.BASE_PATH, 'pattern'),
+        os.path.join(XRDWriter.PROGRESS_PATH, 'cake'),
+        os.path.join(XRDWriter.PROGRESS_PATH, 'pattern'),
+    )
+
+    def __init__(self, file_path: str, xrd: XRD, shard_num: int, writer_options: dict = None):
+        """
+        file_path: まとめたデータを置くtmp.hdf
+        xrd: 全frameのXRD。shardごとに frame_range を絞って作り直す
+        writer_options: shardを書き込むXRDWriterに渡す引数 (num_threads, memory_budget, cake_layout, compression など)
+        """
+        if shard_num < 1:
+            raise ValueError(f"shard_num は1以上にしてください: {shard_num}")
+        self.file_path = file_path
+        self.xrd = xrd
+        self.shard_num = min(shard_num, xrd.frame_num)
+        self.writer_options = writer_options or {}
+
+    """ 分割 """
+    def plan(self) -> list:
+        """ shardごとの {'shard', 'frame_range', 'path'}。frame数がなるべく均等になるように分ける """
+        bounds = np.linspace(0, self.xrd.frame_num, self.shard_num + 1).round().astype(int)
+        return [
+            {'shard': i, 'frame_range': (int(bounds[i]), int(bounds[i + 1])), 'path': self.shard_path(i)}
+            for i in range(self.shard_num)
+        ]
+
+    def shard_path(self, shard: int) -> str:
+        """ <tmp.hdfの名前>_shards/shard_<番号>_of_<shard数>.hdf """
+        return os.path.join(self.shard_dir(), f'shard_{shard:04d}_of_{self.shard_num:04d}.hdf')
+
+    def shard_dir(self) -> str:
+        return os.path.splitext(self.file_path)[0] + '_shards'
+
+    """ 書き込み (workerごと) """
+    def write_shard(self, shard: int) -> dict:
+        """ shard番目の範囲を積算して書き込む。途中まで書き込まれていれば続きから (XRDWriterのresume) """
+        job = self.plan()[shard]
+        os.makedirs(self.shard_dir(), exist_ok=True)
+        return _write_shard(self.xrd.to_config(), job['frame_range'], job['path'], self.writer_options)
+
+    def run_local(self, num_workers: int) -> dict:
+        """ 全shardを、このマシンの num_workers 個のプロセスで書き込んでからまとめる """
+        os.makedirs(self.shard_dir(), exist_ok=True)
+        jobs = self.plan()
+        start = time.perf_counter()
+        print(f"{self.xrd.frame_num} frame を {len(jobs)} 個のshardに分けて、{num_workers} プロセスで積算します。")
+        # h5pyのファイルハンドルをforkで引き継がないように spawn で起動する (XRDPoolと同じ)
+        with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = [
+                executor.submit(_write_shard, self.xrd.to_config(), job['frame_range'], job['path'], self.writer_options)
+                for job in jobs
+            ]
+            reports = [future.result() for future in futures] # 失敗したshardがあればここで例外になる
+        wall_seconds = time.perf_counter() - start
+        print(f"shardの書き込み: {wall_seconds:.1f} s ({self.xrd.frame_num / wall_seconds:.1f} frames/s)")
+        return self.assemble(reports)
+
+    """ まとめる """
+    def assemble(self, reports: list = None) -> dict:
+        """
+        各shardのデータセットをframe方向に並べたVDSを tmp.hdf に作る。params・arrも書き込む
+        無いshardがあっても作る (その部分は0、完了フラグはFalse)。進み具合を返す
+        """
+        writer = XRDWriter(self.file_path, self.xrd)
+        writer.write_params()
+        writer.write_arrays()
+        jobs = self.plan()
+        with h5py.File(self.file_path, 'a') as f_append:
+            # 前のcakeから作ったもの (縮小版・積分画像) は使えないので消しておく
+            for data_path in (*self.DATA_PATHS, self.SHARD_PATH, CakePyramid.BASE_PATH, CakeIntegralIndex.DATA_PATH):
+                if data_path in f_append:
+                    del f_append[data_path]
+            shard_datasets = self._read_shard_datasets(jobs)
+            for data_path in self.DATA_PATHS:
+                self._create_virtual_dataset(f_append, data_path, jobs, shard_datasets)
+            done = {name: f_append[os.path.join(XRDWriter.PROGRESS_PATH, name)][:] for name in ('cake', 'pattern')}
+            for name in ('cake', 'pattern'):
+                f_append[os.path.join(XRDWriter.BASE_PATH, name)].attrs['partial'] = not bool(done[name].all())
+            # どのshardをまとめたか
+            shards = f_append.create_group(self.SHARD_PATH)
+            shards.create_dataset('path', data=[os.path.relpath(job['path'], os.path.dirname(os.path.abspath(self.file_path))) for job in jobs])
+            shards.create_dataset('frame_range', data=np.array([job['frame_range'] for job in jobs], dtype=np.int64))
+            shards.create_dataset('found', data=np.array([job['path'] in shard_datasets for job in jobs]))
+            if reports is not None:
+                shards.attrs['reports'] = json.dumps(reports)
+        progress = {
+            'shards': len(jobs),
+            'found_shards': len(shard_datasets),
+            'done_frames': int(np.count_nonzero(done['cake'] & done['pattern'])),
+            'frame_num': self.xrd.frame_num,
+        }
+        print(f"{progress['found_shards']}/{progress['shards']} 個のshardをまとめました "
+              f"({progress['done_frames']}/{progress['frame_num']} frame 完了): {self.file_path}")
+        return progress
+
+    def _read_shard_datasets(self, jobs: list) -> dict:
+        """ {shardのpath: {データセットのpath: (shape, dtype)}}。無いshard・形が合わないshardは入れない """
+        shard_datasets = {}
+        for job in jobs:
+            if not os.path.exists(job['path']):
+                print(f"shard {job['shard']} がありません: {job['path']}")
+                continue
+            frame_count = job['frame_range'][1] - job['frame_range'][0]
+            with h5py.File(job['path'], 'r') as f:
+                if not all(data_path in f for data_path in self.DATA_PATHS):
+                    print(f"shard {job['shard']} はまだ書き込まれていません: {job['path']}")
+                    continue
+                datasets = {data_path: (f[data_path].shape, f[data_path].dtype) for data_path in self.DATA_PATHS}
+            if any(shape[0] != frame_count or shape[1:] != self._row_shape(data_path)
+                   for data_path, (shape, _) in datasets.items()):
+                print(f"shard {job['shard']} の形が合わないので使いません (分割数・frame数が違う): {job['path']}")
+                continue
+            shard_datasets[job['path']] = datasets
+        return shard_datasets
+
+    def _row_shape(self, data_path: str) -> tuple:
+        """ 1frameあたりのshape。完了フラグは () """
+        return {
+            os.path.join(XRDWriter.BASE_PATH, 'cake'): (self.xrd.npt_azi, self.xrd.npt_tth),
+            os.path.join(XRDWriter.BASE_PATH, 'pattern'): (self.xrd.npt_tth,),
+        }.get(data_path, ())
+
+    def _create_virtual_dataset(self, f_append: h5py.File, data_path: str, jobs: list, shard_datasets: dict):
+        is_progress = data_path.startswith(XRDWriter.PROGRESS_PATH)
+        layout = h5py.VirtualLayout(shape=(self.xrd.frame_num, *self._row_shape(data_path)), dtype=bool if is_progress else np.float32)
+        base_dir = os.path.dirname(os.path.abspath(self.file_path))
+        for job in jobs:
+            if job['path'] not in shard_datasets:
+                continue
+            shape, _ = shard_datasets[job['path']][data_path]
+            # tmp.hdfからの相対path。tmp.hdfとshardのフォルダをまとめて移動しても読める
+            source = h5py.VirtualSource(os.path.relpath(job['path'], base_dir), data_path, shape=shape)
+            from_frame, to_frame = job['frame_range']
+            layout[from_frame:to_frame] = source
+        f_append.create_virtual_dataset(data_path, layout, fillvalue=False if is_progress else 0)
+
+    @classmethod
+    def read_shards(cls, file_path: str) -> list:
+        """ まとめたshardの一覧 [{'path', 'frame_range', 'found'}]。shardでなければ空 """
+        with h5py.File(file_path, 'r') as f:
+            if cls.SHARD_PATH not in f:
+                return []
+            group = f[cls.SHARD_PATH]
+            return [
+                {'path': path.decode() if isinstance(path, bytes) else path, 'frame_range': tuple(int(v) for v in frame_range), 'found': bool(found)}
+                for path, frame_range, found in zip(group['path'][:], group['frame_range'][:], group['found'][:])
+            ]
+
+
+def _write_shard(xrd_config: dict, frame_range: tuple, shard_path: str, writer_options: dict) -> dict:
+    """ 1つのshardを書き込む (プロセスプールのworker・別のノードで実行される) """
+    xrd = XRD(**{**xrd_config, 'frame_range': frame_range})
+    writer = XRDWriter(shard_path, xrd, **writer_options)
+    writer.write_params()
+    writer.write_pattern_and_cake_data()
+    return {'path': shard_path, 'frame_range': list(frame_range), **writer.run_report}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='frameの範囲ごとに別のプロセス・ノードで caking して、HDF5の仮想データセットでまとめる')
+    parser.add_argument('command', choices=['local', 'worker', 'assemble'],
+                        help='local: このマシンで全shardを書いてまとめる / worker: 1つのshardだけ書く / assemble: まとめる')
+    parser.add_argument('xrd_path')
+    parser.add_argument('poni_path')
+    parser.add_argument('tmp_hdf_path')
+    parser.add_argument('--shard_num', type=int, required=True)
+    parser.add_argument('--shard', type=int, help='worker: 書き込むshardの番号 (0から)')
+    parser.add_argument('--workers', type=int, default=1, help='local: 同時に書き込むshardの数')
+    parser.add_argument('--mask_path', default=None)
+    parser.add_argument('--npt_tth', type=int, default=1_000)
+    parser.add_argument('--npt_azi', type=int, default=1_000)
+    parser.add_argument('--threads', type=int, default=1, help='1つのshardあたりの積算スレッド数')
+    parser.add_argument('--cake_layout', choices=XRDWriter.CAKE_LAYOUTS, default='contiguous')
+    parser.add_argument('--compression', choices=[c for c in XRDWriter.COMPRESSIONS if c is not None], default=None)
+    args = parser.parse_args()
+
+    sharded = ShardedCaking(
+        args.tmp_hdf_path,
+        XRD(xrd_path=args.xrd_path, poni_path=args.poni_path, mask_path=args.mask_path, npt_tth=args.npt_tth, npt_azi=args.npt_azi),
+        shard_num=args.shard_num,
+        writer_options={'num_threads': args.threads, 'cake_layout': args.cake_layout, 'compression': args.compression},
+    )
+    if args.command == 'local':
+        sharded.run_local(args.workers)
+    elif args.command == 'worker':
+        if args.shard is None:
+            parser.error('worker には --shard が必要です')
+        sharded.write_shard(args.shard)
+    else:
+        sharded.assemble()
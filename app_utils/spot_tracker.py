@@ -0,0 +1,257 @@
+"""
+frameごとに検出したスポット (entry/spots, SpotDetector) をつないで、粒ごとの軌跡 (track) にするクラス
+
+frame順に、続いている軌跡の予測位置 (最後の位置 + 速度 x 経過frame数) の近くにある、次のframeのスポットを探す。
+探すときは (2θ, 方位角) を許容量で割った座標のKD木 (scipy.spatial.cKDTree) を使うので、
+1frameあたり O((軌跡の数 + スポットの数) log n) で済み、スポットが数十万個あっても総当たりにならない。
+方位角は周期的 (-180° と 180° がつながる) な座標として扱う。
+max_gap frameまでスポットが見つからなくても軌跡は続いているとみなす (一時的に暗くなった・検出漏れ)。
+
+結果は
+    entry/spots/track: 各スポットの軌跡ID (スポットの表と同じ順番)
+    entry/tracks/<列名>: 軌跡ごとの集計 (TRACK_COLUMNS)。1行が1つの軌跡で、行番号が軌跡ID
+    entry/tracks/series/<列名>: 軌跡ID順に並べたスポット。軌跡ごとの時系列は series_start から length 個
+に保存する。
+
+    SpotTracker().write_tracks(tmp_hdf_path)
+    series = SpotTracker.read_track(tmp_hdf_path, track_id)
+"""
+import json
+import os
+
+import h5py
+import numpy as np
+from scipy.spatial import cKDTree
+
+from app_utils.spots import SpotDetector
+
+
+class SpotTracker:
+    DATA_PATH = 'entry/tracks'
+    TRACK_COLUMN_PATH = os.path.join(SpotDetector.DATA_PATH, 'track')
+    # 軌跡ごとの集計。drift_* は 2θ・方位角の1frameあたりの変化 (直線の傾き)
+    TRACK_COLUMNS = {
+        'first_frame': np.int32,
+        'last_frame': np.int32,
+        'length': np.int32,
+        'series_start': np.int64,
+        'tth': np.float32,
+        'azi': np.float32,
+        'drift_tth': np.float32,
+        'drift_azi': np.float32,
+        'max_intensity': np.float32,
+    }
+    SERIES_COLUMNS = ('frame', 'tth', 'azi', 'intensity')
+    # 速度を更新するときの、新しい移動量の重み (1なら直前の移動量だけを使う)
+    VELOCITY_SMOOTHING = 0.5
+
+    def __init__(self, tth_tolerance: float = 0.05, azi_tolerance: float = 2.0, max_gap: int = 3):
+        """
+        tth_tolerance, azi_tolerance: 予測位置からこれだけ (deg) 離れていても同じ粒とみなす。楕円の範囲で探す
+        max_gap: スポットが見つからないframeがこれだけ続いても、軌跡を切らない
+        """
+        self.tth_tolerance = tth_tolerance
+        self.azi_tolerance = azi_tolerance
+        self.max_gap = max_gap
+
+    def params(self) -> dict:
+        return {'tth_tolerance': self.tth_tolerance, 'azi_tolerance': self.azi_tolerance, 'max_gap': self.max_gap}
+
+    """ 追跡 """
+    def link(self, frames: np.ndarray, tth: np.ndarray, azi: np.ndarray) -> np.ndarray:
+        """
+        frame順に並んだスポットの (frame, 2θ, 方位角) から、各スポットの軌跡ID (0から連番) を返す
+        """
+        track_ids = np.full(len(frames), -1, dtype=np.int64)
+        if len(frames) == 0:
+            return track_ids
+        scaled = self._scale(tth, azi)
+        boxsize = [0, 360.0 / self.azi_tolerance] # 2θは周期的でない (0)、方位角は一周で戻る
+        # 続いている軌跡の状態。最後の位置 (許容量で割った座標) と frame、1frameあたりの移動量
+        active_ids = np.zeros(0, dtype=np.int64)
+        active_position = np.zeros((0, 2))
+        active_velocity = np.zeros((0, 2))
+        active_frame = np.zeros(0, dtype=np.int64)
+        track_num = 0
+        frame_starts = np.flatnonzero(np.r_[True, np.diff(frames) != 0])
+        for start, stop in zip(frame_starts, np.r_[frame_starts[1:], len(frames)]):
+            frame = frames[start]
+            # max_gap frameより前に途切れた軌跡はもう伸ばさない
+            alive = frame - active_frame <= self.max_gap + 1
+            active_ids, active_position, active_velocity, active_frame = (
+                active_ids[alive], active_position[alive], active_velocity[alive], active_frame[alive]
+            )
+            spot_position = scaled[start:stop]
+            matched_tracks, matched_spots = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+            if len(active_ids):
+                gap = (frame - active_frame)[:, None]
+                predicted = active_position + active_velocity * gap
+                predicted[:, 1] %= boxsize[1]
+                matched_tracks, matched_spots = self._match(predicted, spot_position, gap[:, 0], boxsize)
+
+            # つながったスポットは軌跡を伸ばす
+            new_ids = np.empty(stop - start, dtype=np.int64)
+            new_ids[matched_spots] = active_ids[matched_tracks]
+            unmatched = np.setdiff1d(np.arange(stop - start), matched_spots)
+            new_ids[unmatched] = np.arange(track_num, track_num + len(unmatched))
+            track_num += len(unmatched)
+            track_ids[start:stop] = new_ids
+
+            # 速度は直前の位置との差 (方位角は近い方向に回った差) を、それまでの速度と平均して求める。
+            # 1回の差だけだとスポットの位置のばらつきがそのまま入り、途切れた後の予測が外れやすい
+            velocity = np.zeros((stop - start, 2))
+            if len(matched_spots):
+                delta = spot_position[matched_spots] - active_position[matched_tracks]
+                delta[:, 1] = (delta[:, 1] + boxsize[1] / 2) % boxsize[1] - boxsize[1] / 2
+                step = delta / (frame - active_frame[matched_tracks])[:, None]
+                velocity[matched_spots] = (
+                    (1 - self.VELOCITY_SMOOTHING) * active_velocity[matched_tracks] + self.VELOCITY_SMOOTHING * step
+                )
+            # 今回つながらなかった軌跡は、そのまま残しておく (max_gap まで)
+            keep = np.setdiff1d(np.arange(len(active_ids)), matched_tracks)
+            active_ids = np.r_[active_ids[keep], new_ids]
+            active_position = np.r_[active_position[keep], spot_position]
+            active_velocity = np.r_[active_velocity[keep], velocity]
+            active_frame = np.r_[active_frame[keep], np.full(stop - start, frame)]
+        return track_ids
+
+    def _scale(self, tth: np.ndarray, azi: np.ndarray) -> np.ndarray:
+        """ 許容量が1になるように割った (2θ, 方位角) 座標。方位角は [0, 360/azi_tolerance) """
+        return np.column_stack([
+            np.asarray(tth, dtype=np.float64) / self.tth_tolerance,
+            (np.asarray(azi, dtype=np.float64) + 180.0) % 360.0 / self.azi_tolerance,
+        ])
+
+    @staticmethod
+    def _match(predicted: np.ndarray, spot_position: np.ndarray, gap: np.ndarray, boxsize: list) -> tuple:
+        """
+        予測位置から距離1以内の (軌跡, スポット) の組を、1対1になるように選ぶ
+        途切れていない軌跡を優先し、その中では近いものから順に決める
+        """
+        if len(spot_position) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        track_tree = cKDTree(predicted, boxsize=boxsize)
+        spot_tree = cKDTree(spot_position, boxsize=boxsize)
+        pairs = track_tree.sparse_distance_matrix(spot_tree, 1.0, output_type='ndarray')
+        if len(pairs) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        tracks, spots = pairs['i'].astype(np.int64), pairs['j'].astype(np.int64)
+        order = np.lexsort((pairs['v'], gap[tracks]))
+        used_tracks, used_spots = set(), set()
+        matched_tracks, matched_spots = [], []
+        for track, spot in zip(tracks[order].tolist(), spots[order].tolist()):
+            if track in used_tracks or spot in used_spots:
+                continue
+            used_tracks.add(track)
+            used_spots.add(spot)
+            matched_tracks.append(track)
+            matched_spots.append(spot)
+        return np.array(matched_tracks, dtype=np.int64), np.array(matched_spots, dtype=np.int64)
+
+    """ 集計 """
+    def summarize(self, track_ids: np.ndarray, spots: dict) -> tuple:
+        """
+        ({軌跡ごとの集計の列名: 配列}, {軌跡ID順のスポットの列名: 配列}) を返す
+        """
+        order = np.lexsort((spots['frame'], track_ids))
+        series = {name: spots[name][order] for name in self.SERIES_COLUMNS}
+        sorted_ids = track_ids[order]
+        track_num = int(track_ids.max()) + 1 if len(track_ids) else 0
+        length = np.bincount(sorted_ids, minlength=track_num)
+        series_start = np.r_[0, np.cumsum(length)[:-1]] if track_num else np.zeros(0, dtype=np.int64)
+        frames = series['frame'].astype(np.float64)
+        tth = series['tth'].astype(np.float64)
+        # 方位角は軌跡の最初の位置からの差にして、-180°/180° をまたいでも連続にする
+        azi = series['azi'].astype(np.float64)
+        azi = azi[series_start[sorted_ids]] + (azi - azi[series_start[sorted_ids]] + 180.0) % 360.0 - 180.0
+        tracks = {
+            'first_frame': series['frame'][series_start] if track_num else np.zeros(0),
+            'last_frame': series['frame'][series_start + length - 1] if track_num else np.zeros(0),
+            'length': length,
+            'series_start': series_start,
+            'tth': np.bincount(sorted_ids, tth, track_num) / np.maximum(length, 1),
+            'azi': (np.bincount(sorted_ids, azi, track_num) / np.maximum(length, 1) + 180.0) % 360.0 - 180.0,
+            'drift_tth': self._slopes(sorted_ids, frames, tth, length),
+            'drift_azi': self._slopes(sorted_ids, frames, azi, length),
+            'max_intensity': self._max_by_track(sorted_ids, series['intensity'], track_num),
+        }
+        return {name: tracks[name].astype(dtype) for name, dtype in self.TRACK_COLUMNS.items()}, series
+
+    @staticmethod
+    def _slopes(ids: np.ndarray, x: np.ndarray, y: np.ndarray, counts: np.ndarray) -> np.ndarray:
+        """ 軌跡ごとの最小二乗の直線の傾き。点が1つ、またはframeが1つだけなら0 """
+        n = len(counts)
+        n_safe = np.maximum(counts, 1)
+        mean_x = np.bincount(ids, x, n) / n_safe
+        mean_y = np.bincount(ids, y, n) / n_safe
+        dx = x - mean_x[ids]
+        sxx = np.bincount(ids, dx * dx, n)
+        sxy = np.bincount(ids, dx * (y - mean_y[ids]), n)
+        slopes = np.zeros(n)
+        np.divide(sxy, sxx, out=slopes, where=sxx > 0)
+        return slopes
+
+    @staticmethod
+    def _max_by_track(ids: np.ndarray, values: np.ndarray, track_num: int) -> np.ndarray:
+        maxima = np.full(track_num, -np.inf)
+        np.maximum.at(maxima, ids, values)
+        return maxima
+
+    """ tmp.hdf """
+    def write_tracks(self, file_path: str) -> int:
+        """ entry/spots のスポットをつないで、軌跡を保存する。軌跡の数を返す """
+        spots = SpotDetector.read_spots(file_path)
+        track_ids = self.link(spots['frame'], spots['tth'], spots['azi'])
+        tracks, series = self.summarize(track_ids, spots)
+        with h5py.File(file_path, 'a') as f_append:
+            for data_path in (self.TRACK_COLUMN_PATH, self.DATA_PATH):
+                if data_path in f_append:
+                    del f_append[data_path]
+            f_append.create_dataset(self.TRACK_COLUMN_PATH, data=track_ids.astype(np.int32))
+            group = f_append.create_group(self.DATA_PATH)
+            for name, values in tracks.items():
+                group.create_dataset(name, data=values)
+            for name, values in series.items():
+                group.create_dataset(os.path.join('series', name), data=values)
+            group.attrs['params'] = json.dumps(self.params())
+        track_num = len(tracks['length'])
+        print(f"{len(track_ids)} 個のスポットを {track_num} 本の軌跡にまとめました。")
+        return track_num
+
+    @classmethod
+    def read_tracks(cls, file_path: str, min_length: int = 1) -> dict:
+        """ 軌跡ごとの集計 {列名: 配列} に 'track_id' を加えたもの。min_length frame以上続いたものだけ """
+        with h5py.File(file_path, 'r') as f:
+            if cls.DATA_PATH not in f:
+                return {'track_id': np.zeros(0, dtype=np.int64), **{name: np.zeros(0, dtype=dtype) for name, dtype in cls.TRACK_COLUMNS.items()}}
+            group = f[cls.DATA_PATH]
+            tracks = {name: group[name][:] for name in cls.TRACK_COLUMNS}
+        tracks['track_id'] = np.arange(len(tracks['length']))
+        keep = tracks['length'] >= min_length
+        return {name: values[keep] for name, values in tracks.items()}
+
+    @classmethod
+    def read_track(cls, file_path: str, track_id: int) -> dict:
+        """ 1つの軌跡のスポットの時系列 {frame, tth, azi, intensity} """
+        with h5py.File(file_path, 'r') as f:
+            group = f[cls.DATA_PATH]
+            start, length = int(group['series_start'][track_id]), int(group['length'][track_id])
+            return {name: group[os.path.join('series', name)][start:start + length] for name in cls.SERIES_COLUMNS}
+
+    @classmethod
+    def read_series(cls, file_path: str, min_length: int = 1) -> dict:
+        """ min_length frame以上続いた軌跡のスポットの時系列をまとめて {track_id, frame, tth, azi, intensity} で返す """
+        tracks = cls.read_tracks(file_path, min_length=min_length)
+        with h5py.File(file_path, 'r') as f:
+            if cls.DATA_PATH not in f:
+                return {'track_id': np.zeros(0, dtype=np.int64), **{name: np.zeros(0) for name in cls.SERIES_COLUMNS}}
+            group = f[cls.DATA_PATH]
+            series = {name: group[os.path.join('series', name)][:] for name in cls.SERIES_COLUMNS}
+        # 軌跡ID順に並んでいるので、残す軌跡の範囲だけを取り出す
+        keep = np.zeros(len(series['frame']) + 1, dtype=np.int64)
+        np.add.at(keep, tracks['series_start'], 1)
+        np.add.at(keep, tracks['series_start'] + tracks['length'], -1)
+        keep = np.cumsum(keep[:-1]) > 0
+        series = {name: values[keep] for name, values in series.items()}
+        series['track_id'] = np.repeat(tracks['track_id'], tracks['length'])
+        return series
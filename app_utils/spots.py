@@ -0,0 +1,264 @@
+"""
+cakeの (方位角, 2θ) 面から回折スポットを検出するクラス
+
+粉末のリングは方位角方向にほぼ一様なので、frameごと・2θ binごとに方位角方向の中央値を背景、
+中央値からの絶対偏差の中央値 (MAD) をばらつきとする。背景から threshold x ばらつき 以上飛び出したbinを、
+(方位角, 2θ) 面でつながっている (8近傍) ものごとにまとめて1つのスポットにする。
+方位角は -180° と 180° がつながっているので、端をまたぐスポットも1つにまとめる。
+frameのブロックごとに処理するので、cake全体をメモリに載せることはない。
+
+結果は entry/spots/<列名> に1次元の列として保存する (SPOT_COLUMNS)。1行が1つのスポット。
+
+    detector = SpotDetector(threshold=5.0)
+    detector.write_spots(tmp_hdf_path)     # 保存済みの entry/cake から検出する
+    XRDWriter(..., spot_detector=detector) # caking しながら検出する
+    spots = SpotDetector.read_spots(tmp_hdf_path)
+"""
+import json
+import os
+
+import h5py
+import numpy as np
+import scipy.sparse
+from scipy import ndimage
+from scipy.sparse.csgraph import connected_components
+from tqdm import tqdm
+
+
+class SpotDetector:
+    DATA_PATH = 'entry/spots'
+    # 列名と型。intensity は背景を引いた強度の和、peak_intensity はその最大値、size はbin数
+    SPOT_COLUMNS = {
+        'frame': np.int32,
+        'tth': np.float32,
+        'azi': np.float32,
+        'intensity': np.float32,
+        'peak_intensity': np.float32,
+        'size': np.int32,
+    }
+    # 1ブロックのcakeの大きさの目安。検出中はこの数倍 (並べ替え用のコピーなど) のメモリを使う
+    BLOCK_BYTES = 64 * 1024**2
+    # 正規分布なら MAD x 1.4826 が標準偏差になる
+    MAD_TO_SIGMA = 1.4826
+    # frameをまたいではつながない。(方位角, 2θ) 面の8近傍
+    _STRUCTURE = np.pad(np.ones((1, 3, 3), dtype=bool), ((1, 1), (0, 0), (0, 0)))
+
+    def __init__(self, threshold: float = 5.0, min_size: int = 4, min_intensity: float = 0.0):
+        """
+        threshold: 背景からばらつき (MADから求めた標準偏差) の何倍飛び出したbinをスポットとするか
+        min_size: これより小さい (bin数) ものは捨てる。鋭いリングの裾では、画素の並びのせいで方位角方向に
+            強度がむらになり、2-3 binの偽のスポットが出やすい
+        min_intensity: 背景を引いた強度がこれ以下のbinは使わない
+        """
+        self.threshold = threshold
+        self.min_size = min_size
+        self.min_intensity = min_intensity
+
+    def params(self) -> dict:
+        return {'threshold': self.threshold, 'min_size': self.min_size, 'min_intensity': self.min_intensity}
+
+    """ 検出 """
+    def detect(self, cakes: np.ndarray, frames, tth_arr: np.ndarray, azi_arr: np.ndarray) -> dict:
+        """
+        cakes: (frame, npt_azi, npt_tth) のブロック。frames: 各cakeのframe番号
+        {列名: 配列} を返す。スポットはframe順
+        """
+        cakes = np.asarray(cakes, dtype=np.float32)
+        frames = np.asarray(frames)
+        valid = cakes != 0 # pyFAIは画素がないbinを0にするので、背景の計算にもスポットにも使わない
+        background, sigma = self._background(cakes, valid)
+        net = cakes - background[:, None, :]
+        mask = valid & (net > self.threshold * sigma[:, None, :]) & (net > self.min_intensity)
+        labels, label_num = ndimage.label(mask, structure=self._STRUCTURE)
+        if label_num == 0:
+            return self._empty()
+        roots = self._merge_azimuth_edges(labels, label_num, azi_arr)
+
+        # スポットのbinだけを取り出して、スポットごとに足し合わせる (cake全体に対する計算をしない)
+        frame_idx, azi_idx, tth_idx = np.nonzero(mask)
+        spot_ids, inverse = np.unique(roots[labels[frame_idx, azi_idx, tth_idx]], return_inverse=True)
+        weights = net[frame_idx, azi_idx, tth_idx].astype(np.float64)
+        intensity = np.bincount(inverse, weights)
+        azi_rad = np.deg2rad(azi_arr[azi_idx])
+        spot_frames = np.empty(len(spot_ids), dtype=np.int64)
+        spot_frames[inverse] = frames[frame_idx]
+        peak_intensity = np.zeros(len(spot_ids))
+        np.maximum.at(peak_intensity, inverse, weights)
+        spots = {
+            'frame': spot_frames,
+            'tth': np.bincount(inverse, weights * tth_arr[tth_idx]) / intensity,
+            # 方位角は端をまたぐことがあるので、角度の重み付き平均 (ベクトルの和の向き) にする
+            'azi': np.rad2deg(np.arctan2(np.bincount(inverse, weights * np.sin(azi_rad)),
+                                         np.bincount(inverse, weights * np.cos(azi_rad)))),
+            'intensity': intensity,
+            'peak_intensity': peak_intensity,
+            'size': np.bincount(inverse),
+        }
+        keep = spots['size'] >= self.min_size
+        order = np.argsort(spots['frame'][keep], kind='stable')
+        return {name: spots[name][keep][order].astype(dtype) for name, dtype in self.SPOT_COLUMNS.items()}
+
+    def _background(self, cakes: np.ndarray, valid: np.ndarray) -> tuple:
+        """ (frame, npt_tth) の背景 (方位角方向の中央値) とばらつき """
+        # 方位角方向に並べ替えるので、方位角を最後の軸にしておく。画素がないbinはNaNにして後ろに集める
+        values = np.where(valid, cakes, np.nan).transpose(0, 2, 1).copy()
+        counts = valid.sum(axis=1)
+        values.sort(axis=2)
+        background = self._sorted_median(values, counts)
+        np.abs(values - background[:, :, None], out=values)
+        values.sort(axis=2)
+        sigma = self.MAD_TO_SIGMA * self._sorted_median(values, counts)
+        # 背景がほぼ平らだとMADが0になり、わずかな揺らぎもスポットになってしまうので、光子数のばらつき (√背景) を下限にする
+        sigma = np.maximum(sigma, np.sqrt(np.maximum(background, 1.0)))
+        return background, sigma
+
+    @staticmethod
+    def _sorted_median(sorted_values: np.ndarray, counts: np.ndarray) -> np.ndarray:
+        """ 最後の軸で並べ替え済み (NaNは後ろ) の配列の、先頭 counts 個の中央値。counts=0 なら0 """
+        lower = np.take_along_axis(sorted_values, np.maximum((counts - 1) // 2, 0)[..., None], axis=-1)[..., 0]
+        upper = np.take_along_axis(sorted_values, np.minimum(counts // 2, sorted_values.shape[-1] - 1)[..., None], axis=-1)[..., 0]
+        return np.where(counts > 0, (lower + upper) / 2, 0.0).astype(np.float32)
+
+    @staticmethod
+    def _merge_azimuth_edges(labels: np.ndarray, label_num: int, azi_arr: np.ndarray) -> np.ndarray:
+        """
+        方位角の最初と最後の行 (-180° と 180°) でつながっているラベルを同じにする
+        ラベル -> まとめた後のラベル の対応表を返す
+        """
+        roots = np.arange(label_num + 1)
+        step = azi_arr[1] - azi_arr[0] if len(azi_arr) > 1 else 0.0
+        if abs(azi_arr[-1] - azi_arr[0] + step - 360.0) > step / 2: # 方位角が一周していなければつながっていない
+            return roots
+        first, last = labels[:, 0, :], labels[:, -1, :]
+        pairs = [np.stack([first, last], axis=-1)] # 真上
+        pairs.append(np.stack([first[:, 1:], last[:, :-1]], axis=-1)) # 斜め
+        pairs.append(np.stack([first[:, :-1], last[:, 1:]], axis=-1))
+        pairs = np.concatenate([pair.reshape(-1, 2) for pair in pairs])
+        pairs = pairs[(pairs > 0).all(axis=1)]
+        if len(pairs) == 0:
+            return roots
+        # つながっているラベルのグループごとに、一番小さいラベルにそろえる
+        involved = np.unique(pairs)
+        nodes = np.searchsorted(involved, pairs)
+        graph = scipy.sparse.coo_matrix((np.ones(len(nodes)), (nodes[:, 0], nodes[:, 1])), shape=(len(involved),) * 2)
+        group_num, groups = connected_components(graph, directed=False)
+        group_roots = np.full(group_num, label_num + 1)
+        np.minimum.at(group_roots, groups, involved)
+        roots[involved] = group_roots[groups]
+        return roots
+
+    def _empty(self) -> dict:
+        return {name: np.zeros(0, dtype=dtype) for name, dtype in self.SPOT_COLUMNS.items()}
+
+    """ tmp.hdf """
+    def write_spots(self, file_path: str) -> int:
+        """ 保存済みの entry/cake から全frameのスポットを検出して entry/spots に書き込む。スポットの数を返す """
+        with h5py.File(file_path, 'a') as f_append:
+            cake_dataset = f_append['entry/cake']
+            tth_arr, azi_arr = f_append['entry/arr/tth'][:], f_append['entry/arr/azi'][:]
+            self.create_table(f_append)
+            self.detect_dataset(f_append, cake_dataset, range(cake_dataset.shape[0]), tth_arr, azi_arr)
+            return self.finish_table(f_append)
+
+    def detect_dataset(self, f_append: h5py.File, cake_dataset: h5py.Dataset, frames, tth_arr, azi_arr):
+        """ cake_dataset の frames をブロックごとに読んで検出し、entry/spots に追記する """
+        frames = list(frames)
+        block_frames = self.block_frames(cake_dataset.shape[1:], cake_dataset.chunks)
+        for start in tqdm(range(0, len(frames), block_frames), desc="Detecting Spots"):
+            block = frames[start:start + block_frames]
+            # 連続したframeならスライスで読む (h5pyはリストでの読み込みが遅い)
+            if block[-1] - block[0] == len(block) - 1:
+                cakes = cake_dataset[block[0]:block[-1] + 1]
+            else:
+                cakes = cake_dataset[block]
+            self.append(f_append, self.detect(cakes, block, tth_arr, azi_arr))
+
+    def block_frames(self, cake_shape, chunks=None) -> int:
+        """ 1ブロックのframe数。chunkがある場合は、chunkのframe方向の大きさの倍数にして同じchunkを何度も読まない """
+        block_frames = max(1, self.BLOCK_BYTES // (int(np.prod(cake_shape)) * np.dtype(np.float32).itemsize))
+        if chunks is not None:
+            block_frames = max(chunks[0], block_frames // chunks[0] * chunks[0])
+        return int(block_frames)
+
+    def create_table(self, f_append: h5py.File):
+        """ 空の entry/spots を作る。前回の結果は消す """
+        if self.DATA_PATH in f_append:
+            del f_append[self.DATA_PATH]
+        group = f_append.create_group(self.DATA_PATH)
+        for name, dtype in self.SPOT_COLUMNS.items():
+            group.create_dataset(name, shape=(0,), maxshape=(None,), chunks=(65536,), dtype=dtype)
+        group.attrs['params'] = json.dumps(self.params())
+
+    @classmethod
+    def append(cls, f_append: h5py.File, spots: dict):
+        count = len(spots['frame'])
+        if count == 0:
+            return
+        for name in cls.SPOT_COLUMNS:
+            dataset = f_append[os.path.join(cls.DATA_PATH, name)]
+            dataset.resize(dataset.shape[0] + count, axis=0)
+            dataset[-count:] = spots[name]
+
+    @classmethod
+    def finish_table(cls, f_append: h5py.File) -> int:
+        """ frame順に並べ直す (追記した順番がframe順とは限らないため)。スポットの数を返す """
+        group = f_append[cls.DATA_PATH]
+        order = np.argsort(group['frame'][:], kind='stable')
+        if np.any(np.diff(order) != 1):
+            for name in cls.SPOT_COLUMNS:
+                group[name][:] = group[name][:][order]
+        group.attrs['count'] = len(order)
+        print(f"スポットを {len(order)} 個検出しました。")
+        return len(order)
+
+    @classmethod
+    def read_spots(cls, file_path: str, frame: int = None) -> dict:
+        """ {列名: 配列}。frame を指定するとそのframeのスポットだけ。無ければ空の配列 """
+        with h5py.File(file_path, 'r') as f:
+            if cls.DATA_PATH not in f:
+                return {name: np.zeros(0, dtype=dtype) for name, dtype in cls.SPOT_COLUMNS.items()}
+            group = f[cls.DATA_PATH]
+            if frame is None:
+                return {name: group[name][:] for name in cls.SPOT_COLUMNS}
+            # frame順に並んでいるので、そのframeの範囲だけ読む
+            frames = group['frame'][:]
+            start, stop = np.searchsorted(frames, frame, side='left'), np.searchsorted(frames, frame, side='right')
+            return {name: group[name][start:stop] for name in cls.SPOT_COLUMNS}
+
+
+class SpotCollector:
+    """
+    caking中に1frameずつcakeを受け取り、ブロックにまとめて検出して entry/spots に追記する (XRDWriter用)
+    途中から再開した場合など、今回積算しなかった完了済みのframeは finish() で保存済みのcakeから検出する
+    """
+    def __init__(self, detector: SpotDetector, f_append: h5py.File, tth_arr: np.ndarray, azi_arr: np.ndarray):
+        self.detector = detector
+        self.f_append = f_append
+        self.tth_arr = tth_arr
+        self.azi_arr = azi_arr
+        self.block_frames = detector.block_frames((len(azi_arr), len(tth_arr)))
+        self.detected_frames = set()
+        self._frames = []
+        self._cakes = []
+        detector.create_table(f_append)
+
+    def add(self, frame: int, cake: np.ndarray):
+        self._frames.append(frame)
+        self._cakes.append(cake)
+        if len(self._frames) >= self.block_frames:
+            self.flush()
+
+    def flush(self):
+        if not self._frames:
+            return
+        spots = self.detector.detect(np.stack(self._cakes), self._frames, self.tth_arr, self.azi_arr)
+        SpotDetector.append(self.f_append, spots)
+        self.detected_frames.update(self._frames)
+        self._frames, self._cakes = [], []
+
+    def finish(self, cake_dataset: h5py.Dataset, done_dataset: h5py.Dataset) -> int:
+        self.flush()
+        remaining = [frame for frame in np.flatnonzero(done_dataset[:]).tolist() if frame not in self.detected_frames]
+        if remaining:
+            self.detector.detect_dataset(self.f_append, cake_dataset, remaining, self.tth_arr, self.azi_arr)
+        return SpotDetector.finish_table(self.f_append)
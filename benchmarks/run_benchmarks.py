@@ -0,0 +1,211 @@
+"""
+caking・ピーク再積算の処理速度を測るベンチマーク
+
+人工の .nxs / .poni (tools.synthetic) を作り、frame数・検出器サイズ・分割数・プロセス数を変えながら
+各処理の frames/s, MB/s (生データ換算), 最大メモリ使用量 (peak RSS) を測る。
+1ケースずつ別プロセスで実行するので、peak RSS はそのケースだけのもの。
+結果は benchmarks/results/<日時>_<gitのコミット>.jsonl に保存し、--compare で2つの結果を比べられる。
+
+    python -m benchmarks.run_benchmarks --preset quick
+    python -m benchmarks.run_benchmarks --frames 100 500 --shapes 512x512 --npt 500x360 1000x1000 --workers 1 4
+    python -m benchmarks.run_benchmarks --compare benchmarks/results/old.jsonl benchmarks/results/new.jsonl
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+
+from tools.synthetic import write_nxs, write_poni
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+PIPELINES = (
+    'get_1d_pattern_data',
+    'get_caked_data',
+    'write_cake_data',
+    'write_pattern_and_cake_data',
+    'write_pattern_and_cake_data_batch', # BatchIntegrator で複数frameまとめて積算
+    'write_re_integrate_peak_data',
+)
+PRESETS = {
+    'quick': {'frames': [50], 'shapes': ['256x256'], 'npt': ['500x360'], 'workers': [1]},
+    'full': {'frames': [100, 1000], 'shapes': ['512x512', '1024x1024'], 'npt': ['1000x1000'], 'workers': [1, 4, 8]},
+}
+
+
+def _parse_pair(text: str) -> tuple:
+    a, b = text.lower().split('x')
+    return int(a), int(b)
+
+
+def _peak_rss_mb() -> float:
+    """ このプロセスと、終了した子プロセス(プロセスプールのworker)のうち大きい方の最大メモリ使用量 """
+    rss = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    # Linuxは KB、macOSは byte で返ってくる
+    return rss / 1024**2 if sys.platform == 'darwin' else rss / 1024
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+""" 入力データ """
+def prepare_inputs(work_dir: str, frame_num: int, shape: tuple) -> tuple:
+    """ 同じ条件の入力が既にあれば使い回す """
+    os.makedirs(work_dir, exist_ok=True)
+    name = f'{shape[0]}x{shape[1]}'
+    poni_path = os.path.join(work_dir, f'{name}.poni')
+    nxs_path = os.path.join(work_dir, f'{name}_{frame_num}.nxs')
+    if not os.path.exists(poni_path):
+        write_poni(poni_path, shape=shape)
+    if not os.path.exists(nxs_path):
+        print(f"入力データを作成します: {nxs_path}")
+        write_nxs(nxs_path, poni_path, frame_num=frame_num)
+    return nxs_path, poni_path
+
+
+""" 1ケース (別プロセスで実行される) """
+def _run_case(case: dict, queue):
+    from app_utils.Writer import XRDWriter, PeakWriter
+    from app_utils.peak_handler import Peak
+    from modules.XRD import XRD
+
+    xrd = XRD(xrd_path=case['nxs_path'], poni_path=case['poni_path'], npt_tth=case['npt_tth'], npt_azi=case['npt_azi'])
+    tmp_hdf_path = os.path.join(case['work_dir'], f"bench_{os.getpid()}.hdf")
+    if os.path.exists(tmp_hdf_path):
+        os.remove(tmp_hdf_path)
+    frame_num = xrd.frame_num
+
+    pipeline = case['pipeline']
+    if pipeline == 'write_re_integrate_peak_data': # cakeが必要なので、先に作っておく (時間には含めない)
+        writer = XRDWriter(tmp_hdf_path, xrd, num_workers=case['workers'], resume=False)
+        writer.write_arrays()
+        writer.write_cake_data()
+        tth_arr, azi_arr = xrd.get_tth(), xrd.get_azi()
+        peak = Peak().set_boundaries(
+            tth_arr, tth_arr[len(tth_arr) // 3], tth_arr[len(tth_arr) // 3 + 20],
+            azi_arr, -30.0, 30.0,
+            0, frame_num
+        )
+
+    start = time.perf_counter()
+    if pipeline == 'get_1d_pattern_data':
+        for frame in range(frame_num):
+            xrd.get_1d_pattern_data(frame)
+    elif pipeline == 'get_caked_data':
+        for frame in range(frame_num):
+            xrd.get_caked_data(frame)
+    elif pipeline in ('write_cake_data', 'write_pattern_and_cake_data'):
+        writer = XRDWriter(tmp_hdf_path, xrd, num_workers=case['workers'], resume=False)
+        getattr(writer, pipeline)()
+    elif pipeline == 'write_pattern_and_cake_data_batch':
+        writer = XRDWriter(tmp_hdf_path, xrd, num_workers=case['workers'], resume=False, batch_integrate=True)
+        writer.write_pattern_and_cake_data()
+    elif pipeline == 'write_re_integrate_peak_data':
+        PeakWriter(tmp_hdf_path).write_re_integrate_peak_data(peak=peak, peak_num=1, frame_num=frame_num, use_index=False)
+    seconds = time.perf_counter() - start
+
+    raw_bytes = frame_num * int(np.prod(case['shape'])) * 4 # uint32
+    if os.path.exists(tmp_hdf_path):
+        os.remove(tmp_hdf_path)
+    queue.put({
+        'seconds': seconds,
+        'frames_per_s': frame_num / seconds,
+        'MB_per_s': raw_bytes / 1e6 / seconds,
+        'peak_rss_MB': _peak_rss_mb(),
+    })
+
+
+def run_case(case: dict) -> dict:
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_run_case, args=(case, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+""" 全ケース """
+def run(frames, shapes, npts, workers, pipelines, work_dir) -> str:
+    revision = _git_revision()
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    result_path = os.path.join(RESULTS_DIR, f"{datetime.now():%Y%m%d_%H%M%S}_{revision}.jsonl")
+    for frame_num, shape, npt, num_workers, pipeline in itertools.product(frames, shapes, npts, workers, pipelines):
+        # プロセス数が関係ない処理は1回だけ測る
+        if num_workers != workers[0] and pipeline in ('get_1d_pattern_data', 'get_caked_data'):
+            continue
+        nxs_path, poni_path = prepare_inputs(work_dir, frame_num, shape)
+        case = {
+            'pipeline': pipeline, 'frame_num': frame_num, 'shape': list(shape),
+            'npt_tth': npt[0], 'npt_azi': npt[1], 'workers': num_workers,
+            'nxs_path': nxs_path, 'poni_path': poni_path, 'work_dir': work_dir,
+        }
+        result = run_case(case)
+        record = {
+            'revision': revision,
+            **{key: case[key] for key in ('pipeline', 'frame_num', 'shape', 'npt_tth', 'npt_azi', 'workers')},
+            **result,
+        }
+        print(
+            f"{pipeline:<30} frames={frame_num:<5} shape={shape[0]}x{shape[1]:<5} npt={npt[0]}x{npt[1]:<5} workers={num_workers:<2}"
+            f" -> {result['frames_per_s']:8.1f} frames/s {result['MB_per_s']:8.1f} MB/s  RSS {result['peak_rss_MB']:7.0f} MB"
+        )
+        with open(result_path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+    print(f"結果を保存しました: {result_path}")
+    return result_path
+
+
+def compare(old_path: str, new_path: str):
+    """ 同じ条件のケースについて、frames/s の比 (new / old) を表示する """
+    def load(path):
+        with open(path, 'r') as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        return {
+            (r['pipeline'], r['frame_num'], tuple(r['shape']), r['npt_tth'], r['npt_azi'], r['workers']): r
+            for r in records
+        }
+    old, new = load(old_path), load(new_path)
+    for key in sorted(old.keys() & new.keys()):
+        ratio = new[key]['frames_per_s'] / old[key]['frames_per_s']
+        print(f"{key}: {old[key]['frames_per_s']:8.1f} -> {new[key]['frames_per_s']:8.1f} frames/s (x{ratio:.2f})")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='caking・ピーク再積算のベンチマーク')
+    parser.add_argument('--preset', choices=PRESETS.keys(), default='quick')
+    parser.add_argument('--frames', type=int, nargs='+')
+    parser.add_argument('--shapes', nargs='+', help='検出器サイズ。例: 512x512')
+    parser.add_argument('--npt', nargs='+', help='npt_tth x npt_azi。例: 1000x1000')
+    parser.add_argument('--workers', type=int, nargs='+')
+    parser.add_argument('--pipelines', nargs='+', choices=PIPELINES, default=list(PIPELINES))
+    parser.add_argument('--work_dir', default=os.path.join(os.path.dirname(__file__), 'work'))
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+    else:
+        preset = PRESETS[args.preset]
+        run(
+            frames=args.frames or preset['frames'],
+            shapes=[_parse_pair(shape) for shape in (args.shapes or preset['shapes'])],
+            npts=[_parse_pair(npt) for npt in (args.npt or preset['npt'])],
+            workers=args.workers or preset['workers'],
+            pipelines=args.pipelines,
+            work_dir=args.work_dir,
+        )
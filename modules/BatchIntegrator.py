@@ -0,0 +1,175 @@
+"""
+複数frameをまとめて積算するクラス
+
+pyFAIのCSR (bbox split) の積算は「画素 -> bin」の疎行列と画像の積なので、
+その疎行列を1回だけ作っておけば、frameのブロック (frame, 画素) を1回の 疎行列 x 行列 で積算できる。
+frameごとに ai.integrate2d を呼ぶより、Pythonの呼び出しや前処理のオーバーヘッドがブロックに1回で済む。
+
+疎行列は pyFAI 自身が作ったもの (.poni, mask, 分割数から) をそのまま使い、規格化も同じく立体角で割るので、
+結果は pyFAI と float32 の丸め誤差の範囲で一致する (validate で確認できる)。
+
+set_window で2θ・方位角のbinの範囲を絞ると、疎行列のその範囲の行だけを使う (クイックルック用)。
+binの境界は全体を積算したときと同じなので、結果は全体の cake のその範囲と一致し、後から全体を積算した結果ともつながる。
+(pyFAIの radial_range, azimuth_range で絞ると、範囲の端をまたぐ画素の割り振りが変わり、端のbinの値が変わってしまう)
+"""
+import numpy as np
+import scipy.sparse
+
+from modules.XRD import XRD
+
+
+class BatchIntegrator:
+    # 1ブロックの 生データ + cake (float32) の大きさの目安
+    BLOCK_BYTES = 256 * 1024**2
+    # 疎行列を作るpyFAIのmethod。画素の分割方法は XRD の2Dのmethodに合わせる
+    ALGO, IMPL = 'csr', 'cython'
+
+    def __init__(self, xrd: XRD):
+        self.xrd = xrd
+        self.npt_tth = xrd.npt_tth
+        self.npt_azi = xrd.npt_azi
+        self._matrix_1d = None # (npt_tth, 画素数)
+        self._matrix_2d = None # (npt_azi * npt_tth, 画素数)。binの順番はcakeと同じく azi が外側
+        self._normalization_1d = None
+        self._normalization_2d = None
+        self.set_window()
+
+    def set_window(self, tth_bins: tuple = None, azi_bins: tuple = None):
+        """
+        積算するbinの範囲 (start, stop) を設定する。Noneなら全体
+        結果のshapeは (frame, azi_binsの数, tth_binsの数) になる
+        NOTE: azi_bins を絞った場合、integrate_patterns_and_cakes のpatternはその方位角範囲だけの和になる
+        """
+        self.tth_bins = tuple(tth_bins) if tth_bins is not None else (0, self.npt_tth)
+        self.azi_bins = tuple(azi_bins) if azi_bins is not None else (0, self.npt_azi)
+        self._window_1d = None # (行を絞った疎行列, 規格化)
+        self._window_2d = None
+
+    def block_frames(self, block_bytes: int = None) -> int:
+        """ 1ブロックの 生データ + 積算途中・結果のcake (float32) が block_bytes (Noneなら BLOCK_BYTES) に収まるframe数 """
+        block_bytes = block_bytes if block_bytes is not None else self.BLOCK_BYTES
+        frame_bytes = (int(np.prod(self.xrd.ai.detector.max_shape)) + 2 * self.npt_azi * self.npt_tth) * np.dtype(np.float32).itemsize
+        return int(max(1, block_bytes // frame_bytes))
+
+    def iterate_blocks(self, frames: list, block_frames: int = None):
+        """ framesを block_frames ずつに分けて、(frameのリスト, (frame, y, x) の生データ) を返す """
+        block_frames = block_frames if block_frames is not None else self.block_frames()
+        for start in range(0, len(frames), block_frames):
+            block = frames[start:start + block_frames]
+            yield block, np.stack([self.xrd._read_frame_data(frame) for frame in block])
+
+    """ 積算 """
+    def integrate_patterns(self, frames_data: np.ndarray) -> np.ndarray:
+        """ (frame, y, x) -> (frame, npt_tth) """
+        matrix, normalization = self._window(dim=1)
+        signal = self._multiply(matrix, frames_data)
+        return self._divide(signal, normalization)
+
+    def integrate_cakes(self, frames_data: np.ndarray) -> np.ndarray:
+        """ (frame, y, x) -> (frame, npt_azi, npt_tth) """
+        return self.integrate_patterns_and_cakes(frames_data)[1]
+
+    def integrate_patterns_and_cakes(self, frames_data: np.ndarray):
+        """
+        (frame, y, x) -> ((frame, npt_tth), (frame, npt_azi, npt_tth))
+        patternはcakeと同じbinの信号・規格化を方位角方向に足して作る (XRD.get_pattern_and_caked_data と同じ)
+        """
+        matrix, normalization = self._window(dim=2)
+        azi_num, tth_num = self.azi_bins[1] - self.azi_bins[0], self.tth_bins[1] - self.tth_bins[0]
+        signal = self._multiply(matrix, frames_data).reshape(-1, azi_num, tth_num)
+        normalization = normalization.reshape(azi_num, tth_num)
+        cakes = self._divide(signal, normalization)
+        patterns = self._divide(signal.sum(axis=1, dtype=np.float64), normalization.sum(axis=0))
+        return patterns, cakes
+
+    @staticmethod
+    def _multiply(matrix, frames_data: np.ndarray) -> np.ndarray:
+        """ (bin, 画素) x (画素, frame) -> (frame, bin) """
+        pixels = np.asarray(frames_data, dtype=np.float32).reshape(len(frames_data), -1)
+        # 積の結果は (bin, frame) の並びなので、以降の計算が連続したメモリで済むように並べ替えておく
+        return np.ascontiguousarray((matrix @ pixels.T).T)
+
+    @staticmethod
+    def _divide(signal: np.ndarray, normalization: np.ndarray) -> np.ndarray:
+        """ 画素がないbinは0 (pyFAIのdummyと同じ) """
+        intensity = np.zeros(signal.shape, dtype=np.float32)
+        np.divide(signal, normalization, out=intensity, where=normalization != 0)
+        return intensity
+
+    """ 疎行列 """
+    def _window(self, dim: int) -> tuple:
+        """ set_window の範囲の行だけにした (疎行列, 規格化)。全体なら作った疎行列をそのまま使う """
+        window = self._window_1d if dim == 1 else self._window_2d
+        if window is not None:
+            return window
+        self._build(dim)
+        tth_rows = np.arange(*self.tth_bins)
+        if dim == 1:
+            matrix, normalization = self._matrix_1d, self._normalization_1d
+            rows = tth_rows
+        else:
+            matrix, normalization = self._matrix_2d, self._normalization_2d
+            rows = np.add.outer(np.arange(*self.azi_bins) * self.npt_tth, tth_rows).ravel() # (azi, tth) の順
+        if len(rows) != matrix.shape[0]:
+            matrix, normalization = matrix[rows], normalization[rows]
+        if dim == 1:
+            self._window_1d = (matrix, normalization)
+        else:
+            self._window_2d = (matrix, normalization)
+        return matrix, normalization
+
+    def _build(self, dim: int):
+        if (dim == 1 and self._matrix_1d is not None) or (dim == 2 and self._matrix_2d is not None):
+            return
+        ai = self.xrd.ai
+        shape = tuple(ai.detector.max_shape)
+        split = self.xrd.method_2d[0] if self.xrd.method_2d is not None else 'bbox'
+        method = (split, self.ALGO, self.IMPL)
+        # 1回積算させて、pyFAIが作った疎行列を取り出す
+        dummy_frame = np.zeros(shape, dtype=np.float32)
+        if dim == 1:
+            result = ai.integrate1d(dummy_frame, npt=self.npt_tth, unit="2th_deg", method=method)
+        else:
+            result = ai.integrate2d(dummy_frame, npt_rad=self.npt_tth, npt_azim=self.npt_azi, unit="2th_deg", method=method)
+        engine = ai.engines[result.method].engine
+        matrix = scipy.sparse.csr_matrix(
+            (np.asarray(engine.data), np.asarray(engine.indices), np.asarray(engine.indptr)),
+            shape=(int(np.prod(engine.bins)), int(np.prod(shape))),
+        )
+        if dim == 2:
+            # pyFAIのbinは tth が外側の順番なので、cakeと同じ (azi, tth) の順番に行を並べ替える
+            matrix = matrix[np.arange(self.npt_tth * self.npt_azi).reshape(self.npt_tth, self.npt_azi).T.ravel()]
+        # maskされた画素の列を消しておく (pyFAIは積算時にその画素を使わない)
+        mask = ai.mask
+        if mask is not None:
+            matrix = matrix @ scipy.sparse.diags((np.asarray(mask).ravel() == 0).astype(np.float32))
+            matrix = matrix.tocsr()
+        # pyFAIと同じく、立体角 (相対値) で規格化する
+        normalization = matrix @ ai.solidAngleArray(shape, absolute=False).ravel().astype(np.float32)
+        if dim == 1:
+            self._matrix_1d, self._normalization_1d = matrix, normalization.astype(np.float64)
+        else:
+            self._matrix_2d, self._normalization_2d = matrix, normalization.astype(np.float64)
+        print(f"{dim}D積算の疎行列を作りました: {matrix.shape}, {matrix.nnz} 要素 ({matrix.data.nbytes / 1e6:.0f} MB)")
+
+    """ 確認 """
+    def validate(self, frames: list = None) -> dict:
+        """
+        pyFAI (XRD.get_pattern_and_caked_data, get_1d_pattern_data) の結果との差 (最大値に対する割合) を返す
+        """
+        if frames is None:
+            frames = sorted({1 if self.xrd.frame_num > 1 else 0, self.xrd.frame_num // 2, self.xrd.frame_num - 1})
+        frames_data = np.stack([self.xrd._read_frame_data(frame) for frame in frames])
+        patterns, cakes = self.integrate_patterns_and_cakes(frames_data)
+        patterns_1d = self.integrate_patterns(frames_data)
+        errors = {'pattern': 0.0, 'cake': 0.0, 'pattern_1d': 0.0}
+        for i, frame in enumerate(frames):
+            reference_pattern, reference_cake = self.xrd.get_pattern_and_caked_data(frame)
+            reference_pattern_1d = self.xrd.get_1d_pattern_data(frame)
+            for name, value, reference in [('pattern', patterns[i], reference_pattern),
+                                           ('cake', cakes[i], reference_cake),
+                                           ('pattern_1d', patterns_1d[i], reference_pattern_1d)]:
+                error = np.abs(value - reference).max() / max(np.abs(reference).max(), 1e-30)
+                errors[name] = max(errors[name], float(error))
+        print(f"pyFAIとの差: {errors}")
+        return errors
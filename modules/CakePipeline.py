@@ -0,0 +1,143 @@
+"""
+caking を 読み込み -> 積算 -> 書き込み のパイプラインで行うクラス
+
+    読み込みスレッド (1つ) --queue--> 積算スレッド (N個) --> 呼び出し側 (frame順に並べて1つのwriterが書き込む)
+
+同時に処理中のframe数 (読み込み済みで書き込みがまだのもの) をメモリの上限から決め、それ以上は読み込まない。
+読み込みスレッドは1frame読むたびに枠を1つ取り、呼び出し側が書き込み終わって次のframeを受け取るときに返す。
+積算が速くても書き込みが遅くても、メモリに載るframe数は枠の数を超えないので、大きい検出器でも落ちない。
+
+h5pyは同時に1スレッドしか動かないので、ファイルの読み込みは1つのスレッド、書き込みは呼び出し側だけで行う。
+積算 (pyFAIのcython・OpenCL) はGILを外して動くので、スレッドを増やすと並列に進む。
+pyFAIのintegratorは複数のスレッドから同時に使うと結果が壊れるので、積算スレッドごとにXRDを作り直して使う
+(疎行列などはスレッドごとに持つことになる。このメモリはframeの枠には含めていない)。
+"""
+import queue
+import threading
+
+import numpy as np
+
+from modules.XRD import XRD
+
+
+class CakePipeline:
+    # 終わりの合図
+    _DONE = object()
+
+    def __init__(self, xrd: XRD, num_threads: int, memory_budget: int, reserved_bytes: int = 0):
+        """
+        num_threads: 積算スレッド数
+        memory_budget: このパイプラインと書き込み側で使ってよいメモリ (byte)
+        reserved_bytes: memory_budgetのうち、パイプラインの外 (書き込み側のバッファなど) で使う分
+        """
+        self.xrd = xrd
+        frame_bytes = xrd.estimate_frame_bytes()
+        self.max_in_flight = max(1, (memory_budget - reserved_bytes) // frame_bytes)
+        # 枠が少ないときにスレッドだけ多くしても待つだけなので、枠の数までにする
+        self.num_threads = max(1, min(num_threads, self.max_in_flight))
+        print(
+            f"パイプライン: 積算スレッド {self.num_threads}, 同時に処理するframe {self.max_in_flight} "
+            f"(1frame {frame_bytes / 1e6:.0f} MB, 上限 {memory_budget / 1e9:.1f} GB)"
+        )
+
+    def run(self, integrate: str, frames):
+        """
+        integrate: 読み込み済みのframeのデータを積算するXRDのメソッド名 ('integrate_pattern', 'integrate_cake', 'integrate_pattern_and_cake')
+        (frame, *結果) を frames の順に返すイテレータ
+        """
+        frames = list(frames)
+        if not frames:
+            return
+        slots = threading.Semaphore(self.max_in_flight)
+        stop = threading.Event()
+        read_queue = queue.Queue(maxsize=self.max_in_flight)
+        result_queue = queue.Queue()
+
+        threads = [threading.Thread(target=self._read, args=(frames, slots, stop, read_queue), daemon=True)]
+        threads += [
+            threading.Thread(target=self._integrate, args=(thread_integrate, stop, read_queue, result_queue), daemon=True)
+            for thread_integrate in self._thread_integrates(integrate)
+        ]
+        self.xrd.open_frame_source()
+        for thread in threads:
+            thread.start()
+        try:
+            # 積算スレッドは終わった順に結果を返すので、frame順に並べ替える。並べ替え待ちのframeも枠の中に入っている
+            waiting = {}
+            for frame in frames:
+                while frame not in waiting:
+                    item = result_queue.get()
+                    if isinstance(item, BaseException):
+                        raise item
+                    waiting[item[0]] = item
+                yield waiting.pop(frame)
+                slots.release() # 書き込みが終わったので、次のframeを読んでよい
+        finally:
+            stop.set() # 途中で止めた場合やエラーの場合も、スレッドは0.1秒以内に終わる
+            for thread in threads:
+                thread.join()
+            self.xrd.close_frame_source()
+
+    def _thread_integrates(self, integrate: str) -> list:
+        """
+        積算スレッドごとのXRDの積算メソッド。
+        pyFAIは最初の積算で疎行列などを作るが、これを複数のスレッドで同時に行うと落ちる (numexprなど) ので、
+        ここで1回ずつ積算して準備を済ませておく
+        """
+        dummy_frame = np.zeros(self.xrd.ai.detector.max_shape, dtype=np.float32)
+        integrates = []
+        for _ in range(self.num_threads):
+            xrd = XRD(**self.xrd.to_config())
+            getattr(xrd, integrate)(dummy_frame)
+            xrd.timer = self.xrd.timer # 準備の時間は記録しない。StageTimerは複数のスレッドから記録してよい
+            integrates.append(getattr(xrd, integrate))
+        return integrates
+
+    def _read(self, frames, slots, stop, read_queue):
+        try:
+            for frame in frames:
+                while not slots.acquire(timeout=0.1):
+                    if stop.is_set():
+                        return
+                if stop.is_set():
+                    return
+                self._put(read_queue, (frame, self.xrd._read_frame_data(frame)), stop)
+        except BaseException as e: # 読み込みのエラーは、積算スレッド経由で呼び出し側に渡す
+            self._put(read_queue, e, stop)
+        finally:
+            for _ in range(self.num_threads):
+                self._put(read_queue, self._DONE, stop)
+
+    def _integrate(self, integrate, stop, read_queue, result_queue):
+        while not stop.is_set():
+            try:
+                item = read_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is self._DONE:
+                return
+            if isinstance(item, BaseException):
+                self._put_result(result_queue, item)
+                return
+            frame, frame_data = item
+            try:
+                result = integrate(frame_data)
+            except BaseException as e:
+                self._put_result(result_queue, RuntimeError(f"Frame {frame} の積算中にエラーが発生しました: {str(e)}"))
+                return
+            del frame_data # 結果を書き込むまで生データを持ち続けないように
+            result_queue.put((frame, *(result if isinstance(result, tuple) else (result,))))
+
+    @staticmethod
+    def _put_result(result_queue, item):
+        result_queue.put(item) # result_queueは大きさの制限がない (枠の数で抑えている) ので待たない
+
+    @staticmethod
+    def _put(target_queue, item, stop):
+        """ queueが空くまで待つ。stopされたら諦める """
+        while not stop.is_set():
+            try:
+                target_queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
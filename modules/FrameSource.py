@@ -0,0 +1,152 @@
+"""
+検出器の生データ(frame, y, x)を1frameずつ取り出すクラス
+
+HDF5ファイルとデータセットを開いたままにしておき、ディスク上のchunkに揃えた複数frameのブロックをまとめて読み込む。
+同じブロック内のframeはメモリから返すので、frameごとのファイルopenやchunkの再解凍が起きない。
+
+gzip (deflate) + shuffle で圧縮されたデータセットは、HDF5のフィルタを通さずに圧縮されたままのchunkを読み (read_direct_chunk)、
+スレッドプールで解凍する。HDF5のフィルタ処理は1スレッドでしか動かないが、zlibの解凍中はGILが外れるので並列に進む。
+それ以外のフィルタ (lzf, bitshuffleなど) や圧縮なしのデータセットは、今まで通りh5pyで読む。
+"""
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import h5py
+import numpy as np
+from h5py import h5z
+
+
+class FrameSource:
+    # 自前で解凍できるフィルタ。データセットのフィルタが全てこの中にあれば、chunkを直接読む
+    DIRECT_FILTERS = (h5z.FILTER_SHUFFLE, h5z.FILTER_DEFLATE)
+
+    def __init__(self, file_path: str, data_path: str, block_frames: int = None, swmr: bool = False,
+                 threads: int = None):
+        """
+        file_path: 生データのファイル(.nxs, .hdf など)
+        data_path: (frame, y, x) のデータセットまでのpath
+        block_frames: 1回に読み込むframe数。Noneならchunkのframe方向の大きさに揃える
+        swmr: 検出器が書き込み中のファイルを読む場合はTrue (SWMR読み込みで開く)
+        threads: chunkを解凍するスレッド数。Noneなら min(8, CPU数)
+        """
+        self.file_path = file_path
+        self.data_path = data_path
+        self.swmr = swmr
+        self.file = h5py.File(file_path, 'r', swmr=swmr)
+        self.dataset = self.file[data_path]
+        self.frame_num = self.dataset.shape[0]
+        self.frame_shape = self.dataset.shape[1:]
+        self.dtype = self.dataset.dtype
+        self.block_frames = block_frames if block_frames else self._chunk_frames()
+        # 現在メモリに載っているブロック
+        self._block = None
+        self._block_start = 0
+        # chunkを直接読む場合のフィルタ (書き込み時にかけた順)。直接読まない場合はNone
+        self.direct_filters = self._direct_filters()
+        self._executor = None
+        if self.direct_filters is not None:
+            self._executor = ThreadPoolExecutor(max_workers=threads if threads else min(8, os.cpu_count() or 1))
+
+    def _chunk_frames(self) -> int:
+        """ chunkのframe方向の大きさ。contiguousなら1frameずつ読む """
+        chunks = self.dataset.chunks
+        return chunks[0] if chunks is not None else 1
+
+    def read(self, frame: int) -> np.ndarray:
+        """ 指定したframeの2次元データを返す。ブロック外なら、frameを含むブロックを読み込み直す """
+        if frame < 0 or frame >= self.frame_num:
+            raise IndexError(f"指定されたframe {frame} は範囲外です (最大: {self.frame_num - 1})。")
+        if self._block is None or not (self._block_start <= frame < self._block_start + len(self._block)):
+            start = frame // self.block_frames * self.block_frames # chunkの境界に揃える
+            stop = min(start + self.block_frames, self.frame_num)
+            self._block = self._read_block(start, stop)
+            self._block_start = start
+        return self._block[frame - self._block_start]
+
+    def _direct_filters(self):
+        """
+        データセットのフィルタが全て DIRECT_FILTERS なら、そのリストを返す。それ以外はNone
+        書き込み中のファイル(SWMR)は、まだ書かれていないchunkがあるので直接読まない
+        """
+        if self.swmr or self.dataset.chunks is None:
+            return None
+        plist = self.dataset.id.get_create_plist()
+        filters = [plist.get_filter(i)[0] for i in range(plist.get_nfilters())]
+        if not filters or any(code not in self.DIRECT_FILTERS for code in filters):
+            return None
+        return filters
+
+    def _read_block(self, start: int, stop: int) -> np.ndarray:
+        if self.direct_filters is None:
+            return self.dataset[start:stop]
+        try:
+            return self._read_block_direct(start, stop)
+        except RuntimeError: # 書き込まれていないchunkがある (fill valueはHDF5に任せる)
+            return self.dataset[start:stop]
+
+    def _read_block_direct(self, start: int, stop: int) -> np.ndarray:
+        """ ブロックにかかる全chunkを圧縮されたまま読み、スレッドプールで解凍して並べる """
+        chunks = self.dataset.chunks
+        block = np.empty((stop - start, *self.frame_shape), dtype=self.dtype)
+        futures = []
+        # ファイルの読み込みはこのスレッドで順番に行い、解凍だけを並列にする
+        for frame_offset in range(start // chunks[0] * chunks[0], stop, chunks[0]):
+            for y_offset in range(0, self.frame_shape[0], chunks[1]):
+                for x_offset in range(0, self.frame_shape[1], chunks[2]):
+                    filter_mask, raw = self.dataset.id.read_direct_chunk((frame_offset, y_offset, x_offset))
+                    future = self._executor.submit(self._decode_chunk, raw, filter_mask)
+                    futures.append(((frame_offset, y_offset, x_offset), future))
+        for (frame_offset, y_offset, x_offset), future in futures:
+            chunk = future.result()
+            # データセットの端のchunkは、はみ出した部分も保存されているので切り取る
+            from_frame = max(frame_offset, start)
+            to_frame = min(frame_offset + chunks[0], stop)
+            to_y = min(y_offset + chunks[1], self.frame_shape[0])
+            to_x = min(x_offset + chunks[2], self.frame_shape[1])
+            block[from_frame - start:to_frame - start, y_offset:to_y, x_offset:to_x] = \
+                chunk[from_frame - frame_offset:to_frame - frame_offset, :to_y - y_offset, :to_x - x_offset]
+        return block
+
+    def _decode_chunk(self, raw: bytes, filter_mask: int) -> np.ndarray:
+        """ 書き込み時と逆の順にフィルタを外す。filter_maskのbitが立っているフィルタは、そのchunkにはかかっていない """
+        data = raw
+        for i in reversed(range(len(self.direct_filters))):
+            if filter_mask & (1 << i):
+                continue
+            if self.direct_filters[i] == h5z.FILTER_DEFLATE:
+                data = zlib.decompress(data)
+            elif self.direct_filters[i] == h5z.FILTER_SHUFFLE:
+                # byteごとにまとめられているのを、要素ごとに戻す
+                data = np.frombuffer(data, dtype=np.uint8).reshape(self.dtype.itemsize, -1).T.tobytes()
+        return np.frombuffer(data, dtype=self.dtype).reshape(self.dataset.chunks)
+
+    def refresh(self) -> int:
+        """
+        書き込み中のファイルに追加されたframeを読めるようにして、最新のframe数を返す
+        SWMRで書かれていないファイルは、開き直して確認する
+        """
+        if self.swmr:
+            self.dataset.refresh()
+        else:
+            self.file.close()
+            self.file = h5py.File(self.file_path, 'r')
+            self.dataset = self.file[self.data_path]
+        self.frame_num = self.dataset.shape[0]
+        # 最後のブロックは途中までしか書かれていなかったかもしれないので、読み込み直させる
+        self._block = None
+        return self.frame_num
+
+    def close(self):
+        self._block = None
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        if self.file:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
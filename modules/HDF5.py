@@ -3,16 +3,79 @@ import h5py
 import numpy as np
 import pandas as pd
 
+def _narrow_to_exact_match(path_list: list, query: str) -> list:
+    """
+    複数のpathから1つに絞れる場合は、それだけのリストにする
+        1. queryそのもの、または entry/query (tmp.hdfの entry/cake, entry/pattern など) があればそれ
+        2. queryで終わる(/query)pathが1つだけならそれ
+    (例: 'cake' で entry/cake, entry/progress/cake, entry/pyramid/cake/2 が見つかった場合は entry/cake)
+    """
+    if len(path_list) < 2:
+        return path_list
+    for exact_path in (query, 'entry/' + query):
+        exact_list = [path for path in path_list if path.lstrip('/') == exact_path]
+        if len(exact_list) == 1:
+            return exact_list
+    exact_list = [path for path in path_list if path.endswith('/' + query)]
+    return exact_list if len(exact_list) == 1 else path_list
+
+def memmap_dataset(file_path: str, data_path: str):
+    """
+    chunkなし・圧縮なしで書き込み済みのデータセット (今のtmp.hdfの entry/cake, entry/pattern など) は、
+    ファイルの決まった位置に配列がそのまま並んでいるので、読み込み専用の np.memmap として返す。
+    スライスしてもh5pyを通らずコピーもしない (OSのページキャッシュから直接読む)。
+    memmapにできないデータセット (スカラー・chunkあり・圧縮・仮想データセット・外部ファイル・未書き込み・数値以外) は None
+
+    NOTE: 返した配列は、ファイルのその位置の今の中身を見ている。
+          データセットを消して作り直すとずれるので、ファイルが書き換わったら作り直す (MemmapCache)
+    """
+    with h5py.File(file_path, 'r') as f:
+        dataset = f.get(data_path)
+        if not isinstance(dataset, h5py.Dataset) or dataset.shape in (None, ()) or dataset.size == 0:
+            return None
+        if dataset.chunks is not None or dataset.is_virtual or dataset.external is not None:
+            return None
+        if dataset.dtype.kind not in 'biuf': # 文字列・可変長・複合型などは、ファイル上の並びがnumpyと違う
+            return None
+        offset = dataset.id.get_offset() # 領域がまだ確保されていなければ None
+        if offset is None:
+            return None
+        shape, dtype = dataset.shape, dataset.dtype
+    return np.memmap(file_path, mode='r', dtype=dtype, offset=offset, shape=shape)
+
+
+class MemmapCache:
+    """
+    data_pathごとの memmap_dataset の結果を持っておく。ファイルが書き換わったら (サイズ・更新時刻が変わったら) 作り直す
+    memmapにできないデータセットは None を覚えておくので、毎回h5pyで調べ直さない
+    """
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self._stamp = None
+        self._memmaps = {}
+
+    def get(self, data_path: str):
+        stat = os.stat(self.file_path)
+        stamp = (stat.st_size, stat.st_mtime_ns)
+        if stamp != self._stamp:
+            self._stamp = stamp
+            self._memmaps = {}
+        if data_path not in self._memmaps:
+            self._memmaps[data_path] = memmap_dataset(self.file_path, data_path)
+        return self._memmaps[data_path]
+
+
 class HDF5():
     SUPPORTED_FILE_TYPES = ['.hdf5', '.hdf', '.h5', '.nxs'] # 有効な拡張子を示すクラス変数
 
-    def __init__(self, file_path):
+    def __init__(self, file_path, swmr=False):
         # ファイルpath文字列の拡張子をチェック
         if any(file_path.endswith(ext) for ext in self.SUPPORTED_FILE_TYPES):
             self.file_path = file_path
             # ファイルが存在すれば、ファイル内のpath構造を設定する。
+            #   検出器が書き込み中のファイル(SWMR)は swmr=True でないと開けない
             if os.path.exists(file_path):
-                with h5py.File(self.file_path, 'r') as f:
+                with h5py.File(self.file_path, 'r', swmr=swmr) as f:
                     self.path_list = self._get_all_dataset_paths(f)
             # 無ければログを出すだけ。作成が必要ならWriterを使う
             else:
@@ -88,8 +151,13 @@ class HDF5Writer(HDF5):
                 raise KeyError(f"{data_path} が見つかりません。")
 
 class HDF5Reader(HDF5):
-    def __init__(self, file_path):
-        super().__init__(file_path)
+    def __init__(self, file_path, swmr=False, use_memmap=False):
+        """
+        use_memmap: chunkなし・圧縮なしのデータセットは、コピーせずに読み込み専用の np.memmap で返す (memmap_dataset)
+            返した配列は書き換えられないので、読むだけの場合に指定する。書き込み中のファイル (swmr=True) では使わない
+        """
+        super().__init__(file_path, swmr=swmr)
+        self._memmaps = MemmapCache(file_path) if use_memmap and not swmr else None
         print(f"HDF5ファイルが見つかりました: {self.file_path}")
 
     def find_by(self, query, shape: list = None):
@@ -114,6 +182,9 @@ class HDF5Reader(HDF5):
                     path = path[1:]
                 result_list.append(path)
 
+        # 複数見つかっても、entry/query や queryで終わるpathに1つだけ絞れればそれを返す (_narrow_to_exact_match)
+        result_list = _narrow_to_exact_match(result_list, query)
+
         if len(result_list) >= 2: # 2個以上見つかった場合
             print(f"\t-> {len(result_list)} 個のpathが見つかりました。リストで返しました。\n")
             for i, path in enumerate(result_list):
@@ -128,6 +199,9 @@ class HDF5Reader(HDF5):
             return None
 
     def return_data(self, data_path: str, shape: list = None):
+        memmap = self._memmaps.get(data_path) if self._memmaps is not None else None
+        if memmap is not None: # ファイルから直接読む。読み込み専用なので、書き換える場合はコピーする
+            return memmap if shape is None else memmap[tuple(shape)]
         with h5py.File(self.file_path, 'r') as f:
             dataset = f[data_path]
             if dataset.shape == ():  # スカラー(単一値)の場合
@@ -166,11 +240,11 @@ class HDF5Reader(HDF5):
             # HDF5ファイルの中身を再帰的に探索
             f.visititems(print_structure)
 
-    def create_fetcher(self, query: str):
+    def create_fetcher(self, query: str, use_memmap: bool = False):
         """
         queryを使ってHDFDataFetcherオブジェクトを作成し、検索したデータパスに基づいて返す
         """
-        fetcher = HDFDataFetcher(file_path=self.file_path)
+        fetcher = HDFDataFetcher(file_path=self.file_path, use_memmap=use_memmap)
         fetcher.set_data_path(query=query)
         return fetcher
 
@@ -178,15 +252,18 @@ class HDF5Reader(HDF5):
 class HDFDataFetcher:
     """
     data_pathを備えさせることで、そのデータを簡単に呼び出せるようにする
+    use_memmap=True なら、chunkなし・圧縮なしのデータセットは np.memmap で読むので、呼ぶたびにファイルを開いたりコピーしたりしない
     """
-    def __init__(self, file_path: str, data_path: str = None):
+    def __init__(self, file_path: str, data_path: str = None, use_memmap: bool = False):
         """
         file_path: HDF5ファイルのパス
         data_path: 初期化時に指定するHDF5ファイル内のデータセットのパス
+        use_memmap: memmapにできるデータセットは、読み込み専用の np.memmap の一部 (view) を返す
         """
         self.file_path = file_path
         self.data_path = data_path
         self.dataset_shape = None
+        self._memmaps = MemmapCache(file_path) if use_memmap else None
         self.path_list = self._get_all_dataset_paths()
 
         if data_path:
@@ -221,10 +298,24 @@ class HDFDataFetcher:
         if frame >= self.dataset_shape[0]:
             raise IndexError(f"指定されたframe {frame} は範囲外です (最大: {self.dataset_shape[0] - 1})。")
 
-        # 指定されたframeのデータを取得
+        return self.fetch(frame)
+
+    def fetch(self, selection):
+        """
+        データセットの一部を返す。selection は dataset[selection] と同じ (np.s_[:, 10:20, 30:40] などでROI・時系列を取り出す)
+        memmapにできるデータセットなら、コピーせずに読み込み専用の view を返す
+        """
+        if self.dataset_shape is None:
+            raise RuntimeError("データセットのshapeが初期化されていません。")
+        memmap = self._memmaps.get(self.data_path) if self._memmaps is not None else None
+        if memmap is not None:
+            return memmap[selection]
         with h5py.File(self.file_path, 'r') as f:
-            dataset = f[self.data_path]
-            return dataset[frame]  # frameの部分だけを返す
+            return f[self.data_path][selection]
+
+    def is_memmapped(self) -> bool:
+        """ 今のdata_pathを memmap で読んでいるか """
+        return self._memmaps is not None and self.data_path is not None and self._memmaps.get(self.data_path) is not None
 
     def get_shape(self):
         """データセットの形状を返す"""
@@ -237,6 +328,7 @@ class HDFDataFetcher:
         for path in self.path_list:
             if query in path:
                 result_list.append(path)
+        result_list = _narrow_to_exact_match(result_list, query)
 
         if len(result_list) == 1:
             result = result_list[0]
@@ -0,0 +1,177 @@
+"""
+pyFAIの積算方法(method)を実際のframeで測り、1D・2Dそれぞれで一番速いものを選ぶクラス
+
+候補は pyFAI のレジストリにある方法のうち、画素分割(split)が同じもの全て。
+histogram (cython), CSR / CSC / LUT (cython, python), OpenCL (GPUに加えて pocl などのCPUデバイスも) が入る。
+画素分割が変わると結果が変わる(ピークが鋭いと数十%)ので、splitは固定し、
+さらに基準の方法 (pyFAIのデフォルト) と結果が一致しない方法は選ばない。
+OpenCLが無いPCでは、cythonなどCPUの方法だけから選ばれる。
+
+選んだ結果は 検出器のshape・.poniの中身・分割数 をキーにしてJSONに保存し、同じ条件では測り直さない。
+
+    tuner = MethodTuner()
+    tuner.apply(xrd) # 保存済みならそれを、無ければ測って xrd.set_methods() する
+"""
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+import pyFAI
+from pyFAI.method_registry import IntegrationMethod
+
+
+class MethodTuner:
+    DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'XRDSpotAnalyzer', 'method_tuning.json')
+    # pyFAIのデフォルト (integrate1d, integrate2d の method)。結果が一致するかの基準にする
+    REFERENCE_METHOD = ('bbox', 'csr', 'cython')
+    # 基準との差の許容量 (基準の強度の最大値に対する割合)。float32の計算順の違いくらいは許す
+    RTOL = 1e-5
+
+    def __init__(self, cache_path: str = None, split: str = 'bbox', sample_frames: int = 3, repeat: int = 2):
+        """
+        cache_path: 選んだ方法を保存するJSON。Noneなら DEFAULT_PATH
+        split: 画素分割の方法。'bbox' (pyFAIのデフォルト) 以外にすると、結果自体が変わるので注意
+        sample_frames: 測るのに使うframe数
+        repeat: 1frameあたり何回測るか (中央値を使う)
+        """
+        self.cache_path = cache_path if cache_path is not None else self.DEFAULT_PATH
+        self.split = split
+        self.sample_frames = sample_frames
+        self.repeat = repeat
+
+    """ 使う側 """
+    def apply(self, xrd, retune: bool = False) -> dict:
+        """ xrdに一番速い方法を設定する。保存済みの結果があれば測らない (retune=True なら測り直す) """
+        key = self.key_for(xrd)
+        cached = self._read_cache()
+        if not retune and key in cached:
+            choice = cached[key]
+            print(f"保存済みの積算方法を使います: 1D {choice['method_1d']}, 2D {choice['method_2d']}")
+        else:
+            choice = self.tune(xrd)
+            cached = self._read_cache() # 測っている間に他のプロセスが書き込んでいるかもしれない
+            cached[key] = choice
+            self._write_cache(cached)
+        xrd.set_methods(method_1d=choice['method_1d'], method_2d=choice['method_2d'])
+        return choice
+
+    def key_for(self, xrd) -> str:
+        key_source = {
+            'shape': list(xrd.ai.detector.max_shape),
+            'poni_sha1': xrd.sha1_of_file(xrd.poni_path),
+            'npt_tth': xrd.npt_tth,
+            'npt_azi': xrd.npt_azi,
+            'split': self.split,
+            'pyFAI': pyFAI.version, # バージョンが変わると速さも変わりうる
+        }
+        return hashlib.sha1(json.dumps(key_source, sort_keys=True).encode()).hexdigest()
+
+    """ 測定 """
+    def tune(self, xrd) -> dict:
+        frames = self._sample_frames(xrd)
+        frame_data = [xrd._read_frame_data(frame) for frame in frames]
+        choice = {'tuned_at': time.strftime('%Y-%m-%d %H:%M:%S'), 'frames': frames}
+        for dim in (1, 2):
+            timings = self._time_methods(xrd, dim, frame_data)
+            valid = {name: timing for name, timing in timings.items() if timing.get('seconds') is not None}
+            best = min(valid, key=lambda name: valid[name]['seconds'])
+            choice[f'method_{dim}d'] = valid[best]['method']
+            choice[f'timings_{dim}d'] = timings
+            print(f"{dim}D: {best} を使います ({valid[best]['seconds'] * 1e3:.2f} ms/frame)")
+        xrd.ai.reset_engines() # 選ばれなかった方法の疎行列などを捨てる。使う方法のものは最初の積算で作り直される
+        return choice
+
+    def _time_methods(self, xrd, dim: int, frame_data: list) -> dict:
+        """ {名前: {'method', 'setup_seconds', 'seconds' (1frameあたりの中央値, 使えなければNone), 'error'}} """
+        timings = {}
+        reference = None
+        for method in self.candidates(dim):
+            name = self.method_name(method)
+            integrate = self._integrate_function(xrd, dim, self.resolve(method, dim))
+            try:
+                # 1回目は疎行列の作成などの準備が入るので、別に測る
+                start = time.perf_counter()
+                intensity = integrate(frame_data[0])
+                setup_seconds = time.perf_counter() - start
+                seconds = []
+                for data in frame_data:
+                    for _ in range(self.repeat):
+                        start = time.perf_counter()
+                        integrate(data)
+                        seconds.append(time.perf_counter() - start)
+            except Exception as e: # OpenCLのデバイスによっては、対応していない方法でエラーになる
+                timings[name] = {'method': method, 'seconds': None, 'error': str(e)}
+                print(f"{dim}D {name}: 使えません ({e})")
+                continue
+            if reference is None:
+                reference = intensity
+            error = float(np.abs(intensity - reference).max() / max(np.abs(reference).max(), 1e-30))
+            timings[name] = {
+                'method': method,
+                'setup_seconds': setup_seconds,
+                'seconds': float(np.median(seconds)) if error <= self.RTOL else None,
+                'max_relative_error': error,
+            }
+            print(f"{dim}D {name}: 準備 {setup_seconds:.2f} s, {np.median(seconds) * 1e3:.2f} ms/frame (基準との差 {error:.1e})")
+        return timings
+
+    @staticmethod
+    def _integrate_function(xrd, dim: int, method):
+        if dim == 1:
+            return lambda data: xrd.ai.integrate1d(data, npt=xrd.npt_tth, unit="2th_deg", method=method).intensity
+        return lambda data: xrd.ai.integrate2d(data, npt_rad=xrd.npt_tth, npt_azim=xrd.npt_azi,
+                                               unit="2th_deg", method=method).intensity
+
+    def _sample_frames(self, xrd) -> list:
+        """ 全体から均等に選ぶ。最初のframeは使わないことがあるので (XRD._read_frame_data) 避ける """
+        first = 1 if xrd.frame_num > 1 else 0
+        return sorted({int(frame) for frame in np.linspace(first, xrd.frame_num - 1, self.sample_frames)})
+
+    """ 方法の表し方 """
+    def candidates(self, dim: int) -> list:
+        """
+        [split, algo, impl, target] のリスト。最初が基準の方法になるように並べる
+        targetはOpenCLの (platform, device) 番号。それ以外はNone
+        """
+        methods = []
+        for method in IntegrationMethod.select_method(dim=dim, split=self.split, degradable=False):
+            target = list(method.target) if method.target is not None else None
+            methods.append([method.split_lower, method.algo_lower, method.impl_lower, target])
+        reference = [*self.REFERENCE_METHOD, None]
+        if self.split == self.REFERENCE_METHOD[0] and reference in methods:
+            methods.remove(reference)
+            methods.insert(0, reference)
+        return methods
+
+    @staticmethod
+    def resolve(method, dim: int):
+        """ 保存用の [split, algo, impl, target] を、pyFAIの method= に渡せる形にする。Noneならデフォルト """
+        if method is None:
+            return MethodTuner.REFERENCE_METHOD
+        split, algo, impl, target = method
+        if target is None:
+            return (split, algo, impl)
+        return IntegrationMethod.select_method(dim=dim, split=split, algo=algo, impl=impl, target=tuple(target))[0]
+
+    @staticmethod
+    def method_name(method) -> str:
+        if method is None:
+            return '/'.join(MethodTuner.REFERENCE_METHOD)
+        split, algo, impl, target = method
+        return f"{split}/{algo}/{impl}" + (f"@{target[0]},{target[1]}" if target is not None else '')
+
+    """ 保存 """
+    def _read_cache(self) -> dict:
+        if not os.path.exists(self.cache_path):
+            return {}
+        with open(self.cache_path, 'r') as f:
+            return json.load(f)
+
+    def _write_cache(self, cached: dict):
+        os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)), exist_ok=True)
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(cached, f, indent=2)
+        os.replace(tmp_path, self.cache_path) # 書き込み途中で落ちても壊れないように
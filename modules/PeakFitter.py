@@ -0,0 +1,233 @@
+"""
+再積算した2θパターン (frame, bin) の全frameに、ピークの関数 + 直線の背景 をまとめてフィッティングするクラス
+
+Levenberg-Marquardt法を、frameの方向にベクトル化して行う。
+各frameのヤコビ行列 (frame, bin, パラメータ) から J^T J を einsum で作り、(frame, p, p) の連立方程式を1回で解く。
+減衰係数 λ はframeごとに持つので、frameごとに普通のLM法と同じ動きになる (収束したframeは以降の計算から外す)。
+
+初期値は各frameのパターン (最大値の位置・2次モーメント) から求める。
+収束しなかったframeは、直前の収束したframeの解を初期値 (warm start) にしてもう一度フィッティングする。
+(frameごとに順番にフィッティングすると、Pythonのループが frame数 x 反復回数 になって遅いので、
+ まず全frameを独立に解き、必要なframeだけ前のframeの解から解き直す)
+
+誤差は共分散行列 (J^T J)^-1 x 残差の分散 の対角成分の平方根 (scipy.optimize.curve_fit の absolute_sigma=False と同じ)。
+
+    result = PeakFitter('pseudo_voigt').fit(tth_axis, tth_pattern)
+    result['center'], result['center_err'] # (frame,)
+"""
+import numpy as np
+
+# FWHM = 1 のときの面積 / 高さ
+_GAUSSIAN_AREA = np.sqrt(np.pi / (4 * np.log(2)))
+_LORENTZIAN_AREA = np.pi / 2
+_FOUR_LN2 = 4 * np.log(2)
+
+
+class PeakFitter:
+    MODELS = {
+        'gaussian': ('amplitude', 'center', 'fwhm', 'background', 'slope'),
+        'pseudo_voigt': ('amplitude', 'center', 'fwhm', 'eta', 'background', 'slope'),
+    }
+    # 1ブロックのヤコビ行列 (frame, bin, パラメータ) の大きさの目安
+    BLOCK_BYTES = 64 * 1024**2
+    # 残差の分散が、収束したframeの中央値のこの倍数を超えたframeは前のframeの解から解き直す
+    RETRY_CHI2_RATIO = 10.0
+
+    def __init__(self, model: str = 'pseudo_voigt', max_iter: int = 100, tolerance: float = 1e-8):
+        """
+        model: 'gaussian' または 'pseudo_voigt' (ガウス関数とローレンツ関数の和。eta がローレンツ関数の割合)
+        tolerance: 残差の二乗和の相対的な変化がこれより小さくなったら収束とする
+        """
+        if model not in self.MODELS:
+            raise ValueError(f"model は {', '.join(self.MODELS)} のどれかです: {model}")
+        self.model = model
+        self.param_names = self.MODELS[model]
+        self.max_iter = max_iter
+        self.tolerance = tolerance
+
+    def fit(self, x: np.ndarray, patterns: np.ndarray) -> dict:
+        """
+        x: (bin,) 2θ
+        patterns: (frame, bin)
+        {パラメータ名: (frame,), パラメータ名_err: (frame,), 'area', 'area_err', 'chi2' (残差の分散), 'converged'} を返す
+        値が有限でないframe・平らなframeは NaN, converged=False になる
+        """
+        x = np.asarray(x, dtype=np.float64)
+        patterns = np.asarray(patterns, dtype=np.float64)
+        frame_num, param_num = len(patterns), len(self.param_names)
+        params = np.full((frame_num, param_num), np.nan)
+        errors = np.full((frame_num, param_num), np.nan)
+        chi2 = np.full(frame_num, np.nan)
+        converged = np.zeros(frame_num, dtype=bool)
+
+        valid = np.isfinite(patterns).all(axis=1) & (np.ptp(patterns, axis=1) > 0)
+        block_frames = max(1, self.BLOCK_BYTES // (len(x) * param_num * 8))
+        valid_frames = np.flatnonzero(valid)
+        for start in range(0, len(valid_frames), block_frames):
+            block = valid_frames[start:start + block_frames]
+            params[block], errors[block], chi2[block], converged[block] = self._fit_block(
+                x, patterns[block], self._initial_params(x, patterns[block])
+            )
+
+        # 収束しなかったframe・残差が他より桁違いに大きいframe (別の極小に落ちた) は、
+        # その前で最後にうまくいったframeの解から解き直す
+        suspicious = converged & (chi2 > self.RETRY_CHI2_RATIO * np.median(chi2[converged])) if converged.any() else converged
+        good = converged & ~suspicious
+        retry = np.flatnonzero(valid & ~good)
+        previous = np.maximum.accumulate(np.where(good, np.arange(frame_num), -1))[retry - 1] if len(retry) else retry
+        has_previous = (retry > 0) & (previous >= 0)
+        retry, previous = retry[has_previous], previous[has_previous]
+        if len(retry):
+            retry_result = self._fit_block(x, patterns[retry], params[previous])
+            # 収束して、残差が小さくなった (または初めて収束した) ときだけ置き換える
+            better = retry_result[3] & (~converged[retry] | (retry_result[2] < chi2[retry]))
+            for values, retried in zip((params, errors, chi2, converged), retry_result):
+                values[retry[better]] = retried[better]
+
+        result = {name: params[:, i] for i, name in enumerate(self.param_names)}
+        result.update({f'{name}_err': errors[:, i] for i, name in enumerate(self.param_names)})
+        result['area'], result['area_err'] = self._area(params, errors)
+        result['chi2'] = chi2
+        result['converged'] = converged
+        print(f"{self.model}: {converged.sum()}/{frame_num} frame が収束しました。")
+        return result
+
+    """ モデル """
+    def _split(self, params: np.ndarray) -> tuple:
+        """ (frame, p) -> amplitude, center, fwhm, eta, background, slope (それぞれ (frame, 1)) """
+        columns = [params[:, i:i + 1] for i in range(params.shape[1])]
+        if self.model == 'gaussian':
+            columns.insert(3, np.zeros_like(columns[0]))
+        return columns
+
+    def _evaluate(self, x: np.ndarray, params: np.ndarray, with_jacobian: bool = True) -> tuple:
+        """ (frame, bin) のモデルの値と、(frame, bin, p) のヤコビ行列 """
+        amplitude, center, fwhm, eta, background, slope = self._split(params)
+        dx = x[None, :] - center
+        u2 = (dx / fwhm) ** 2
+        gaussian = np.exp(-_FOUR_LN2 * u2)
+        lorentzian = 1 / (1 + 4 * u2)
+        profile = eta * lorentzian + (1 - eta) * gaussian
+        x_offset = x - self._x_mid(x)
+        model = amplitude * profile + background + slope * x_offset
+        if not with_jacobian:
+            return model, None
+        # d(profile)/d(center), d(profile)/d(fwhm)
+        d_gaussian = 2 * _FOUR_LN2 * gaussian
+        d_lorentzian = 8 * lorentzian ** 2
+        d_center = amplitude * (eta * d_lorentzian + (1 - eta) * d_gaussian) * dx / fwhm ** 2
+        d_fwhm = amplitude * (eta * d_lorentzian + (1 - eta) * d_gaussian) * u2 / fwhm
+        columns = [profile, d_center, d_fwhm]
+        if self.model == 'pseudo_voigt':
+            columns.append(amplitude * (lorentzian - gaussian))
+        columns += [np.ones_like(model), np.broadcast_to(x_offset, model.shape)]
+        return model, np.stack(columns, axis=-1)
+
+    @staticmethod
+    def _x_mid(x: np.ndarray) -> float:
+        """ 背景の傾きの基準点。パラメータ同士の相関を小さくするため、範囲の中央にする """
+        return (x[0] + x[-1]) / 2
+
+    def _area(self, params: np.ndarray, errors: np.ndarray) -> tuple:
+        """ ピークの面積 (背景を除く) と、その誤差 (amplitude, fwhm, eta の誤差から。相関は無視する) """
+        amplitude, _, fwhm, eta, _, _ = (column[:, 0] for column in self._split(params))
+        shape_factor = eta * _LORENTZIAN_AREA + (1 - eta) * _GAUSSIAN_AREA
+        area = amplitude * fwhm * shape_factor
+        amplitude_err, fwhm_err = errors[:, 0], errors[:, 2]
+        variance = (fwhm * shape_factor * amplitude_err) ** 2 + (amplitude * shape_factor * fwhm_err) ** 2
+        if self.model == 'pseudo_voigt':
+            variance += (amplitude * fwhm * (_LORENTZIAN_AREA - _GAUSSIAN_AREA) * errors[:, 3]) ** 2
+        return area, np.sqrt(variance)
+
+    """ 初期値 """
+    def _initial_params(self, x: np.ndarray, patterns: np.ndarray) -> np.ndarray:
+        """ 両端を結んだ直線を背景とし、背景を引いたパターンの最大値・2次モーメントから求める """
+        edge = max(1, len(x) // 10)
+        left, right = patterns[:, :edge].mean(axis=1), patterns[:, -edge:].mean(axis=1)
+        x_left, x_right = x[:edge].mean(), x[-edge:].mean()
+        slope = (right - left) / (x_right - x_left)
+        background = left + slope * (self._x_mid(x) - x_left)
+        signal = patterns - (background[:, None] + slope[:, None] * (x - self._x_mid(x)))
+        peak_idx = signal.argmax(axis=1)
+        amplitude = signal[np.arange(len(patterns)), peak_idx]
+        center = x[peak_idx]
+        weight = np.clip(signal, 0, None)
+        sigma = np.sqrt((weight * (x - center[:, None]) ** 2).sum(axis=1) / np.maximum(weight.sum(axis=1), 1e-30))
+        bin_width = np.abs(np.diff(x)).mean()
+        fwhm = np.clip(2.3548 * sigma, 2 * bin_width, np.ptp(x))
+        columns = [amplitude, center, fwhm]
+        if self.model == 'pseudo_voigt':
+            columns.append(np.full(len(patterns), 0.5))
+        columns += [background, slope]
+        return np.column_stack(columns)
+
+    """ Levenberg-Marquardt """
+    def _fit_block(self, x: np.ndarray, patterns: np.ndarray, params: np.ndarray) -> tuple:
+        params = params.copy()
+        frame_num, param_num = params.shape
+        model, _ = self._evaluate(x, params, with_jacobian=False)
+        chi2 = ((patterns - model) ** 2).sum(axis=1)
+        lam = np.full(frame_num, 1e-3)
+        converged = np.zeros(frame_num, dtype=bool)
+        active = np.arange(frame_num)
+        for _ in range(self.max_iter):
+            if len(active) == 0:
+                break
+            model, jacobian = self._evaluate(x, params[active])
+            residual = patterns[active] - model
+            gradient = np.einsum('fni,fn->fi', jacobian, residual)
+            # 範囲の端にあって、さらに外に出ようとしているパラメータは動かさない (そのframeの残りのパラメータだけで解く)
+            frozen = self._frozen(params[active], gradient)
+            if frozen.any():
+                jacobian = np.where(frozen[:, None, :], 0.0, jacobian)
+                gradient = np.where(frozen, 0.0, gradient)
+            jtj = np.einsum('fni,fnj->fij', jacobian, jacobian)
+            diagonal = np.einsum('fii->fi', jtj)
+            damped = jtj + (lam[active, None] * (diagonal + 1e-12 * diagonal.max(axis=1, keepdims=True)))[:, :, None] * np.eye(param_num)
+            try:
+                step = np.linalg.solve(damped, gradient[..., None])[..., 0]
+            except np.linalg.LinAlgError:
+                step = np.einsum('fij,fj->fi', np.linalg.pinv(damped), gradient)
+            trial = self._constrain(x, params[active] + step)
+            trial_model, _ = self._evaluate(x, trial, with_jacobian=False)
+            trial_chi2 = ((patterns[active] - trial_model) ** 2).sum(axis=1)
+
+            improved = trial_chi2 < chi2[active]
+            accepted = active[improved]
+            change = (chi2[accepted] - trial_chi2[improved]) / np.maximum(chi2[accepted], 1e-300)
+            params[accepted] = trial[improved]
+            chi2[accepted] = trial_chi2[improved]
+            lam[accepted] = np.maximum(lam[accepted] / 10, 1e-12)
+            lam[active[~improved]] *= 10
+            # 良くなった幅が十分小さい、または λ が大きくなりすぎた (これ以上良くならない) ら終わり
+            converged[accepted[change < self.tolerance]] = True
+            converged[active[~improved & (lam[active] > 1e10)]] = True
+            active = active[~converged[active]]
+        converged[active] = False
+
+        # 誤差: (J^T J)^-1 x 残差の分散
+        _, jacobian = self._evaluate(x, params)
+        jtj = np.einsum('fni,fnj->fij', jacobian, jacobian)
+        dof = max(1, len(x) - param_num)
+        variance = chi2 / dof
+        covariance = np.linalg.pinv(jtj) * variance[:, None, None]
+        errors = np.sqrt(np.clip(np.einsum('fii->fi', covariance), 0, None))
+        # 範囲の外に出たピーク・幅が範囲より広いピークは収束していない扱いにする
+        _, center, fwhm, _, _, _ = (column[:, 0] for column in self._split(params))
+        converged &= (center >= x.min()) & (center <= x.max()) & (fwhm < 2 * np.ptp(x))
+        return params, errors, variance, converged
+
+    def _frozen(self, params: np.ndarray, gradient: np.ndarray) -> np.ndarray:
+        """ (frame, p) のうち、eta が 0 または 1 にあって外向きに動こうとしているもの """
+        frozen = np.zeros(params.shape, dtype=bool)
+        if self.model == 'pseudo_voigt':
+            frozen[:, 3] = ((params[:, 3] <= 0) & (gradient[:, 3] < 0)) | ((params[:, 3] >= 1) & (gradient[:, 3] > 0))
+        return frozen
+
+    def _constrain(self, x: np.ndarray, params: np.ndarray) -> np.ndarray:
+        """ fwhm は正 (binの幅の1/10以上)、eta は 0-1 に収める """
+        bin_width = np.abs(np.diff(x)).mean()
+        params[:, 2] = np.maximum(params[:, 2], bin_width / 10)
+        if self.model == 'pseudo_voigt':
+            params[:, 3] = np.clip(params[:, 3], 0, 1)
+        return params
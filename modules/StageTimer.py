@@ -0,0 +1,144 @@
+"""
+処理の段階(生データの読み込み・pyFAIの積算・HDF5への書き込みなど)ごとに、時間と移動したbyte数を集計するクラス
+
+1回ごとの時間は対数のbinのヒストグラムに入れるので、回数が多くてもメモリは増えない。
+report() で機械が読める形(dict)にまとめて、tmp.hdfに保存したり画面に表示したりする。
+複数のスレッド (CakePipeline) から同時に記録してもよい。
+"""
+import cProfile
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class _StageRecord:
+    """ stage() の中で移動したbyte数を設定するためのもの """
+    def __init__(self):
+        self.nbytes = 0
+
+
+class StageTimer:
+    # 1回あたりの時間のヒストグラムのbinの境界 (1 µs から 100 s まで、対数で等間隔)
+    HISTOGRAM_EDGES = np.logspace(-6, 2, 41)
+
+    def __init__(self):
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str, nbytes: int = 0):
+        """
+        with timer.stage('read_frame') as record:
+            ...
+            record.nbytes = data.nbytes # 後から分かる場合はここで設定する
+        """
+        record = _StageRecord()
+        record.nbytes = nbytes
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            self.add(name, time.perf_counter() - start, record.nbytes)
+
+    def add(self, name: str, seconds: float, nbytes: int = 0):
+        with self._lock:
+            self._add(name, seconds, nbytes)
+
+    def _add(self, name: str, seconds: float, nbytes: int):
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = {
+                'count': 0, 'seconds': 0.0, 'bytes': 0,
+                'min_seconds': float('inf'), 'max_seconds': 0.0,
+                'histogram': [0] * (len(self.HISTOGRAM_EDGES) + 1),
+            }
+        stage['count'] += 1
+        stage['seconds'] += seconds
+        stage['bytes'] += int(nbytes)
+        stage['min_seconds'] = min(stage['min_seconds'], seconds)
+        stage['max_seconds'] = max(stage['max_seconds'], seconds)
+        stage['histogram'][int(np.searchsorted(self.HISTOGRAM_EDGES, seconds))] += 1
+
+    def merge(self, stages: dict):
+        """ 別のStageTimer(他のプロセスなど)の stages を足し合わせる """
+        with self._lock:
+            self._merge(stages)
+
+    def _merge(self, stages: dict):
+        for name, other in stages.items():
+            stage = self.stages.get(name)
+            if stage is None:
+                self.stages[name] = {**other, 'histogram': list(other['histogram'])}
+                continue
+            for key in ('count', 'seconds', 'bytes'):
+                stage[key] += other[key]
+            stage['min_seconds'] = min(stage['min_seconds'], other['min_seconds'])
+            stage['max_seconds'] = max(stage['max_seconds'], other['max_seconds'])
+            stage['histogram'] = [a + b for a, b in zip(stage['histogram'], other['histogram'])]
+
+    def pop_stages(self) -> dict:
+        """ 今までの集計を返して、空に戻す。プロセスプールのworkerから1回分ずつ送るのに使う """
+        with self._lock:
+            stages, self.stages = self.stages, {}
+        return stages
+
+    def _percentile(self, stage: dict, q: float) -> float:
+        """ ヒストグラムから求めた近似のパーセンタイル (binの上端) """
+        cumulative = np.cumsum(stage['histogram'])
+        idx = int(np.searchsorted(cumulative, q / 100 * cumulative[-1]))
+        edges = np.append(self.HISTOGRAM_EDGES, np.inf)
+        return float(min(edges[idx], stage['max_seconds']))
+
+    def report(self) -> dict:
+        """ stageごとの合計・平均・パーセンタイル・転送速度 """
+        report = {}
+        with self._lock:
+            stages = {name: dict(stage) for name, stage in self.stages.items()}
+        for name, stage in stages.items():
+            report[name] = {
+                'count': stage['count'],
+                'total_seconds': stage['seconds'],
+                'mean_seconds': stage['seconds'] / stage['count'],
+                'min_seconds': stage['min_seconds'],
+                'p50_seconds': self._percentile(stage, 50),
+                'p95_seconds': self._percentile(stage, 95),
+                'max_seconds': stage['max_seconds'],
+                'bytes': stage['bytes'],
+                'MB_per_s': stage['bytes'] / 1e6 / stage['seconds'] if stage['seconds'] else 0.0,
+                'histogram_edges_seconds': self.HISTOGRAM_EDGES.tolist(),
+                'histogram': stage['histogram'],
+            }
+        return report
+
+    def summary(self) -> str:
+        lines = []
+        for name, stage in self.report().items():
+            lines.append(
+                f"{name:<16} {stage['count']:>7} 回  合計 {stage['total_seconds']:8.2f} s  "
+                f"平均 {stage['mean_seconds'] * 1e3:8.2f} ms  p95 {stage['p95_seconds'] * 1e3:8.2f} ms  "
+                f"{stage['MB_per_s']:8.1f} MB/s"
+            )
+        return '\n'.join(lines)
+
+
+@contextmanager
+def profiled(output_path: str = None):
+    """
+    詳しく調べたいときだけ使う。with の中を cProfile で計測し、output_path に保存する (snakeviz などで見られる)
+    output_path が None なら何もしない
+    """
+    if output_path is None:
+        yield None
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        profiler.dump_stats(output_path)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+        print(f"プロファイル結果を保存しました: {output_path}")
@@ -1,60 +1,199 @@
 """
 nxsとponiを読み込んで，積算・cakingされたデータを返す
 """
+import hashlib
 import os
 import numpy as np
 
 import h5py
 import pyFAI
 import pyopencl as cl
+from modules.FrameSource import FrameSource
 from modules.HDF5 import HDF5Reader
+from modules.MethodTuner import MethodTuner
+from modules.StageTimer import StageTimer
 
 
 class XRD:
+    # describe_params に入れない設定。積算結果は変わらないので、変えても途中から再開できるようにする
+    #   swmr: ファイルの開き方だけ。method_1d, method_2d: MethodTuner は基準と結果が一致する方法しか選ばない (set_methods)
+    CONFIG_EXCLUDED_FROM_PARAMS = ('swmr', 'method_1d', 'method_2d')
+
     def __init__(self,
                  xrd_path=None, poni_path=None, mask_path=None,
-                 npt_tth=1_000, npt_azi=1_000):
+                 npt_tth=1_000, npt_azi=1_000, swmr=False,
+                 method_1d=None, method_2d=None, frame_range=None):
+        # 検出器が書き込み中のファイルを読む(ライブ処理)場合はTrue。ファイルは全てSWMR読み込みで開く
+        self.swmr = swmr
+        # (from_frame, to_frame) を指定すると、その範囲だけを frame 0, 1, ... として扱う (分割して積算する場合。ShardedCaking)
+        self.frame_range = None
         # ファイル別に処理
         if xrd_path.endswith('.hdf'):
-            self.hdf = HDF5Reader(xrd_path)
-            # TODO: 少なくともframe数は必要。.nxs と同じに self.frame_num を設定
-            raise NotImplementedError('実装中')
+            self.hdf_path = xrd_path
+            self.hdf = HDF5Reader(xrd_path, swmr=swmr)
+            self.data_path_to_frames = self._find_frames_path_in_hdf() # 決まったpathが無いので、3次元のデータセットを探す
+            self._read_params_from_hdf()
         elif xrd_path.endswith('.nxs'):
             self.nxs_path = xrd_path
-            self.nxs = HDF5Reader(xrd_path)
+            self.nxs = HDF5Reader(xrd_path, swmr=swmr)
             self.data_path_to_detector = "/entry/instrument/detector"  # hdfとしてのデータまでのpath
+            self.data_path_to_frames = os.path.join(self.data_path_to_detector, 'data')
             self._read_params_from_nxs()
         else:
             raise NotImplementedError('.nxs, .hdfのみが実装されています。')
         # 共通処理
         self.gpu_available = self._check_opencl_support() # OpenCL が利用可能か確認。GPUを使えるか
         self.xrd_path = xrd_path # 保存しておく。他のメソッドで拡張子判断するときに使う
+        self.poni_path = poni_path # 並列処理のworkerで同じintegratorを作り直すために保存しておく
+        self.frame_source = None # open_frame_source() している間だけファイルを開きっぱなしにする
+        self.timer = StageTimer() # 読み込み・積算にかかった時間を集計する
         self._create_integrator(poni_path) # AzimuthalIntegratorを作成する
         self.npt_tth = npt_tth
         self.npt_azi = npt_azi
+        # pyFAIの積算方法。[split, algo, impl, target] (MethodTuner で選ぶ)。Noneならデフォルト
+        self.set_methods(method_1d=method_1d, method_2d=method_2d)
         # maskの設定(なくても良い)
+        self.mask_path = None
         if mask_path is not None:
             self.set_mask(mask_path=mask_path)
+        if frame_range is not None:
+            self.set_frame_range(*frame_range)
 
-    """ 拡張子別に実装 """
+    """ 共通 """
+    def to_config(self) -> dict:
+        """
+        同じ設定のXRDを作り直すための引数を返す。XRD(**config) で復元できる
+        (別プロセスにはpyFAIのintegratorをそのまま渡せないため、pathと分割数だけを渡す)
+        """
+        config = {
+            'xrd_path': self.xrd_path,
+            'poni_path': self.poni_path,
+            'mask_path': self.mask_path,
+            'npt_tth': self.npt_tth,
+            'npt_azi': self.npt_azi,
+            'swmr': self.swmr,
+            'method_1d': self.method_1d,
+            'method_2d': self.method_2d,
+        }
+        # 範囲を絞っていないときは入れない (describe_params が変わって、今までのtmp.hdfが再開できなくなるため)
+        if self.frame_range is not None:
+            config['frame_range'] = self.frame_range
+        return config
+
+    """ 共通 """
+    def set_frame_range(self, from_frame: int, to_frame: int):
+        """
+        生データの from_frame から to_frame の手前までを、frame 0 から frame_num - 1 として扱う
+        frame_num はこの範囲のframe数になる。生データ全体のframe数は total_frame_num に残す
+        """
+        total_frame_num = self.total_frame_num if self.frame_range is not None else self.frame_num
+        if not 0 <= from_frame < to_frame <= total_frame_num:
+            raise ValueError(f"frameの範囲が無効です: {from_frame} - {to_frame} (全体: {total_frame_num} frame)")
+        self.total_frame_num = total_frame_num
+        self.frame_range = (int(from_frame), int(to_frame))
+        self.frame_num = to_frame - from_frame
+
+    """ 共通 """
+    def describe_params(self) -> dict:
+        """
+        積算結果を決めるパラメータを返す。途中から再開するときに、前回と同じ条件かどうかの確認に使う
+        生データはサイズと更新時刻、.poni・maskは中身のハッシュで区別する
+        to_config のうち、積算結果を変えないもの (CONFIG_EXCLUDED_FROM_PARAMS) は入れない
+        """
+        xrd_stat = os.stat(self.xrd_path)
+        config = {key: value for key, value in self.to_config().items() if key not in self.CONFIG_EXCLUDED_FROM_PARAMS}
+        return {
+            **config,
+            'xrd_size': xrd_stat.st_size,
+            'xrd_mtime_ns': xrd_stat.st_mtime_ns,
+            'poni_sha1': self.sha1_of_file(self.poni_path),
+            'mask_sha1': self.sha1_of_file(self.mask_path) if self.mask_path is not None else None,
+        }
+
+    @staticmethod
+    def sha1_of_file(path) -> str:
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    """ 共通 """
     def _read_frame_data(self, frame):
+        with self.timer.stage('read_frame') as record:
+            frame_data = self._read_frame_data_by_type(frame)
+            record.nbytes = frame_data.nbytes
+        return frame_data
+
+    """ 拡張子別に実装 """
+    def _read_frame_data_by_type(self, frame):
+        total_frame_num = self.frame_num
+        if self.frame_range is not None: # 範囲の中のframe番号から、生データのframe番号にする
+            frame, total_frame_num = frame + self.frame_range[0], self.total_frame_num
         if self.xrd_path.endswith('.nxs'):
             # 複数の露光データがあるとき、最初のframeを飛ばす。使い物にならないときがある&重要でないことが多いため。
-            if frame == 0 and self.frame_num > 1:
+            if frame == 0 and total_frame_num > 1:
                 frame = 1
-            with h5py.File(self.xrd_path, 'r') as f:
-                frame_data = f[os.path.join(self.data_path_to_detector, 'data')][frame, :, :]
-        elif self.xrd_path.endswith('.hdf'):
-            raise NotImplementedError('実装してください')
+        # .nxs, .hdf ともに (frame, y, x) のデータセットから読む
+        if self.frame_source is not None:
+            return self.frame_source.read(frame)
+        with h5py.File(self.xrd_path, 'r', swmr=self.swmr) as f:
+            frame_data = f[self.data_path_to_frames][frame, :, :]
         return frame_data
 
+    """ 共通 """
+    def open_frame_source(self, threads: int = None) -> FrameSource:
+        """
+        全frameを処理する前に呼ぶ。close_frame_source() までファイルを開いたままにして、chunk単位でまとめて読み込む
+        threads: 圧縮されたchunkを解凍するスレッド数 (FrameSource)。Noneなら自動
+        """
+        self.close_frame_source()
+        self.frame_source = FrameSource(self.xrd_path, self.data_path_to_frames, swmr=self.swmr, threads=threads)
+        return self.frame_source
+
+    """ 共通 """
+    def close_frame_source(self):
+        if self.frame_source is not None:
+            self.frame_source.close()
+            self.frame_source = None
+
+    """ 共通 """
+    def refresh_frame_num(self) -> int:
+        """
+        書き込み中のファイルに追加されたframeを確認して、self.frame_num を更新する (ライブ処理用)
+        open_frame_source() している間に呼ぶ
+        """
+        self.frame_num = self.frame_source.refresh()
+        return self.frame_num
+
     """ .nxs専用 """
     def _read_params_from_nxs(self):
-        with h5py.File(self.nxs_path, 'r') as f:
-            self.frame_num = f[os.path.join(self.data_path_to_detector, 'data')].shape[0]
+        with h5py.File(self.nxs_path, 'r', swmr=self.swmr) as f:
+            self.frame_num = f[self.data_path_to_frames].shape[0]
             self.exposure_ms = f.get(os.path.join(self.data_path_to_detector, 'count_time'))[0]
         self.fps = 1_000.0 / self.exposure_ms
 
+    """ .hdf専用 """
+    def _find_frames_path_in_hdf(self) -> str:
+        """ 数値の3次元 (frame, y, x) データセットのうち、一番大きいものを検出器のデータとする """
+        candidates = []
+        with h5py.File(self.hdf_path, 'r', swmr=self.swmr) as f:
+            for path in self.hdf.path_list:
+                dataset = f[path]
+                if dataset.ndim == 3 and dataset.dtype.kind in 'uif':
+                    candidates.append((dataset.size, path))
+        if not candidates:
+            raise ValueError(f"(frame, y, x) の3次元データセットが見つかりません: {self.hdf_path}")
+        size, path = max(candidates)
+        if len(candidates) > 1:
+            print(f"3次元データセットが {len(candidates)} 個見つかりました。一番大きい {path} を使います。")
+        return path
+
+    """ .hdf専用 """
+    def _read_params_from_hdf(self):
+        with h5py.File(self.hdf_path, 'r', swmr=self.swmr) as f:
+            self.frame_num = f[self.data_path_to_frames].shape[0]
+        # 露光時間は書かれている場所・単位がファイルによって違うので、読まない
+        self.exposure_ms = None
+        self.fps = None
+
 
     """ 共通 """
     def _create_integrator(self, poni_path):
@@ -73,15 +212,27 @@ class XRD:
     def set_mask(self, *, mask_path=None):
         if mask_path.endswith('.npy'):
             print(f" > Set mask: {mask_path}")
+            self.mask_path = mask_path
             self.ai.mask = np.load(mask_path)
         else:
             raise Exception(f'Mask path {mask_path} not .npy')
 
+    """ 共通 """
+    def set_methods(self, *, method_1d=None, method_2d=None):
+        """
+        積算に使うpyFAIのmethodを設定する。どれを使っても結果は同じで、速さだけが変わる
+        NOTE: describe_params() には含めない。MethodTuner は基準と結果が一致する方法しか選ばないため
+        """
+        self.method_1d = list(method_1d) if method_1d is not None else None
+        self.method_2d = list(method_2d) if method_2d is not None else None
+        self._pyfai_method_1d = MethodTuner.resolve(self.method_1d, dim=1)
+        self._pyfai_method_2d = MethodTuner.resolve(self.method_2d, dim=2)
+
     """ 共通 """
     def get_tth(self):
         try:
             frame_data = self._read_frame_data(0) # 0frame目のデータを読み込む
-            tth, I = self.ai.integrate1d(frame_data, npt=self.npt_tth, unit="2th_deg")
+            tth, I = self.ai.integrate1d(frame_data, npt=self.npt_tth, unit="2th_deg", method=self._pyfai_method_1d)
             return tth
         except Exception as e:
             raise RuntimeError(f"Frame 0 の 1D 積分中にエラーが発生しました: {str(e)}")
@@ -93,7 +244,8 @@ class XRD:
             I, tth, azi = self.ai.integrate2d(frame_data,
                                               npt_rad=self.npt_tth,  # NOTE これはintegrate_1dと揃える
                                               npt_azim=self.npt_azi,
-                                              unit="2th_deg")
+                                              unit="2th_deg",
+                                              method=self._pyfai_method_2d)
             return azi
         except Exception as e:
             raise RuntimeError(f"Frame 0 の 2D 積分中にエラーが発生しました: {str(e)}")
@@ -111,9 +263,7 @@ class XRD:
             : 強度
         """
         try:
-            frame_data = self._read_frame_data(frame)
-            tth, I = self.ai.integrate1d(frame_data, npt=self.npt_tth, unit="2th_deg")
-            return I # tthは別でメソッドを作っている
+            return self.integrate_pattern(self._read_frame_data(frame))
         except Exception as e:
             raise RuntimeError(f"Frame {frame} の 1D 積分中にエラーが発生しました: {str(e)}")
 
@@ -131,17 +281,81 @@ class XRD:
             : 強度
         """
         try:
-            frame_data = self._read_frame_data(frame)
-            # 2D積分を行いcakedデータを取得する
+            return self.integrate_cake(self._read_frame_data(frame))
+        except Exception as e:
+            raise RuntimeError(f"Frame {frame} の 2D 積分中にエラーが発生しました: {str(e)}")
+
+    """ 共通 """
+    def get_pattern_and_caked_data(self, frame):
+        """
+        指定したフレームのデータを1回だけ読み込み、1次元パターンとcakeデータを両方返すメソッド
+        1次元パターンはcakeと同じ2θのbinから作るので、integrate1dをもう1回呼ぶ必要はない
+
+        Parameters:
+        frame (int): 積分するフレームのインデックス
+
+        Returns:
+            : (1次元パターンの強度, cakeの強度)
+        """
+        try:
+            return self.integrate_pattern_and_cake(self._read_frame_data(frame))
+        except Exception as e:
+            raise RuntimeError(f"Frame {frame} の 1D/2D 積分中にエラーが発生しました: {str(e)}")
+
+    # 読み込み済みのframeのデータを積算する。get_* から呼ばれるほか、読み込みと積算を別のスレッドで行う場合 (CakePipeline) に使う
+    """ 共通 """
+    def integrate_pattern(self, frame_data):
+        with self.timer.stage('integrate1d'):
+            tth, I = self.ai.integrate1d(frame_data, npt=self.npt_tth, unit="2th_deg", method=self._pyfai_method_1d)
+        return I # tthは別でメソッドを作っている
+
+    """ 共通 """
+    def integrate_cake(self, frame_data):
+        with self.timer.stage('integrate2d'):
             I, tth, azi = self.ai.integrate2d(frame_data,
                                               npt_rad=self.npt_tth,  # NOTE これはintegrate_1dと揃える
                                               npt_azim=self.npt_azi,
                                               unit="2th_deg",
-                                              # method='ocl' if self.gpu_available else 'cython', # コメントアウトして
-                                              )
+                                              method=self._pyfai_method_2d)
+        return I
+
+    """ 共通 """
+    def integrate_pattern_and_cake(self, frame_data):
+        with self.timer.stage('integrate2d'):
+            result = self.ai.integrate2d(frame_data,
+                                         npt_rad=self.npt_tth,  # NOTE これはintegrate_1dと揃える
+                                         npt_azim=self.npt_azi,
+                                         unit="2th_deg",
+                                         method=self._pyfai_method_2d)
+        return self._pattern_from_cake_result(result, frame_data), result.intensity
+
+    """ 共通 """
+    def estimate_frame_bytes(self) -> int:
+        """
+        1frameを読み込んで積算し終わるまでに使うメモリの目安
+        生データ + pyFAIが作るfloat32のコピー + cake (float32) + pyFAI内部の信号・規格化の和 (float64 x 2)
+        """
+        pixel_num = int(np.prod(self.ai.detector.max_shape))
+        bin_num = self.npt_tth * self.npt_azi
+        return pixel_num * (8 + 4) + bin_num * (4 + 8 * 2) # 生データは uint32/float32 を想定して多めに8 byte
+
+    def _pattern_from_cake_result(self, result, frame_data):
+        """
+        2D積分の結果を方位角方向に足し合わせて1次元パターンにする
+        信号の和を規格化(立体角など)の和で割るので、integrate1dと同じ値になる
+        """
+        sum_signal = result.sum_signal
+        sum_normalization = result.sum_normalization
+        # 古いpyFAIやmethodによっては和が返ってこないので、読み込み済みのデータで1D積分する
+        if sum_signal is None or sum_normalization is None:
+            with self.timer.stage('integrate1d'):
+                tth, I = self.ai.integrate1d(frame_data, npt=self.npt_tth, unit="2th_deg", method=self._pyfai_method_1d)
             return I
-        except Exception as e:
-            raise RuntimeError(f"Frame {frame} の 2D 積分中にエラーが発生しました: {str(e)}")
+        signal = np.asarray(sum_signal, dtype=np.float64).reshape(self.npt_azi, self.npt_tth).sum(axis=0)
+        normalization = np.asarray(sum_normalization, dtype=np.float64).reshape(self.npt_azi, self.npt_tth).sum(axis=0)
+        pattern = np.zeros(self.npt_tth, dtype=np.float64)
+        np.divide(signal, normalization, out=pattern, where=normalization != 0) # 画素がないbinは0 (pyFAIのdummyと同じ)
+        return pattern
 
     def _check_opencl_support(self):
         """ OpenCL (GPU) が利用可能かチェック """
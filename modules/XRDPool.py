@@ -0,0 +1,149 @@
+"""
+XRDの積算をプロセスプールで並列に行うクラス
+
+各workerプロセスは .poni から自分専用のXRD(pyFAIのintegrator)を作り、frame番号を受け取って積算結果を返す。
+HDF5への書き込みはしない。結果はframe順に返すので、呼び出し側の1つのwriterが順番に書き込む。
+各workerの読み込み・積算の時間(StageTimer)は結果と一緒に送り返し、self.timer に足し合わせる。
+"""
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from modules.BatchIntegrator import BatchIntegrator
+from modules.StageTimer import StageTimer
+from modules.XRD import XRD
+
+# workerプロセスごとに1つだけ作られるXRD。_init_workerで設定される
+_worker_xrd: XRD = None
+# ブロック単位で積算する場合の疎行列。最初のブロックで作る
+_worker_batch: BatchIntegrator = None
+
+
+def _init_worker(xrd_config: dict):
+    """ workerプロセスの起動時に1回だけ呼ばれる。.poniからintegratorを作り、生データのファイルを開いておく """
+    global _worker_xrd, _worker_batch
+    _worker_xrd = XRD(**xrd_config)
+    _worker_batch = BatchIntegrator(_worker_xrd)
+    _worker_xrd.open_frame_source(threads=1) # プロセスが終わるまで開いたままにする。解凍はプロセスごとに並列になっているので1スレッド
+
+
+# 結果の最後には、そのframeの処理時間 (StageTimer.stages) を付けて返す
+def _integrate_pattern(frame: int):
+    return frame, _worker_xrd.get_1d_pattern_data(frame), _worker_xrd.timer.pop_stages()
+
+
+def _integrate_cake(frame: int):
+    return frame, _worker_xrd.get_caked_data(frame), _worker_xrd.timer.pop_stages()
+
+
+def _integrate_pattern_and_cake(frame: int):
+    return (frame, *_worker_xrd.get_pattern_and_caked_data(frame), _worker_xrd.timer.pop_stages())
+
+
+# ブロック単位 (BatchIntegrator)。framesをまとめて積算し、(frameのリスト, 結果の配列..., 処理時間) を返す
+def _integrate_pattern_block(frames: list):
+    return (frames, *_integrate_block(frames, _worker_batch.integrate_patterns), _worker_xrd.timer.pop_stages())
+
+
+def _integrate_cake_block(frames: list):
+    return (frames, *_integrate_block(frames, _worker_batch.integrate_cakes), _worker_xrd.timer.pop_stages())
+
+
+def _integrate_pattern_and_cake_block(frames: list):
+    return (frames, *_integrate_block(frames, _worker_batch.integrate_patterns_and_cakes), _worker_xrd.timer.pop_stages())
+
+
+def _integrate_block(frames: list, integrate) -> tuple:
+    frames_data = np.stack([_worker_xrd._read_frame_data(frame) for frame in frames])
+    with _worker_xrd.timer.stage('integrate_batch', nbytes=frames_data.nbytes):
+        result = integrate(frames_data)
+    return result if isinstance(result, tuple) else (result,)
+
+
+class XRDPool:
+    # 1回のやり取りでworkerに渡すframe数の上限。cakeは1frameでも大きいので小さめにしておく
+    MAX_CHUNKSIZE = 8
+
+    def __init__(self, xrd: XRD, num_workers: int = None, max_in_flight: int = None):
+        """
+        xrd: 積算の設定元。pathと分割数だけを各workerに渡して作り直す
+        num_workers: workerプロセス数。Noneなら default_num_workers() を使う
+        max_in_flight: workerに渡してから、呼び出し側が受け取り終わるまでの仕事の数の上限。メモリを制限するため
+            Noneなら制限しない (全frameを一度にworkerに渡すので、書き込みが遅いと結果がメモリに溜まる)
+        """
+        self.xrd_config = xrd.to_config()
+        self.num_workers = num_workers if num_workers else self.default_num_workers()
+        self.max_in_flight = max_in_flight
+        if max_in_flight is not None: # 仕事より多いworkerは待つだけなので減らす
+            self.num_workers = max(1, min(self.num_workers, max_in_flight))
+        self.timer = StageTimer() # 全workerの読み込み・積算の時間
+
+    @staticmethod
+    def default_num_workers() -> int:
+        """ 画面操作などのためにCPUを2つ残しておく """
+        return max(1, min(8, (os.cpu_count() or 1) - 2))
+
+    def imap_pattern(self, frames):
+        """ (frame, 1次元パターン) をframes順に返すイテレータ """
+        return self._imap(_integrate_pattern, frames)
+
+    def imap_cake(self, frames):
+        """ (frame, cakeデータ) をframes順に返すイテレータ """
+        return self._imap(_integrate_cake, frames)
+
+    def imap_pattern_and_cake(self, frames):
+        """ (frame, 1次元パターン, cakeデータ) をframes順に返すイテレータ。rawデータの読み込みは1frame1回 """
+        return self._imap(_integrate_pattern_and_cake, frames)
+
+    def imap_blocks(self, kind: str, frames, block_frames: int):
+        """
+        BatchIntegrator で block_frames ずつまとめて積算する。結果は imap_<kind> と同じく1frameずつ返す
+        kind: 'pattern', 'cake', 'pattern_and_cake'
+        """
+        func = {
+            'pattern': _integrate_pattern_block,
+            'cake': _integrate_cake_block,
+            'pattern_and_cake': _integrate_pattern_and_cake_block,
+        }[kind]
+        frames = list(frames)
+        # 全workerに仕事が回るように、ブロックをworker数より多くする
+        block_frames = max(1, min(block_frames, -(-len(frames) // self.num_workers)))
+        blocks = [frames[start:start + block_frames] for start in range(0, len(frames), block_frames)]
+        for block, *arrays in self._imap(func, blocks, chunksize=1):
+            for i, frame in enumerate(block):
+                yield (frame, *(array[i] for array in arrays))
+
+    def _imap(self, func, items, chunksize: int = None):
+        """ items: workerに渡すもの (frame番号、またはframeのリスト) """
+        items = list(items)
+        if not items: # 全て処理済みの場合など。プロセスを起動しない
+            return
+        if chunksize is None:
+            chunksize = max(1, min(self.MAX_CHUNKSIZE, len(items) // (self.num_workers * 4)))
+        # h5pyのファイルハンドルやstreamlitの状態をforkで引き継がないように spawn で起動する
+        with ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(self.xrd_config,),
+        ) as executor:
+            for *result, stages in self._bounded_map(executor, func, items, chunksize):
+                self.timer.merge(stages)
+                yield tuple(result)
+
+    def _bounded_map(self, executor, func, items: list, chunksize: int):
+        """ executor.map と同じく結果を順番に返す。max_in_flight があれば、受け取られた分だけ次の仕事を渡す """
+        if self.max_in_flight is None:
+            yield from executor.map(func, items, chunksize=chunksize)
+            return
+        items = iter(items)
+        pending = deque(executor.submit(func, item) for _, item in zip(range(self.max_in_flight), items))
+        while pending:
+            yield pending.popleft().result()
+            # 呼び出し側が書き込み終わってから次を渡すので、メモリに載る結果は max_in_flight 個まで
+            for item in items:
+                pending.append(executor.submit(func, item))
+                break
@@ -5,10 +5,10 @@ import streamlit as st
 from matplotlib import pyplot as plt
 from openpyxl.xml.functions import fromstring
 
-from app_utils import setting_handler
+from app_utils import cache_handler, setting_handler
 from app_utils.Writer import XRDWriter, PeakWriter
+from app_utils.cake_index import CakeIntegralIndex
 from app_utils.peak_handler import Peak
-from modules.HDF5 import HDF5Reader
 
 setting_handler.set_common_setting(has_link_in_page=False)
 setting = setting_handler.Setting()
@@ -58,12 +58,10 @@ else:
     boundaries['to_azi'] = 60.0
 
 
-# tmp.hdfを参照しておく
-cake_hdf = HDF5Reader(setting.setting_json['tmp_hdf_path'])
+# tmp.hdfを参照しておく。tmp.hdfが書き換わるまではキャッシュしたものを使う
+cake_hdf = cache_handler.get_tmp_reader(setting.setting_json['tmp_hdf_path'])
 # 配列データの取得
-frame_arr = cake_hdf.find_by(query='arr/frame')
-tth_arr = cake_hdf.find_by(query='arr/tth')
-azi_arr = cake_hdf.find_by(query='arr/azi')
+frame_arr, tth_arr, azi_arr = cache_handler.get_arrays(setting.setting_json['tmp_hdf_path'])
 
 peak = Peak().set_from_json(
     peak_num, tth_arr, azi_arr
@@ -127,7 +125,7 @@ if st.button('更新'):
 st.divider() # --------------------------------------------------------------------------------------------------------#
 st.subheader("Peak 範囲の表示")
 # patternデータの表示
-pattern = cake_hdf.find_by(query='pattern')
+pattern, _ = cache_handler.get_pattern(setting.setting_json['tmp_hdf_path'])
 # パターンの必要な領域を切り取る
 selected_pattern = pattern[from_frame:to_frame, peak.from_tth_idx:peak.to_tth_idx]
 st.write(selected_pattern.shape)
@@ -140,22 +138,41 @@ ax.set_ylabel('2θ (deg)')
 st.pyplot(fig)
 del fig
 
-if st.button('この範囲で再積算する'):
-    # ↑で設定された2θの範囲で、全frameのcake dataから再度積算を行う。
-    hdf_writer = PeakWriter(file_path=setting.setting_json['tmp_hdf_path'])
-    hdf_writer.write_re_integrate_peak_data(
-        peak=peak,
-        peak_num=peak_num,
-        frame_num=len(frame_arr)
-    )
+re_integrate_col, re_integrate_all_col = st.columns(2)
+with re_integrate_col:
+    if st.button('この範囲で再積算する'):
+        # ↑で設定された2θの範囲で、全frameのcake dataから再度積算を行う。
+        hdf_writer = PeakWriter(filepath=setting.setting_json['tmp_hdf_path'])
+        hdf_writer.write_re_integrate_peak_data(
+            peak=peak,
+            peak_num=peak_num,
+            frame_num=len(frame_arr)
+        )
+with re_integrate_all_col:
+    if st.button('保存した全ピークを再積算する'):
+        # peaks.json にある全てのピークを、cakeを1回読むだけで再積算する
+        all_peaks = Peak.load_all(tth_arr, azi_arr)
+        hdf_writer = PeakWriter(filepath=setting.setting_json['tmp_hdf_path'])
+        hdf_writer.write_re_integrate_peaks(peaks=all_peaks, frame_num=len(frame_arr))
+        st.write(f"Peak {', '.join(all_peaks)}: {hdf_writer.run_report['wall_seconds']:.1f} s")
 
 gc.collect()
 
 st.divider() # --------------------------------------------------------------------------------------------------------#
 st.subheader("再積算結果")
-#
-to_tth_query = os.path.join('peak', f'{peak_num}', 'tth')
-tth_pattern = cake_hdf.find_by(query=to_tth_query)[from_frame:to_frame]
+if CakeIntegralIndex.exists(setting.setting_json['tmp_hdf_path']):
+    # インデックスがあれば、今の範囲でその場で計算する (ボタンを押さなくても範囲の変更がすぐ反映される)
+    st.caption('インデックスから現在の範囲で計算しています')
+    tth_pattern, azi_pattern = CakeIntegralIndex(setting.setting_json['tmp_hdf_path']).roi_profiles(
+        peak.from_azi_idx, peak.to_azi_idx,
+        peak.from_tth_idx, peak.to_tth_idx,
+        from_frame=from_frame, to_frame=to_frame
+    )
+else:
+    to_tth_query = os.path.join('peak', f'{peak_num}', 'tth')
+    tth_pattern = cake_hdf.find_by(query=to_tth_query)[from_frame:to_frame]
+    to_azi_query = os.path.join('peak', f'{peak_num}', 'azi')
+    azi_pattern = cake_hdf.find_by(query=to_azi_query)[from_frame:to_frame]
 st.write(tth_pattern.shape)
 # 描画
 fig, ax = plt.subplots(figsize=(10, 5))
@@ -166,9 +183,6 @@ ax.set_ylabel('2θ (deg)')
 st.pyplot(fig)
 del fig
 
-#
-to_azi_query = os.path.join('peak', f'{peak_num}', 'azi')
-azi_pattern = cake_hdf.find_by(query=to_azi_query)[from_frame:to_frame]
 # 描画
 fig, ax = plt.subplots()
 im = ax.imshow(azi_pattern.T, cmap='jet', aspect='auto', origin='lower')
@@ -177,3 +191,35 @@ ax.set_xlabel('Time (frame)')
 ax.set_ylabel('2θ (deg)')
 st.pyplot(fig)
 del fig
+
+st.divider() # --------------------------------------------------------------------------------------------------------#
+st.subheader("ピークのフィッティング")
+# 再積算した2θパターンの全frameに、ピークの関数 + 直線の背景 をフィッティングする
+fit_model = st.selectbox(label='関数', options=['pseudo_voigt', 'gaussian'])
+if st.button('全frameをフィッティングする'):
+    hdf_writer = PeakWriter(filepath=setting.setting_json['tmp_hdf_path'])
+    try:
+        with st.spinner('フィッティングしています...'):
+            hdf_writer.write_peak_fit(
+                peak_num=peak_num,
+                tth_axis=tth_arr[peak.from_tth_idx:peak.to_tth_idx],
+                model=fit_model
+            )
+    except KeyError: # まだ再積算していない
+        st.error(f'Peak {peak_num} はまだ再積算されていません。先に再積算してください。')
+    except ValueError: # 再積算した後に範囲を変えた
+        st.error(f'Peak {peak_num} の2θの範囲が、再積算したときと変わっています。今の範囲で再積算し直してください。')
+
+fit_result = PeakWriter.read_peak_fit(setting.setting_json['tmp_hdf_path'], peak_num)
+if fit_result:
+    st.write(f"収束したframe: {fit_result['converged'].sum()} / {len(fit_result['converged'])}")
+    fit_frames = frame_arr[:len(fit_result['converged'])]
+    converged = fit_result['converged']
+    for name, label in [('center', '2θ (deg)'), ('fwhm', 'FWHM (deg)'), ('area', 'Area (a.u.)')]:
+        fig, ax = plt.subplots(figsize=(10, 3))
+        ax.errorbar(fit_frames[converged], fit_result[name][converged], yerr=fit_result[f'{name}_err'][converged],
+                    fmt='.', markersize=2, elinewidth=0.5)
+        ax.set_xlabel('Time (frame)')
+        ax.set_ylabel(label)
+        st.pyplot(fig)
+        del fig
@@ -1,13 +1,19 @@
 import gc
 import os
+import time
 
 import streamlit as st
 from matplotlib import pyplot as plt
 
 from app_utils.Writer import XRDWriter
-from modules.HDF5 import HDF5Reader
-from modules.XRD import XRD
-from app_utils import setting_handler
+from app_utils.live import start_follow_process
+from app_utils.pyramid import CakePyramid
+from app_utils.result_cache import IntegrationCache
+from app_utils.spot_tracker import SpotTracker
+from app_utils.spots import SpotDetector
+from modules.MethodTuner import MethodTuner
+from modules.XRDPool import XRDPool
+from app_utils import cache_handler, setting_handler
 
 setting_handler.set_common_setting(has_link_in_page=False)
 setting = setting_handler.Setting()
@@ -33,7 +39,8 @@ st.markdown(
 )
 
 # 選択されたデータを取り出す・処理するためにオブジェクト化
-xrd = XRD(
+# 再実行のたびに作り直さないように、ファイル・分割数が同じ間はキャッシュしたものを使う
+xrd = cache_handler.get_xrd(
     xrd_path=setting.setting_json['xrd_path'],
     poni_path=setting.setting_json['poni_path'],
     npt_tth=setting.setting_json['npt_tth'],
@@ -60,18 +67,226 @@ st.markdown(
         {setting.setting_json["tmp_hdf_path"]}
     """
 )
+workers_col, threads_col, memory_col = st.columns(3)
+with workers_col:
+    num_workers = st.number_input(
+        label='並列処理のプロセス数 (1なら並列化しない)',
+        min_value=1,
+        max_value=os.cpu_count(),
+        value=XRDPool.default_num_workers(),
+        step=1
+    )
+with threads_col:
+    num_threads = st.number_input(
+        label='積算スレッド数 (プロセス数が1のとき。読み込み・積算・書き込みを同時に進める)',
+        min_value=1,
+        max_value=os.cpu_count(),
+        value=1,
+        step=1,
+        disabled=num_workers > 1
+    )
+with memory_col:
+    memory_budget_gb = st.number_input(
+        label='積算中に使うメモリの上限 (GB)',
+        min_value=0.5,
+        value=XRDWriter.DEFAULT_MEMORY_BUDGET / 1024**3,
+        step=0.5
+    )
+layout_col, compression_col, shuffle_col = st.columns(3)
+with layout_col:
+    cake_layout = st.selectbox(
+        label='cakeの保存レイアウト (frame: 1frameずつ表示, roi: ピークの再積算)',
+        options=XRDWriter.CAKE_LAYOUTS
+    )
+with compression_col:
+    compression = st.selectbox(
+        label='cakeの圧縮',
+        options=XRDWriter.COMPRESSIONS,
+        format_func=lambda c: 'なし' if c is None else c
+    )
+with shuffle_col:
+    shuffle = st.checkbox(label='shuffleフィルタ', value=compression is not None, disabled=compression is None)
+build_pyramid = st.checkbox(
+    label='表示用の縮小データ (2x, 4x, ...) も作る (大きい分割数のときに表示が速くなる)',
+    value=True
+)
+resume = st.checkbox(
+    label='前回と同じ条件なら、中断したところから再開する',
+    value=True
+)
+autotune = st.checkbox(
+    label='積算方法 (pyFAIのmethod) を実測して一番速いものを使う (検出器・.poni・分割数ごとに初回だけ測る)',
+    value=True
+)
+batch_integrate = st.checkbox(
+    label='複数frameをまとめて積算する (疎行列の積。frame数が多いときに速い。結果はpyFAIと丸め誤差の範囲で一致)',
+    value=False
+)
+spot_col, spot_threshold_col = st.columns([3, 1])
+with spot_col:
+    detect_spots = st.checkbox(
+        label='caking中にスポットを検出する (方位角方向の中央値を背景として、飛び出した部分を entry/spots に保存)',
+        value=False
+    )
+with spot_threshold_col:
+    spot_threshold = st.number_input(label='しきい値 (σの何倍か)', min_value=1.0, value=5.0, step=0.5)
+is_write_cake_index = st.checkbox(
+    label='再積算用のインデックスを作る (Peakページで範囲を変えるとすぐに再積算される。cakeの約2倍の容量が必要)',
+    value=False
+)
+# 積算結果のキャッシュ。同じ生データ・.poni・mask・積算の設定・書き込むものなら、保存してある結果をコピーするだけで済ませる
+use_result_cache = st.toggle('積算結果のキャッシュを使う', value=setting.setting_json.get('use_result_cache', False))
+if use_result_cache:
+    cache_col, cache_size_col = st.columns([3, 1])
+    with cache_col:
+        cache_dir = st.text_input(
+            label='キャッシュの保存先',
+            value=setting.setting_json.get('cache_dir', os.path.join(os.path.dirname(setting.setting_json['tmp_hdf_path']), 'cache')),
+        )
+    with cache_size_col:
+        cache_max_gb = st.number_input(
+            label='上限 (GB)',
+            min_value=1.0,
+            value=float(setting.setting_json.get('cache_max_gb', 50.0)),
+            step=10.0
+        )
+    if st.button(label='キャッシュの設定を更新'):
+        setting.update_setting(key='use_result_cache', value=use_result_cache)
+        setting.update_setting(key='cache_dir', value=cache_dir)
+        setting.update_setting(key='cache_max_gb', value=cache_max_gb)
+        setting = setting_handler.Setting()
+    result_cache = IntegrationCache(cache_dir=cache_dir, max_bytes=int(cache_max_gb * 1e9))
+    st.caption(f'現在のキャッシュ: {result_cache.total_bytes() / 1e9:.2f} GB')
+# 積算方法の設定。xrdはページの再実行をまたいで使い回されるので、自動で選ばない場合はデフォルトに戻す
+def set_integration_methods(xrd, autotune: bool):
+    if not autotune:
+        xrd.set_methods()
+        return
+    with st.spinner('積算方法を選んでいます...'):
+        choice = MethodTuner().apply(xrd)
+    st.caption(f"積算方法: 1D {MethodTuner.method_name(choice['method_1d'])}, 2D {MethodTuner.method_name(choice['method_2d'])}")
+
+def create_writer(xrd):
+    return XRDWriter(
+        filepath=setting.setting_json['tmp_hdf_path'], xrd=xrd, num_workers=num_workers,
+        cake_layout=cake_layout, compression=compression, shuffle=shuffle,
+        build_pyramid=build_pyramid, resume=resume, batch_integrate=batch_integrate,
+        num_threads=num_threads, memory_budget=int(memory_budget_gb * 1024**3),
+        spot_detector=SpotDetector(threshold=spot_threshold) if detect_spots else None
+    )
+
+# クイックルック。Nframeおき・範囲を絞って先に積算する。残りは 'Start process' で埋まる (再開にチェックがある場合)
+with st.expander('クイックルック (Nframeおき・2θ/方位角の範囲を絞って先に見る)'):
+    quick_frame_step = st.number_input(label='何frameおきに積算するか', min_value=1, value=10, step=1)
+    limit_tth = st.checkbox(label='2θの範囲を絞る')
+    tth_min_col, tth_max_col = st.columns(2)
+    with tth_min_col:
+        quick_tth_min = st.number_input(label='2θ min (deg)', value=0.0, disabled=not limit_tth)
+    with tth_max_col:
+        quick_tth_max = st.number_input(label='2θ max (deg)', value=90.0, disabled=not limit_tth)
+    limit_azi = st.checkbox(label='方位角の範囲を絞る (patternは書き込まない)')
+    azi_min_col, azi_max_col = st.columns(2)
+    with azi_min_col:
+        quick_azi_min = st.number_input(label='方位角 min (deg)', value=-180.0, disabled=not limit_azi)
+    with azi_max_col:
+        quick_azi_max = st.number_input(label='方位角 max (deg)', value=180.0, disabled=not limit_azi)
+    if st.button(label='クイックルック'):
+        set_integration_methods(xrd, autotune)
+        writer = create_writer(xrd)
+        writer.write_params()
+        writer.write_arrays()
+        writer.write_quick_look(
+            frame_step=quick_frame_step,
+            tth_range=(quick_tth_min, quick_tth_max) if limit_tth else None,
+            azi_range=(quick_azi_min, quick_azi_max) if limit_azi else None,
+        )
+        st.write(f"{writer.run_report['frame_count']} frame, {writer.run_report['wall_seconds']:.1f} s")
+
 # 処理
 if st.button(label='Start process', type='primary'):
-    # 書き込みクラスをオブジェクト化
-    writer = XRDWriter(filepath=setting.setting_json['tmp_hdf_path'], xrd=xrd)
-    # 書き込み
-    writer.write_params()
-    writer.write_arrays()
-    writer.write_pattern_data()
-    writer.write_cake_data()
+    set_integration_methods(xrd, autotune) # 積算方法もキャッシュのキーに入るので、先に決める
+    # 復元したtmp.hdfには保存したときに作ったもの (縮小版・インデックス・スポット) しか入っていないので、それもキーに入れる
+    cache_outputs = {
+        'cake_layout': cake_layout,
+        'compression': compression,
+        'shuffle': shuffle if compression is not None else False,
+        'build_pyramid': build_pyramid,
+        'spot_threshold': spot_threshold if detect_spots else None,
+        'cake_index': is_write_cake_index,
+    }
+    cache_key = IntegrationCache.fingerprint(xrd, outputs=cache_outputs) if use_result_cache else None
+    if use_result_cache and result_cache.restore(cache_key, setting.setting_json['tmp_hdf_path']):
+        st.success('キャッシュにあった積算結果を使いました。')
+    else:
+        # 書き込みクラスをオブジェクト化
+        writer = create_writer(xrd)
+        # 書き込み
+        writer.write_params()
+        writer.write_arrays()
+        writer.write_pattern_and_cake_data() # rawデータを1回だけ読んで pattern と cake を両方書き込む
+        st.write('cakeの保存結果', writer.cake_storage_report)
+        st.write(f"{writer.run_report['frame_count']} frame, {writer.run_report['wall_seconds']:.1f} s "
+                 f"({writer.run_report['frames_per_s']:.1f} frames/s)")
+        st.code(writer.timer.summary()) # 読み込み・積算・書き込みのどこに時間がかかっているか
+        if is_write_cake_index:
+            writer.write_cake_index()
+        if use_result_cache:
+            result_cache.store(cache_key, setting.setting_json['tmp_hdf_path'], description=xrd.to_config())
+
+# 前回までの処理時間の集計 (tmp.hdfの entry/report)
+with st.expander('処理時間の記録'):
+    try:
+        run_reports = XRDWriter.read_run_reports(setting.setting_json['tmp_hdf_path'])
+    except OSError: # ライブ処理がtmp.hdfを書き込み中
+        run_reports = {}
+    for name, report in run_reports.items():
+        st.write(f"**{name}** ({report['finished_at']}): {report['frame_count']} frame, {report['wall_seconds']:.1f} s")
+        st.json({
+            stage_name: {key: value for key, value in stage.items() if not key.startswith('histogram')}
+            for stage_name, stage in report['stages'].items()
+        }, expanded=False)
+
+# ライブ処理。測定中の .nxs に追加されたframeを、別プロセスで順に積算する
+st.markdown('##### ライブ処理 (測定中のデータ)')
+live_process = st.session_state.get('live_process')
+is_live = live_process is not None and live_process.is_alive()
+live_col1, live_col2 = st.columns(2)
+with live_col1:
+    if st.button(label='ライブ処理を開始', disabled=is_live):
+        set_integration_methods(xrd, autotune)
+        st.session_state['live_process'], st.session_state['live_stop_event'] = start_follow_process(
+            xrd_config=xrd.to_config(),
+            tmp_hdf_path=setting.setting_json['tmp_hdf_path'],
+        )
+        is_live = True
+with live_col2:
+    if st.button(label='ライブ処理を停止', disabled=not is_live):
+        st.session_state['live_stop_event'].set()
+        st.session_state['live_process'].join()
+        is_live = False
+if is_live:
+    st.info('ライブ処理中です。frameが追加されると表示が更新されます。')
 
 gc.collect() # メモリを掃除
 
+if st.button(label='保存済みのcakeからスポットを検出する'):
+    with st.spinner('スポットを検出しています...'):
+        spot_count = SpotDetector(threshold=spot_threshold).write_spots(setting.setting_json['tmp_hdf_path'])
+    st.success(f'スポットを {spot_count} 個検出しました。')
+
+track_col, tth_tolerance_col, azi_tolerance_col, max_gap_col = st.columns([3, 1, 1, 1])
+with tth_tolerance_col:
+    tth_tolerance = st.number_input(label='2θの許容量 (deg)', min_value=0.001, value=0.05, step=0.01, format='%.3f')
+with azi_tolerance_col:
+    azi_tolerance = st.number_input(label='方位角の許容量 (deg)', min_value=0.1, value=2.0, step=0.5)
+with max_gap_col:
+    max_gap = st.number_input(label='途切れてよいframe数', min_value=0, value=3, step=1)
+with track_col:
+    if st.button(label='検出したスポットをframe間でつなぐ (粒の追跡)'):
+        with st.spinner('スポットを追跡しています...'):
+            track_num = SpotTracker(tth_tolerance, azi_tolerance, int(max_gap)).write_tracks(setting.setting_json['tmp_hdf_path'])
+        st.success(f'{track_num} 本の軌跡にまとめました。')
+
 st.divider() # --------------------------------------------------------------------------------------------------------#
 st.subheader('積算データの確認')
 
@@ -80,15 +295,32 @@ if not os.path.exists(setting.setting_json['tmp_hdf_path']):
     st.stop()
 
 # ここからはtmp.hdfを参照しながらデータを描画する
-cake_hdf = HDF5Reader(setting.setting_json['tmp_hdf_path'])
+# 配列データの取得。tmp.hdfが書き換わるまではキャッシュしたものを使う
+try:
+    frame_arr, tth_arr, azi_arr = cache_handler.get_arrays(setting.setting_json['tmp_hdf_path'])
+except (OSError, KeyError):
+    if not is_live:
+        raise
+    # ライブ処理がtmp.hdfを書き込み中、またはまだ最初のframeが来ていない
+    st.info('データの書き込みを待っています...')
+    time.sleep(1)
+    st.rerun()
+
+# クイックルックなどで、まだ積算していないframe・範囲がある場合
+if not is_live:
+    for name, progress in XRDWriter.read_progress(setting.setting_json['tmp_hdf_path']).items():
+        if progress['partial']:
+            st.warning(f"{name}: 積算が途中です ({progress['done_frames']}/{progress['frame_num']} frame 完了)。"
+                       f"積算していないframe・範囲は0です。'Start process' で残りを積算できます。")
 
-# 配列データの取得
-frame_arr = cake_hdf.find_by(query='arr/frame')
-tth_arr = cake_hdf.find_by(query='arr/tth')
-azi_arr = cake_hdf.find_by(query='arr/azi')
+# 表示する画素数。これを下回らない範囲で縮小されたデータを読み込む
+DISPLAY_SHAPE = (480, 640)
+# 表示するだけで書き換えないので、frameを動かすたびにコピーしないように memmap で読む
+# (ライブ処理中はSWMRで書き込み中のファイルなので、HDF5Readerと同じくmemmapにしない)
+cake_pyramid = CakePyramid(setting.setting_json['tmp_hdf_path'], use_memmap=not is_live)
 
 # patternデータの表示
-pattern = cake_hdf.find_by(query='pattern')
+pattern, pattern_factor = cache_handler.get_pattern(setting.setting_json['tmp_hdf_path'], display_shape=DISPLAY_SHAPE)
 fig, ax = plt.subplots()
 im = ax.imshow(pattern, cmap='jet', aspect='auto', origin='lower',
                extent=[tth_arr.min(), tth_arr.max(), frame_arr.min(), frame_arr.max()])
@@ -99,27 +331,43 @@ st.pyplot(fig)
 del fig
 
 # cakeデータの表示
-# 大量のデータに対しては fetcher (HDF内の特定のデータパスにあるデータを取る専用のオブジェクト)を作成しておく
-cake_fetcher = cake_hdf.create_fetcher(query='cake')
+# 表示サイズに合った解像度のものだけを1frame分読み込む
 frame = st.slider(
     label='frame',
     min_value=0,
-    max_value=500
+    max_value=len(frame_arr) - 1
 )
+cake, cake_factor = cake_pyramid.fetch_cake_frame(frame=frame, display_shape=DISPLAY_SHAPE)
 fig, ax = plt.subplots()
 im = ax.imshow(
-    cake_fetcher.fetch_by_frame(frame=frame),
+    cake,
     cmap='jet', aspect='auto', origin='lower',
     extent=[tth_arr.min(), tth_arr.max(), azi_arr.min(), azi_arr.max()]
 )
 plt.colorbar(im, ax=ax, label='Intensity (a.u.)')
+# 検出したスポットがあれば重ねて表示する
+frame_spots = SpotDetector.read_spots(setting.setting_json['tmp_hdf_path'], frame=frame) if not is_live else None
+if frame_spots is not None and len(frame_spots['frame']):
+    ax.scatter(frame_spots['tth'], frame_spots['azi'], s=40, facecolors='none', edgecolors='white', linewidths=0.8)
 ax.set_xlabel('2θ (deg)')
 ax.set_ylabel('Azimuth (deg)')
-ax.set_title(f'Frame = {frame}')
+ax.set_title(f'Frame = {frame}' + (f' (1/{cake_factor})' if cake_factor > 1 else ''))
 st.pyplot(fig)
 del fig
 
+# スポットの軌跡があれば、方位角の時間変化を表示する
+if not is_live and SpotTracker.read_tracks(setting.setting_json['tmp_hdf_path'])['length'].size:
+    min_length = st.number_input(label='表示する軌跡の最小の長さ (frame)', min_value=1, value=5, step=1)
+    series = SpotTracker.read_series(setting.setting_json['tmp_hdf_path'], min_length=int(min_length))
+    fig, ax = plt.subplots()
+    ax.scatter(series['frame'], series['azi'], c=series['track_id'] % 20, cmap='tab20', s=2)
+    ax.set_xlabel('Time (frame)')
+    ax.set_ylabel('Azimuth (deg)')
+    ax.set_title(f'{len(set(series["track_id"].tolist()))} tracks (>= {min_length} frames)')
+    st.pyplot(fig)
+    del fig
 
-
-
-
+# ライブ処理中は、少し待ってから再実行して表示を更新する
+if is_live:
+    time.sleep(2)
+    st.rerun()
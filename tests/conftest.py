@@ -0,0 +1,70 @@
+"""
+テスト用の小さな人工データ (tools/synthetic.py) と、それを読み込んだXRD
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # リポジトリ直下から import する
+
+from app_utils.Writer import XRDWriter
+from app_utils.peak_handler import Peak
+from modules.XRD import XRD
+from tools.synthetic import write_nxs, write_poni
+
+FRAME_NUM = 12
+NPT_TTH = 80
+NPT_AZI = 60
+
+
+@pytest.fixture(scope='session')
+def xrd_input(tmp_path_factory):
+    """ (nxsのpath, poniのpath) """
+    work_dir = tmp_path_factory.mktemp('input')
+    poni_path = write_poni(str(work_dir / 'synthetic.poni'), shape=(128, 128))
+    nxs_path = write_nxs(str(work_dir / 'synthetic.nxs'), poni_path, frame_num=FRAME_NUM)
+    return nxs_path, poni_path
+
+
+def make_xrd(xrd_input, npt_tth=NPT_TTH, npt_azi=NPT_AZI) -> XRD:
+    nxs_path, poni_path = xrd_input
+    return XRD(xrd_path=nxs_path, poni_path=poni_path, npt_tth=npt_tth, npt_azi=npt_azi)
+
+
+def write_tmp_hdf(tmp_hdf, xrd, **options) -> XRDWriter:
+    """ tmp.hdfの XRDWriter を作って、params・arr まで書き込む。options は XRDWriter の引数 """
+    writer = XRDWriter(str(tmp_hdf), xrd, **options)
+    writer.write_params()
+    writer.write_arrays()
+    return writer
+
+
+def write_pattern_and_cake(tmp_hdf, xrd, **options) -> XRDWriter:
+    """ write_tmp_hdf の後、全frameの pattern と cake を書き込む """
+    writer = write_tmp_hdf(tmp_hdf, xrd, **options)
+    writer.write_pattern_and_cake_data()
+    return writer
+
+
+def make_peak(xrd, tth_bins: tuple, azi_bins: tuple) -> Peak:
+    """ 2θ・方位角のbin番号 (start, stop) で範囲を決めたピーク。全frame """
+    tth_arr, azi_arr = xrd.get_tth(), xrd.get_azi()
+    return Peak().set_boundaries(
+        tth_arr, tth_arr[tth_bins[0]], tth_arr[tth_bins[1]],
+        azi_arr, azi_arr[azi_bins[0]], azi_arr[azi_bins[1]],
+        0, xrd.frame_num
+    )
+
+
+@pytest.fixture(scope='session')
+def xrd(xrd_input):
+    return make_xrd(xrd_input)
+
+
+@pytest.fixture(scope='session')
+def reference(xrd):
+    """ 1frameずつ積算した (pattern, cake)。書き込んだtmp.hdfと比べる用 """
+    results = [xrd.get_pattern_and_caked_data(frame) for frame in range(xrd.frame_num)]
+    return np.stack([pattern for pattern, _ in results]), np.stack([cake for _, cake in results])
@@ -0,0 +1,43 @@
+"""
+BatchIntegrator: 複数frameをまとめて積算した結果が、pyFAIでframeごとに積算した結果と合うか
+"""
+import numpy as np
+
+from modules.BatchIntegrator import BatchIntegrator
+
+FRAMES = [0, 4, 7, 11]
+
+
+def _frames_data(xrd):
+    return np.stack([xrd._read_frame_data(frame) for frame in FRAMES])
+
+
+def test_batch_cake_matches_integrate2d(xrd, reference):
+    ref_pattern, ref_cake = reference
+    patterns, cakes = BatchIntegrator(xrd).integrate_patterns_and_cakes(_frames_data(xrd))
+    assert cakes.shape == (len(FRAMES), xrd.npt_azi, xrd.npt_tth)
+    for i, frame in enumerate(FRAMES):
+        I, _, _ = xrd.ai.integrate2d(xrd._read_frame_data(frame), npt_rad=xrd.npt_tth, npt_azim=xrd.npt_azi,
+                                     unit="2th_deg", method=xrd._pyfai_method_2d)
+        np.testing.assert_allclose(cakes[i], I, rtol=1e-4, atol=1e-5 * I.max())
+    np.testing.assert_allclose(patterns, ref_pattern[FRAMES], rtol=1e-4, atol=1e-5 * ref_pattern.max())
+    np.testing.assert_allclose(cakes, ref_cake[FRAMES], rtol=1e-4, atol=1e-5 * ref_cake.max())
+
+
+def test_validate_reports_small_errors(xrd):
+    errors = BatchIntegrator(xrd).validate(FRAMES)
+    assert set(errors) == {'pattern', 'cake', 'pattern_1d'}
+    assert max(errors.values()) < 1e-4
+
+
+def test_window_matches_full_cake(xrd):
+    integrator = BatchIntegrator(xrd)
+    frames_data = _frames_data(xrd)
+    full = integrator.integrate_cakes(frames_data)
+    integrator.set_window(tth_bins=(20, 45), azi_bins=(10, 30))
+    window = integrator.integrate_cakes(frames_data)
+    assert window.shape == (len(FRAMES), 20, 25)
+    np.testing.assert_allclose(window, full[:, 10:30, 20:45], rtol=1e-6)
+    # ブロックに分けても同じ
+    blocks = [integrator.integrate_cakes(data) for _, data in integrator.iterate_blocks(FRAMES, block_frames=3)]
+    np.testing.assert_allclose(np.concatenate(blocks), window, rtol=1e-6)
@@ -0,0 +1,70 @@
+"""
+cakeの積分画像 (entry/cake_index) から再積算した結果が、今のcakeから直接計算したものと同じになるか
+"""
+import h5py
+import numpy as np
+import pytest
+
+from app_utils.Writer import PeakWriter
+from app_utils.cake_index import CakeIntegralIndex
+from app_utils.peak_handler import Peak
+from conftest import make_peak, make_xrd, write_pattern_and_cake
+
+
+def _peak(xrd) -> Peak:
+    return make_peak(xrd, (20, 35), (10, 30))
+
+
+def _roi_profiles(tmp_hdf, peak: Peak):
+    """ cakeのROIから直接計算した (tthパターン, aziパターン) """
+    with h5py.File(tmp_hdf, 'r') as f:
+        roi = f['entry/cake'][:, peak.from_azi_idx:peak.to_azi_idx, peak.from_tth_idx:peak.to_tth_idx]
+    return roi.mean(axis=1), roi.mean(axis=2)
+
+
+def _re_integrate(tmp_hdf, xrd, peak: Peak):
+    PeakWriter(str(tmp_hdf)).write_re_integrate_peak_data(peak, 0, xrd.frame_num, use_index=True)
+    with h5py.File(tmp_hdf, 'r') as f:
+        return f['entry/peak/0/tth'][:], f['entry/peak/0/azi'][:]
+
+
+def test_index_matches_cake(tmp_path, xrd):
+    tmp_hdf = tmp_path / 'tmp.hdf'
+    write_pattern_and_cake(tmp_hdf, xrd).write_cake_index()
+    assert CakeIntegralIndex.exists(str(tmp_hdf))
+
+    peak = _peak(xrd)
+    tth_pattern, azi_pattern = _re_integrate(tmp_hdf, xrd, peak)
+    expected_tth, expected_azi = _roi_profiles(tmp_hdf, peak)
+    np.testing.assert_allclose(tth_pattern, expected_tth, rtol=1e-4, atol=1e-4)
+    np.testing.assert_allclose(azi_pattern, expected_azi, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize('recake_options', [{'resume': False}, {'resume': True}])
+def test_recake_invalidates_index(tmp_path, xrd_input, recake_options):
+    tmp_hdf = tmp_path / 'tmp.hdf'
+    write_pattern_and_cake(tmp_hdf, make_xrd(xrd_input, npt_tth=100, npt_azi=70)).write_cake_index()
+
+    # 分割数を変えて積算し直すと、前のcakeの積分画像は使わない (消える)
+    xrd = make_xrd(xrd_input)
+    write_pattern_and_cake(tmp_hdf, xrd, **recake_options)
+    assert not CakeIntegralIndex.exists(str(tmp_hdf))
+
+    peak = _peak(xrd)
+    tth_pattern, azi_pattern = _re_integrate(tmp_hdf, xrd, peak)
+    expected_tth, expected_azi = _roi_profiles(tmp_hdf, peak)
+    np.testing.assert_allclose(tth_pattern, expected_tth, rtol=1e-5)
+    np.testing.assert_allclose(azi_pattern, expected_azi, rtol=1e-5)
+
+
+def test_index_of_other_cake_is_rejected(tmp_path, xrd):
+    tmp_hdf = tmp_path / 'tmp.hdf'
+    write_pattern_and_cake(tmp_hdf, xrd).write_cake_index()
+    # XRDWriterを通さずにcakeが書き換えられた場合 (shapeが変わる)
+    with h5py.File(tmp_hdf, 'a') as f:
+        cake = f['entry/cake'][:]
+        del f['entry/cake']
+        f.create_dataset('entry/cake', data=cake[:-1])
+    assert not CakeIntegralIndex.exists(str(tmp_hdf))
+    with pytest.raises(ValueError):
+        CakeIntegralIndex(str(tmp_hdf)).roi_profiles(10, 30, 20, 35)
@@ -0,0 +1,71 @@
+"""
+CakePipeline: 積算スレッドが終わった順番によらず、framesの順に結果を返すか。同時に持つframe数が枠を超えないか
+"""
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from modules.CakePipeline import CakePipeline
+
+
+def _slow_down(pipeline: CakePipeline):
+    """ 積算スレッドごとに待ち時間を変えて、終わる順番を入れ替える """
+    thread_integrates = pipeline._thread_integrates
+
+    def slow_thread_integrates(integrate):
+        def delayed(integrate, delay):
+            def run(frame_data):
+                time.sleep(delay)
+                return integrate(frame_data)
+            return run
+        return [delayed(integrate, 0.02 * (i % 3)) for i, integrate in enumerate(thread_integrates(integrate))]
+    pipeline._thread_integrates = slow_thread_integrates
+
+
+def test_results_come_in_frame_order(xrd, reference):
+    frames = [5, 0, 11, 3, 7, 1, 9, 2]
+    pipeline = CakePipeline(xrd, num_threads=3, memory_budget=64 * xrd.estimate_frame_bytes())
+    _slow_down(pipeline)
+    results = list(pipeline.run('integrate_pattern_and_cake', frames))
+    assert [result[0] for result in results] == frames
+    for frame, pattern, cake in results:
+        np.testing.assert_allclose(pattern, reference[0][frame], rtol=1e-5)
+        np.testing.assert_allclose(cake, reference[1][frame], rtol=1e-5)
+
+
+def test_frames_in_flight_stay_within_budget(xrd):
+    pipeline = CakePipeline(xrd, num_threads=4, memory_budget=3 * xrd.estimate_frame_bytes())
+    assert pipeline.max_in_flight == 3
+    assert pipeline.num_threads == 3 # 枠より多いスレッドは作らない
+
+    read_frame_data, in_flight, lock = xrd._read_frame_data, [0, 0], threading.Lock() # [今, 最大]
+
+    def counting_read(frame):
+        with lock:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight)
+        return read_frame_data(frame)
+    xrd._read_frame_data = counting_read
+    try:
+        for _ in pipeline.run('integrate_cake', range(xrd.frame_num)):
+            time.sleep(0.01) # 書き込みが遅い場合
+            with lock:
+                in_flight[0] -= 1
+    finally:
+        del xrd._read_frame_data
+    assert in_flight[1] <= pipeline.max_in_flight
+
+
+def test_integration_error_is_raised(xrd):
+    pipeline = CakePipeline(xrd, num_threads=2, memory_budget=8 * xrd.estimate_frame_bytes())
+    thread_integrates = pipeline._thread_integrates
+
+    def failing_thread_integrates(integrate):
+        def fail(frame_data):
+            raise ValueError('broken frame')
+        return [fail for _ in thread_integrates(integrate)]
+    pipeline._thread_integrates = failing_thread_integrates
+    with pytest.raises(RuntimeError, match='broken frame'):
+        list(pipeline.run('integrate_cake', range(xrd.frame_num)))
@@ -0,0 +1,59 @@
+"""
+HDF5Reader・HDFDataFetcher の memmap 読み込み (use_memmap=True の場合だけ)
+"""
+import h5py
+import numpy as np
+import pytest
+
+from modules.HDF5 import HDF5Reader, HDFDataFetcher, memmap_dataset
+
+
+@pytest.fixture
+def hdf_path(tmp_path):
+    path = str(tmp_path / 'data.hdf')
+    data = np.arange(4 * 5 * 6, dtype=np.float32).reshape(4, 5, 6)
+    with h5py.File(path, 'w') as f:
+        f.create_dataset('entry/cake', data=data)
+        f.create_dataset('entry/chunked', data=data, chunks=(1, 5, 6), compression='gzip')
+        f.create_dataset('entry/params/npt_tth', data=6.0)
+    return path
+
+
+def test_reader_returns_writable_copy_by_default(hdf_path):
+    data = HDF5Reader(hdf_path).find_by('entry/cake')
+    assert not isinstance(data, np.memmap)
+    data[0, 0, 0] = -1 # 呼び出し側で書き換えられる
+    assert HDF5Reader(hdf_path).find_by('entry/cake')[0, 0, 0] == 0
+
+
+def test_reader_memmap_is_read_only_view(hdf_path):
+    reader = HDF5Reader(hdf_path, use_memmap=True)
+    data = reader.find_by('entry/cake')
+    assert isinstance(data, np.memmap)
+    assert not data.flags.writeable
+    with h5py.File(hdf_path, 'r') as f:
+        np.testing.assert_array_equal(data, f['entry/cake'][:])
+        np.testing.assert_array_equal(reader.find_by('entry/cake', shape=[slice(1, 3), 2]), f['entry/cake'][1:3, 2])
+    assert reader.find_by('npt_tth') == 6.0 # スカラーは今まで通り値で返す
+
+
+def test_fetcher_memmap_and_fallback(hdf_path):
+    with h5py.File(hdf_path, 'r') as f:
+        expected = f['entry/cake'][:]
+    for data_path, memmapped in [('entry/cake', True), ('entry/chunked', False)]:
+        fetcher = HDFDataFetcher(hdf_path, data_path, use_memmap=True)
+        assert fetcher.is_memmapped() == memmapped
+        np.testing.assert_array_equal(fetcher.fetch_by_frame(2), expected[2])
+        np.testing.assert_array_equal(fetcher.fetch(np.s_[:, 1:3, 4]), expected[:, 1:3, 4])
+    assert not HDFDataFetcher(hdf_path, 'entry/cake').is_memmapped()
+    assert memmap_dataset(hdf_path, 'entry/chunked') is None
+
+
+def test_memmap_follows_rewritten_dataset(hdf_path):
+    fetcher = HDFDataFetcher(hdf_path, 'entry/cake', use_memmap=True)
+    fetcher.fetch_by_frame(0)
+    with h5py.File(hdf_path, 'a') as f: # 消して作り直すと、ファイル内の位置が変わる
+        del f['entry/cake']
+        f.create_dataset('entry/padding', data=np.zeros(1000))
+        f.create_dataset('entry/cake', data=np.full((4, 5, 6), 7, dtype=np.float32))
+    np.testing.assert_array_equal(fetcher.fetch_by_frame(0), np.full((5, 6), 7))
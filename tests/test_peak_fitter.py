@@ -0,0 +1,91 @@
+"""
+PeakFitter のフィッティング: 形が分かっているピークから、中心・半値幅・面積が戻るか
+"""
+import h5py
+import numpy as np
+import pytest
+
+from app_utils.Writer import PeakWriter
+from modules.PeakFitter import PeakFitter, _GAUSSIAN_AREA, _LORENTZIAN_AREA
+
+TTH = np.linspace(10, 12, 81)
+FRAME_NUM = 8
+CENTER = np.linspace(10.8, 11.2, FRAME_NUM)
+FWHM = np.linspace(0.15, 0.25, FRAME_NUM)
+AMPLITUDE = np.linspace(100, 200, FRAME_NUM)
+
+
+def _patterns(eta: float = 0.0) -> np.ndarray:
+    """ (frame, bin) の pseudo-Voigt (eta=0 ならガウス関数) + 直線の背景 """
+    u2 = ((TTH - CENTER[:, None]) / FWHM[:, None]) ** 2
+    profile = eta / (1 + 4 * u2) + (1 - eta) * np.exp(-4 * np.log(2) * u2)
+    return AMPLITUDE[:, None] * profile + 5 + 3 * (TTH - 11)
+
+
+@pytest.mark.parametrize('model, eta', [('gaussian', 0.0), ('pseudo_voigt', 0.3)])
+def test_fit_exact_peak(model, eta):
+    result = PeakFitter(model).fit(TTH, _patterns(eta))
+    assert result['converged'].all()
+    np.testing.assert_allclose(result['center'], CENTER, rtol=1e-6)
+    np.testing.assert_allclose(result['fwhm'], FWHM, rtol=1e-5)
+    np.testing.assert_allclose(result['amplitude'], AMPLITUDE, rtol=1e-5)
+    area = AMPLITUDE * FWHM * (eta * _LORENTZIAN_AREA + (1 - eta) * _GAUSSIAN_AREA)
+    np.testing.assert_allclose(result['area'], area, rtol=1e-5)
+    if model == 'pseudo_voigt':
+        np.testing.assert_allclose(result['eta'], eta, atol=1e-5)
+    np.testing.assert_allclose(result['center_err'], 0, atol=1e-6) # 残差がないので誤差も0
+
+
+def test_fit_errors_match_curve_fit():
+    optimize = pytest.importorskip('scipy.optimize')
+    noisy = _patterns() + np.random.default_rng(0).normal(0, 2, (FRAME_NUM, len(TTH)))
+    result = PeakFitter('gaussian').fit(TTH, noisy)
+
+    def gaussian(x, amplitude, center, fwhm, background, slope):
+        return amplitude * np.exp(-4 * np.log(2) * ((x - center) / fwhm) ** 2) + background + slope * (x - 11)
+
+    for frame in (0, FRAME_NUM - 1):
+        expected, covariance = optimize.curve_fit(gaussian, TTH, noisy[frame], p0=[AMPLITUDE[frame], CENTER[frame], FWHM[frame], 5, 3])
+        for i, name in enumerate(PeakFitter.MODELS['gaussian']):
+            np.testing.assert_allclose(result[name][frame], expected[i], rtol=1e-4, atol=1e-6)
+            np.testing.assert_allclose(result[f'{name}_err'][frame], np.sqrt(covariance[i, i]), rtol=1e-3)
+
+
+def test_retry_starts_from_previous_frame():
+    # frame 3 の初期値をピークから遠く離すと、1回目は直線だけに収束する (中心が範囲の外なので収束しない扱い)
+    fitter = PeakFitter('gaussian')
+    initial_params = fitter._initial_params
+
+    def bad_initial_params(x, patterns):
+        params = initial_params(x, patterns)
+        params[3, 1] = x[0] - 100
+        return params
+    fitter._initial_params = bad_initial_params
+    fit_block, retried = fitter._fit_block, []
+
+    def recording_fit_block(x, patterns, params):
+        retried.append(params.copy())
+        return fit_block(x, patterns, params)
+    fitter._fit_block = recording_fit_block
+
+    result = fitter.fit(TTH, _patterns())
+    assert len(retried) == 2 # 全frame + frame 3 のやり直し
+    np.testing.assert_allclose(retried[1][0, 1], CENTER[2]) # frame 2 の解から解き直す
+    assert result['converged'].all()
+    np.testing.assert_allclose(result['center'], CENTER, rtol=1e-6)
+
+
+def test_write_peak_fit(tmp_path):
+    tmp_hdf = str(tmp_path / 'tmp.hdf')
+    with h5py.File(tmp_hdf, 'w') as f:
+        f.create_dataset('entry/peak/0/tth', data=_patterns())
+
+    PeakWriter(tmp_hdf).write_peak_fit(0, TTH, model='gaussian')
+    result = PeakWriter.read_peak_fit(tmp_hdf, 0)
+    np.testing.assert_allclose(result['center'], CENTER, rtol=1e-6)
+    np.testing.assert_allclose(result['area'], AMPLITUDE * FWHM * _GAUSSIAN_AREA, rtol=1e-5)
+    assert PeakWriter.read_peak_fit(tmp_hdf, 1) == {}
+
+    # 再積算した後にピークの2θの範囲を変えた場合
+    with pytest.raises(ValueError):
+        PeakWriter(tmp_hdf).write_peak_fit(0, TTH[:-1], model='gaussian')
@@ -0,0 +1,51 @@
+"""
+PeakWriter の再積算: 複数のピークをまとめて再積算した結果と、読み込むROI
+"""
+import h5py
+import numpy as np
+import pytest
+
+from app_utils.Writer import PeakWriter
+from conftest import make_peak, write_tmp_hdf
+
+
+@pytest.fixture
+def peaks(xrd):
+    # 0, 1 は重なっていて、2 は2θ方向に離れている
+    return {
+        0: make_peak(xrd, (10, 20), (5, 25)),
+        1: make_peak(xrd, (15, 24), (10, 30)),
+        2: make_peak(xrd, (60, 70), (30, 50)),
+    }
+
+
+def test_group_rois_splits_distant_peaks(peaks):
+    groups = PeakWriter._group_rois(peaks)
+    assert [peak_nums for _, peak_nums in groups] == [[0, 1], [2]]
+    for roi, peak_nums in groups:
+        for peak_num in peak_nums: # グループのROIは、含まれる全ピークの範囲を囲む
+            peak = peaks[peak_num]
+            assert roi[0] <= peak.from_azi_idx and peak.to_azi_idx <= roi[1]
+            assert roi[2] <= peak.from_tth_idx and peak.to_tth_idx <= roi[3]
+
+
+@pytest.mark.parametrize('cake_layout', ['contiguous', 'roi'])
+def test_re_integrate_peaks_reads_only_grouped_rois(tmp_path, xrd, peaks, cake_layout):
+    tmp_hdf = str(tmp_path / 'tmp.hdf')
+    write_tmp_hdf(tmp_hdf, xrd, cake_layout=cake_layout).write_cake_data()
+
+    peak_writer = PeakWriter(tmp_hdf)
+    peak_writer.write_re_integrate_peaks(peaks, xrd.frame_num, use_index=False)
+
+    with h5py.File(tmp_hdf, 'r') as f:
+        cake = f['entry/cake'][:]
+        for peak_num, peak in peaks.items():
+            roi = cake[:, peak.from_azi_idx:peak.to_azi_idx, peak.from_tth_idx:peak.to_tth_idx]
+            np.testing.assert_allclose(f[f'entry/peak/{peak_num}/tth'][:], roi.mean(axis=1), rtol=1e-6)
+            np.testing.assert_allclose(f[f'entry/peak/{peak_num}/azi'][:], roi.mean(axis=2), rtol=1e-6)
+
+    # 全ピークを囲む1つのROIより少なく読む
+    read_bytes = peak_writer.run_report['stages']['read_roi']['bytes']
+    union_size = (50 - 5) * (70 - 10)
+    assert read_bytes == xrd.frame_num * 4 * sum(PeakWriter._roi_size(roi) for roi, _ in PeakWriter._group_rois(peaks))
+    assert read_bytes < xrd.frame_num * 4 * union_size
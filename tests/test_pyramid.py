@@ -0,0 +1,66 @@
+"""
+cake・patternの縮小版 (entry/pyramid) が、積算し直した後も今のデータと合っているか
+"""
+import h5py
+import numpy as np
+
+from app_utils.Writer import XRDWriter
+from app_utils.pyramid import CakePyramid, downsample
+from conftest import make_xrd, write_pattern_and_cake
+
+# 縮小版を作るには CakePyramid.MIN_SIZE の2倍以上のbinが必要
+NPT_TTH = 300
+NPT_AZI = 260
+
+
+def test_pyramid_matches_data(tmp_path, xrd_input):
+    tmp_hdf = tmp_path / 'tmp.hdf'
+    write_pattern_and_cake(tmp_hdf, make_xrd(xrd_input, npt_tth=NPT_TTH, npt_azi=NPT_AZI), build_pyramid=True)
+
+    pyramid = CakePyramid(str(tmp_hdf))
+    assert pyramid.available_factors('pattern') == [1, 2]
+    assert pyramid.available_factors('cake') == [1, 2]
+    with h5py.File(tmp_hdf, 'r') as f:
+        pattern, cake = f['entry/pattern'][:], f['entry/cake'][:]
+    pattern_2x, factor = pyramid.fetch_pattern(display_shape=(1, NPT_TTH // 2))
+    assert factor == 2
+    np.testing.assert_allclose(pattern_2x, downsample(pattern, 2, axes=(0, 1)), rtol=1e-5)
+    cake_2x, factor = pyramid.fetch_cake_frame(3, display_shape=(NPT_AZI // 2, NPT_TTH // 2))
+    assert factor == 2
+    np.testing.assert_allclose(cake_2x, downsample(cake[3], 2, axes=(0, 1)), rtol=1e-5)
+
+
+def test_recake_without_pyramid_removes_old_pyramid(tmp_path, xrd_input, xrd):
+    tmp_hdf = tmp_path / 'tmp.hdf'
+    write_pattern_and_cake(tmp_hdf, make_xrd(xrd_input, npt_tth=NPT_TTH, npt_azi=NPT_AZI), build_pyramid=True)
+    write_pattern_and_cake(tmp_hdf, xrd, build_pyramid=False)
+
+    pyramid = CakePyramid(str(tmp_hdf))
+    assert pyramid.available_factors('pattern') == [1]
+    assert pyramid.available_factors('cake') == [1]
+    pattern, factor = pyramid.fetch_pattern(display_shape=(1, 1))
+    assert factor == 1
+    assert pattern.shape == (xrd.frame_num, xrd.npt_tth)
+
+
+def test_pattern_only_rewrite_removes_old_pattern_pyramid(tmp_path, xrd_input):
+    tmp_hdf = tmp_path / 'tmp.hdf'
+    xrd = make_xrd(xrd_input, npt_tth=NPT_TTH, npt_azi=NPT_AZI)
+    write_pattern_and_cake(tmp_hdf, xrd, build_pyramid=True)
+    # 同じ条件でpatternだけを積算し直した場合も (resume=False)、縮小版は作らないので残さない
+    writer = XRDWriter(str(tmp_hdf), xrd, resume=False)
+    writer.write_pattern_data()
+    assert CakePyramid(str(tmp_hdf)).available_factors('pattern') == [1]
+
+
+def test_fetch_cake_frame_memmap_is_opt_in(tmp_path, xrd):
+    tmp_hdf = tmp_path / 'tmp.hdf'
+    write_pattern_and_cake(tmp_hdf, xrd)
+    with h5py.File(tmp_hdf, 'r') as f:
+        expected = f['entry/cake'][3]
+
+    cake, _ = CakePyramid(str(tmp_hdf)).fetch_cake_frame(3)
+    assert not isinstance(cake, np.memmap) and cake.flags.writeable
+    cake, _ = CakePyramid(str(tmp_hdf), use_memmap=True).fetch_cake_frame(3)
+    assert isinstance(cake, np.memmap) and not cake.flags.writeable
+    np.testing.assert_array_equal(cake, expected)
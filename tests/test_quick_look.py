@@ -0,0 +1,85 @@
+"""
+クイックルック (XRDWriter.write_quick_look) の後に、全frameの積算で残りを埋める
+"""
+import h5py
+import numpy as np
+
+from app_utils.Writer import XRDWriter
+from app_utils.pyramid import CakePyramid, downsample
+from conftest import make_xrd, write_tmp_hdf
+
+
+def _read(tmp_hdf):
+    with h5py.File(tmp_hdf, 'r') as f:
+        return f['entry/pattern'][:], f['entry/cake'][:]
+
+
+def test_fill_after_strided_quick_look(tmp_path, xrd, reference):
+    tmp_hdf = tmp_path / 'tmp.hdf'
+    ref_pattern, ref_cake = reference
+    write_tmp_hdf(tmp_hdf, xrd).write_quick_look(frame_step=3)
+
+    progress = XRDWriter.read_progress(str(tmp_hdf))['cake']
+    quick_frames = list(range(0, xrd.frame_num, 3))
+    assert progress['done_frames'] == len(quick_frames)
+    assert progress['partial']
+    assert progress['quick_look']['frame_step'] == 3
+    pattern, cake = _read(tmp_hdf)
+    np.testing.assert_allclose(cake[quick_frames], ref_cake[quick_frames], rtol=1e-5)
+    assert not cake[1].any() # まだ積算していないframeは0
+
+    writer = write_tmp_hdf(tmp_hdf, xrd)
+    writer.write_pattern_and_cake_data()
+    assert writer.run_report['frame_count'] == xrd.frame_num - len(quick_frames) # クイックルックのframeは積算し直さない
+    progress = XRDWriter.read_progress(str(tmp_hdf))['cake']
+    assert progress['done_frames'] == xrd.frame_num
+    assert not progress['partial']
+    assert progress['quick_look'] is None
+    pattern, cake = _read(tmp_hdf)
+    np.testing.assert_allclose(pattern, ref_pattern, rtol=1e-5)
+    np.testing.assert_allclose(cake, ref_cake, rtol=1e-5)
+
+
+def test_fill_after_windowed_quick_look(tmp_path, xrd, reference):
+    tmp_hdf = tmp_path / 'tmp.hdf'
+    ref_pattern, ref_cake = reference
+    tth_arr, azi_arr = xrd.get_tth(), xrd.get_azi()
+    write_tmp_hdf(tmp_hdf, xrd).write_quick_look(frame_step=2, tth_range=(tth_arr[20], tth_arr[39]), azi_range=(azi_arr[10], azi_arr[29]))
+
+    progress = XRDWriter.read_progress(str(tmp_hdf))
+    assert progress['cake']['done_frames'] == 0 # 範囲を絞ったframeは完了にしない
+    assert progress['cake']['quick_look']['tth_bins'] == [20, 40]
+    assert progress['cake']['quick_look']['azi_bins'] == [10, 30]
+    pattern, cake = _read(tmp_hdf)
+    window = np.s_[::2, 10:30, 20:40]
+    np.testing.assert_allclose(cake[window], ref_cake[window], atol=1e-4 * ref_cake.max())
+    assert not cake[::2, :10].any() and not cake[::2, :, :20].any() # 範囲の外は0
+    assert not pattern.any() # 方位角を絞った場合、patternは書き込まない
+
+    writer = write_tmp_hdf(tmp_hdf, xrd)
+    writer.write_pattern_and_cake_data()
+    assert writer.run_report['frame_count'] == xrd.frame_num
+    assert not XRDWriter.read_progress(str(tmp_hdf))['cake']['partial']
+    pattern, cake = _read(tmp_hdf)
+    np.testing.assert_allclose(pattern, ref_pattern, rtol=1e-5)
+    np.testing.assert_allclose(cake, ref_cake, rtol=1e-5)
+
+
+def test_windowed_quick_look_updates_cake_pyramid(tmp_path, xrd_input):
+    # Nframeおきのクイックルックの後に範囲を絞ったクイックルックをしても、縮小版が書き込んだcakeと合っている
+    tmp_hdf = tmp_path / 'tmp.hdf'
+    xrd = make_xrd(xrd_input, npt_tth=300, npt_azi=260) # 縮小版を作るには CakePyramid.MIN_SIZE の2倍以上のbinが必要
+    tth_arr = xrd.get_tth()
+    write_tmp_hdf(tmp_hdf, xrd, build_pyramid=True).write_quick_look(frame_step=3)
+    write_tmp_hdf(tmp_hdf, xrd, build_pyramid=True).write_quick_look(frame_step=2, tth_range=(tth_arr[100], tth_arr[199]))
+
+    def assert_pyramid_matches_cake():
+        with h5py.File(tmp_hdf, 'r') as f:
+            cake, cake_2x = f['entry/cake'][:], f[CakePyramid.data_path('cake', 2)][:]
+        np.testing.assert_allclose(cake_2x, downsample(cake, 2, axes=(1, 2)), rtol=1e-5, atol=1e-6)
+        return cake
+
+    cake = assert_pyramid_matches_cake()
+    assert cake[2, :, 100:200].any() # 範囲を絞って書き込んだframe
+    write_tmp_hdf(tmp_hdf, xrd, build_pyramid=True).write_pattern_and_cake_data()
+    assert_pyramid_matches_cake()
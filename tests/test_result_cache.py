@@ -0,0 +1,42 @@
+"""
+IntegrationCache のキー: 積算結果を変える設定だけで変わり、ファイルのコピーでは変わらない
+"""
+import os
+import shutil
+
+from app_utils.result_cache import IntegrationCache
+from modules.XRD import XRD
+from conftest import make_xrd
+
+
+def test_key_ignores_location_and_mtime(tmp_path, xrd_input, xrd):
+    nxs_path, poni_path = xrd_input
+    copied_nxs = str(tmp_path / 'copied.nxs')
+    copied_poni = str(tmp_path / 'copied.poni')
+    shutil.copyfile(nxs_path, copied_nxs) # 更新時刻はコピーした時刻になる
+    shutil.copyfile(poni_path, copied_poni)
+    os.utime(copied_nxs, ns=(0, 0))
+    copied = XRD(xrd_path=copied_nxs, poni_path=copied_poni, npt_tth=xrd.npt_tth, npt_azi=xrd.npt_azi)
+    assert IntegrationCache.fingerprint(copied) == IntegrationCache.fingerprint(xrd)
+
+
+def test_key_changes_with_integration_settings(xrd_input):
+    key = IntegrationCache.fingerprint(make_xrd(xrd_input))
+    assert IntegrationCache.fingerprint(make_xrd(xrd_input, npt_tth=81)) != key
+
+    xrd = make_xrd(xrd_input)
+    xrd.set_methods(method_2d=['no', 'histogram', 'cython', None])
+    assert IntegrationCache.fingerprint(xrd) != key
+
+    xrd = make_xrd(xrd_input)
+    xrd.set_frame_range(2, 8)
+    assert IntegrationCache.fingerprint(xrd) != key
+
+
+def test_key_changes_with_outputs(xrd):
+    # 復元したtmp.hdfに入っているもの (インデックス・縮小版など) が違えば別のキー
+    outputs = {'cake_layout': 'contiguous', 'build_pyramid': True, 'cake_index': False}
+    key = IntegrationCache.fingerprint(xrd, outputs=outputs)
+    assert IntegrationCache.fingerprint(xrd, outputs=dict(outputs)) == key
+    assert IntegrationCache.fingerprint(xrd, outputs={**outputs, 'cake_index': True}) != key
+    assert IntegrationCache.fingerprint(xrd, outputs={**outputs, 'build_pyramid': False}) != key
@@ -0,0 +1,42 @@
+"""
+ShardedCaking: frameの範囲ごとに書き込んだshardを、VDSで1つのtmp.hdfにまとめる
+"""
+import h5py
+import numpy as np
+
+from app_utils.Writer import XRDWriter
+from app_utils.shards import ShardedCaking
+from modules.HDF5 import HDF5Reader
+
+
+def test_assembled_vds_equals_single_process_cake(tmp_path, xrd, reference):
+    tmp_hdf = str(tmp_path / 'tmp.hdf')
+    progress = ShardedCaking(tmp_hdf, xrd, shard_num=3).run_local(num_workers=2)
+    assert progress == {'shards': 3, 'found_shards': 3, 'done_frames': xrd.frame_num, 'frame_num': xrd.frame_num}
+
+    with h5py.File(tmp_hdf, 'r') as f:
+        assert f['entry/cake'].is_virtual
+        assert not f['entry/cake'].attrs['partial']
+    reader = HDF5Reader(tmp_hdf)
+    np.testing.assert_allclose(reader.find_by('pattern'), reference[0], rtol=1e-5)
+    np.testing.assert_allclose(reader.find_by('cake'), reference[1], rtol=1e-5)
+    fetcher = reader.create_fetcher('cake')
+    np.testing.assert_allclose(fetcher.fetch_by_frame(xrd.frame_num - 1), reference[1][-1], rtol=1e-5)
+
+
+def test_assemble_with_missing_shard(tmp_path, xrd, reference):
+    tmp_hdf = str(tmp_path / 'tmp.hdf')
+    caking = ShardedCaking(tmp_hdf, xrd, shard_num=3)
+    caking.write_shard(0)
+    caking.write_shard(2)
+    progress = caking.assemble()
+    assert progress['found_shards'] == 2
+
+    missing_from, missing_to = caking.plan()[1]['frame_range']
+    done = XRDWriter.read_progress(tmp_hdf)['cake']
+    assert done['partial']
+    assert done['done_frames'] == xrd.frame_num - (missing_to - missing_from)
+    cake = HDF5Reader(tmp_hdf).find_by('cake')
+    assert not cake[missing_from:missing_to].any() # 無いshardの部分は0
+    np.testing.assert_allclose(cake[:missing_from], reference[1][:missing_from], rtol=1e-5)
+    np.testing.assert_allclose(cake[missing_to:], reference[1][missing_to:], rtol=1e-5)
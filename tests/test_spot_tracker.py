@@ -0,0 +1,40 @@
+"""
+SpotTracker: スポットをframeごとにつないだ軌跡
+"""
+import numpy as np
+
+from app_utils.spot_tracker import SpotTracker
+
+
+def _spots(rows):
+    """ [(frame, tth, azi), ...] を frame順に並べた列のdict """
+    rows = sorted(rows)
+    frames, tth, azi = (np.array(column) for column in zip(*rows))
+    return {'frame': frames, 'tth': tth, 'azi': azi, 'intensity': np.ones(len(rows), dtype=np.float32)}
+
+
+def test_track_crossing_180_stays_one_track():
+    # 方位角が 1frameに1.5°ずつ増えて 180° をまたぐ粒 (frame 4 は検出漏れ) と、止まっている粒
+    crossing = [(frame, 10.0, (174.0 + 1.5 * frame + 180.0) % 360.0 - 180.0) for frame in range(10) if frame != 4]
+    still = [(frame, 12.0, 179.0) for frame in range(10)]
+    spots = _spots(crossing + still)
+    assert (spots['azi'] < 0).any() and (spots['azi'] > 0).any()
+
+    tracker = SpotTracker(tth_tolerance=0.05, azi_tolerance=2.0, max_gap=3)
+    track_ids = tracker.link(spots['frame'], spots['tth'], spots['azi'])
+    on_crossing = spots['tth'] == 10.0
+    assert len(np.unique(track_ids[on_crossing])) == 1
+    assert len(np.unique(track_ids[~on_crossing])) == 1
+    assert track_ids[on_crossing][0] != track_ids[~on_crossing][0]
+
+    tracks, _ = tracker.summarize(track_ids, spots)
+    crossing_id = track_ids[on_crossing][0]
+    assert tracks['length'][crossing_id] == 9
+    np.testing.assert_allclose(tracks['drift_azi'][crossing_id], 1.5, rtol=1e-5) # 360°跳ばない
+    assert abs(abs(tracks['azi'][crossing_id]) - 180.0) < 5.0
+
+
+def test_gap_longer_than_max_gap_splits_track():
+    spots = _spots([(frame, 10.0, 30.0) for frame in (0, 1, 2, 7, 8)])
+    track_ids = SpotTracker(max_gap=3).link(spots['frame'], spots['tth'], spots['azi'])
+    assert track_ids.tolist() == [0, 0, 0, 1, 1]
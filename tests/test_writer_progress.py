@@ -0,0 +1,95 @@
+"""
+XRDWriter の完了フラグ (entry/progress): 途中で止まった書き込みの再開と、書き込んだtmp.hdfの検索
+"""
+import numpy as np
+import pytest
+
+from app_utils.Writer import XRDWriter
+from conftest import make_xrd, write_pattern_and_cake, write_tmp_hdf
+from modules.HDF5 import HDF5Reader
+
+
+class Interrupted(Exception):
+    pass
+
+
+def _interrupt_after(writer: XRDWriter, frame_count: int):
+    """ frame_count frame積算したところで例外を投げるようにする (書き込み中に落ちた場合) """
+    iterate = writer._iterate_pattern_and_cake
+
+    def interrupted(frames):
+        for i, result in enumerate(iterate(frames)):
+            if i == frame_count:
+                raise Interrupted()
+            yield result
+    writer._iterate_pattern_and_cake = interrupted
+
+
+def test_resume_after_interrupted_write(tmp_path, xrd, reference):
+    tmp_hdf = tmp_path / 'tmp.hdf'
+    writer = write_tmp_hdf(tmp_hdf, xrd)
+    _interrupt_after(writer, 5)
+    with pytest.raises(Interrupted):
+        writer.write_pattern_and_cake_data()
+
+    progress = XRDWriter.read_progress(str(tmp_hdf))
+    for name in ('pattern', 'cake'):
+        assert progress[name]['done_frames'] == 5
+        assert progress[name]['partial'] # 落ちた場合も未完了になっている
+
+    writer = write_tmp_hdf(tmp_hdf, xrd)
+    writer.write_pattern_and_cake_data()
+    assert writer.run_report['frame_count'] == xrd.frame_num - 5 # 完了済みのframeは積算し直さない
+
+    progress = XRDWriter.read_progress(str(tmp_hdf))
+    for name in ('pattern', 'cake'):
+        assert progress[name]['done_frames'] == xrd.frame_num
+        assert not progress[name]['partial']
+    reader = HDF5Reader(str(tmp_hdf))
+    np.testing.assert_allclose(reader.find_by('pattern'), reference[0], rtol=1e-5)
+    np.testing.assert_allclose(reader.find_by('cake'), reference[1], rtol=1e-5)
+
+
+def test_resume_with_other_integration_method(tmp_path, xrd_input):
+    # 積算方法 (MethodTuner の結果) は積算結果を変えないので、変えても途中から再開する
+    tmp_hdf = tmp_path / 'tmp.hdf'
+    xrd = make_xrd(xrd_input)
+    writer = write_tmp_hdf(tmp_hdf, xrd)
+    _interrupt_after(writer, 5)
+    with pytest.raises(Interrupted):
+        writer.write_pattern_and_cake_data()
+
+    xrd.set_methods(method_1d=['bbox', 'csr', 'cython', None], method_2d=['bbox', 'csr', 'cython', None])
+    writer = write_tmp_hdf(tmp_hdf, xrd)
+    writer.write_pattern_and_cake_data()
+    assert writer.run_report['frame_count'] == xrd.frame_num - 5
+
+
+def test_resume_false_starts_over(tmp_path, xrd):
+    tmp_hdf = tmp_path / 'tmp.hdf'
+    writer = write_tmp_hdf(tmp_hdf, xrd)
+    _interrupt_after(writer, 5)
+    with pytest.raises(Interrupted):
+        writer.write_pattern_and_cake_data()
+
+    writer = write_tmp_hdf(tmp_hdf, xrd, resume=False)
+    writer.write_pattern_and_cake_data()
+    assert writer.run_report['frame_count'] == xrd.frame_num
+
+
+@pytest.mark.parametrize('cake_layout', ['contiguous', 'roi'])
+def test_find_by_and_fetcher_on_written_tmp_hdf(tmp_path, xrd, reference, cake_layout):
+    # entry/progress/<cake, pattern>・entry/report・entry/pyramid があっても entry/cake, entry/pattern が見つかる
+    tmp_hdf = tmp_path / 'tmp.hdf'
+    write_pattern_and_cake(tmp_hdf, xrd, cake_layout=cake_layout, build_pyramid=True)
+
+    reader = HDF5Reader(str(tmp_hdf))
+    assert reader.search_data_path('cake') == 'entry/cake'
+    assert reader.search_data_path('pattern') == 'entry/pattern'
+    np.testing.assert_allclose(reader.find_by('pattern'), reference[0], rtol=1e-5)
+    fetcher = reader.create_fetcher('cake')
+    assert fetcher.data_path == 'entry/cake'
+    assert fetcher.get_shape() == reference[1].shape
+    np.testing.assert_allclose(fetcher.fetch_by_frame(3), reference[1][3], rtol=1e-5)
+    # 他のデータセットは今まで通り、queryで終わるpathが1つだけなら見つかる
+    np.testing.assert_array_equal(reader.find_by('arr/frame'), np.arange(xrd.frame_num))
@@ -0,0 +1,49 @@
+"""
+検出器が .nxs に書き込んでいる状況を再現する (ライブ処理の確認用)
+
+SWMRモードで /entry/instrument/detector/data に1frameずつ追加していく。
+別のターミナルで XRDWriter.follow_data (Cakingページのライブ処理) を動かすと、追加されたframeから順に積算される。
+
+    python -m tools.simulate_detector out.nxs out.poni --frames 200 --fps 5
+"""
+import argparse
+import os
+import time
+
+import h5py
+import numpy as np
+
+from tools.synthetic import SyntheticFrames, write_poni
+
+
+def simulate(nxs_path: str, poni_path: str, frame_num: int, fps: float, exposure_ms: float = 10.0, seed: int = 0):
+    if not os.path.exists(poni_path):
+        write_poni(poni_path)
+    frames = SyntheticFrames(poni_path, seed=seed)
+    with h5py.File(nxs_path, 'w', libver='latest') as f:
+        dataset = f.create_dataset(
+            'entry/instrument/detector/data',
+            shape=(0, *frames.shape),
+            maxshape=(None, *frames.shape),
+            chunks=(1, *frames.shape),
+            dtype=np.uint32,
+        )
+        f.create_dataset('entry/instrument/detector/count_time', data=np.array([exposure_ms]))
+        f.swmr_mode = True # ここから先は読み込み側がSWMRで読める
+        for frame in range(frame_num):
+            dataset.resize(frame + 1, axis=0)
+            dataset[frame] = frames.frame(frame)
+            dataset.flush()
+            print(f"frame {frame + 1}/{frame_num}")
+            time.sleep(1.0 / fps)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='検出器の書き込みを再現して、.nxsにframeを追加し続ける')
+    parser.add_argument('nxs_path')
+    parser.add_argument('poni_path', help='無ければ作る')
+    parser.add_argument('--frames', type=int, default=200)
+    parser.add_argument('--fps', type=float, default=5.0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    simulate(args.nxs_path, args.poni_path, args.frames, args.fps, seed=args.seed)
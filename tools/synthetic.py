@@ -0,0 +1,85 @@
+"""
+テスト・ベンチマーク用に、検出器データ(.nxs)と校正データ(.poni)を人工的に作る
+
+.nxs は実際のものと同じく /entry/instrument/detector/data に (frame, y, x) の画像、
+/entry/instrument/detector/count_time に露光時間(ms)を持つ。
+画像はデバイリング + 時間とともに少しずつ動く回折斑点 + ポアソンノイズ。
+"""
+import json
+
+import h5py
+import numpy as np
+import pyFAI
+
+
+def write_poni(poni_path: str, shape=(512, 512), pixel_size=75e-6, distance=0.2, wavelength=0.4e-10):
+    """ ビームが検出器の中心に当たる配置の .poni を書き込む """
+    detector_config = {'pixel1': pixel_size, 'pixel2': pixel_size, 'max_shape': list(shape)}
+    with open(poni_path, 'w') as f:
+        f.write(
+            "poni_version: 2\n"
+            "Detector: Detector\n"
+            f"Detector_config: {json.dumps(detector_config)}\n"
+            f"Distance: {distance}\n"
+            f"Poni1: {shape[0] * pixel_size / 2}\n"
+            f"Poni2: {shape[1] * pixel_size / 2}\n"
+            "Rot1: 0\n"
+            "Rot2: 0\n"
+            "Rot3: 0\n"
+            f"Wavelength: {wavelength}\n"
+        )
+    return poni_path
+
+
+class SyntheticFrames:
+    """ .poni の配置で、frameごとの画像を作るクラス """
+    def __init__(self, poni_path: str, ring_num: int = 6, spot_num: int = 40, seed: int = 0):
+        ai = pyFAI.load(poni_path)
+        self.shape = tuple(ai.detector.max_shape)
+        self.tth = ai.center_array(self.shape, unit='2th_deg')
+        self.chi = ai.center_array(self.shape, unit='chi_deg')
+        rng = np.random.default_rng(seed)
+        tth_max = self.tth.max()
+        self.ring_tth = np.linspace(0.2, 0.85, ring_num) * tth_max
+        self.ring_intensity = rng.uniform(50, 200, ring_num)
+        # 斑点はリング上に置き、frameとともに方位角方向に少しずつ動かす。寿命もばらばらにする
+        ring_idx = rng.integers(0, ring_num, spot_num)
+        self.spot_tth = self.ring_tth[ring_idx] + rng.normal(0, 0.02, spot_num)
+        self.spot_chi = rng.uniform(-180, 180, spot_num)
+        self.spot_drift = rng.normal(0, 0.05, spot_num) # deg / frame
+        self.spot_intensity = rng.uniform(300, 2000, spot_num)
+        self.spot_born = rng.integers(0, 200, spot_num)
+        self.spot_lifetime = rng.integers(50, 400, spot_num)
+        self.seed = seed
+
+    def frame(self, frame: int) -> np.ndarray:
+        image = np.full(self.shape, 10.0)
+        for tth, intensity in zip(self.ring_tth, self.ring_intensity):
+            image += intensity * np.exp(-0.5 * ((self.tth - tth) / 0.01) ** 2)
+        alive = (self.spot_born <= frame) & (frame < self.spot_born + self.spot_lifetime)
+        for i in np.flatnonzero(alive):
+            chi = (self.spot_chi[i] + self.spot_drift[i] * frame + 180) % 360 - 180
+            d_chi = (self.chi - chi + 180) % 360 - 180
+            image += self.spot_intensity[i] * np.exp(
+                -0.5 * (((self.tth - self.spot_tth[i]) / 0.01) ** 2 + (d_chi / 0.5) ** 2)
+            )
+        rng = np.random.default_rng(self.seed * 1_000_003 + frame)
+        return rng.poisson(image).astype(np.uint32)
+
+
+def write_nxs(nxs_path: str, poni_path: str, frame_num: int = 100, exposure_ms: float = 10.0,
+              compression: str = None, chunk_frames: int = 1, seed: int = 0):
+    """ 全frameを書き込んだ .nxs を作る """
+    frames = SyntheticFrames(poni_path, seed=seed)
+    with h5py.File(nxs_path, 'w') as f:
+        dataset = f.create_dataset(
+            'entry/instrument/detector/data',
+            shape=(frame_num, *frames.shape),
+            dtype=np.uint32,
+            chunks=(min(chunk_frames, frame_num), *frames.shape),
+            compression=compression,
+        )
+        for frame in range(frame_num):
+            dataset[frame] = frames.frame(frame)
+        f.create_dataset('entry/instrument/detector/count_time', data=np.array([exposure_ms]))
+    return nxs_path